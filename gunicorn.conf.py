@@ -1,2 +1,14 @@
 workers = 3
-# threads = 2  # Ignore for now - not sure if DB request dumping is thread safe
\ No newline at end of file
+# threads = 2  # Ignore for now - not sure if DB request dumping is thread safe
+
+
+def post_fork(server, worker):
+    """Each worker has its own metrics, so they each serve them on their own port. Workers
+    are replaced when they exit, so each takes the first free port from
+    ASTROFEED_METRICS_PORT onwards (rather than one based on the order they started in.)
+    """
+    from astrofeed_lib.config import METRICS_PORT
+    from astrofeed_lib.metrics import serve_metrics_on_free_port
+
+    if METRICS_PORT is not None:
+        serve_metrics_on_free_port(METRICS_PORT, server.cfg.workers)
@@ -15,6 +15,7 @@ CREATE TABLE "account" (
 ,  "muted_count" integer NOT NULL
 ,  "banned_count" integer NOT NULL
 ,  "warned_count" integer NOT NULL
+,  "updated_at" timestamp NOT NULL
 );
 DROP INDEX IF EXISTS "account_did";
 CREATE INDEX "account_did" ON "account" ("did");
@@ -30,6 +31,8 @@ DROP INDEX IF EXISTS "account_is_valid";
 CREATE INDEX "account_is_valid" ON "account" ("is_valid");
 DROP INDEX IF EXISTS "account_mod_level";
 CREATE INDEX "account_mod_level" ON "account" ("mod_level");
+DROP INDEX IF EXISTS "account_updated_at";
+CREATE INDEX "account_updated_at" ON "account" ("updated_at");
 DROP INDEX IF EXISTS "idx_account_account_did_is_valid";
 CREATE INDEX "idx_account_account_did_is_valid" ON "account" ("did","is_valid");
 DROP INDEX IF EXISTS "idx_account_account_handle";
@@ -0,0 +1,10 @@
+BEGIN TRANSACTION;
+DROP TABLE IF EXISTS "accountchange";
+CREATE TABLE "accountchange" (
+  "id" SERIAL PRIMARY KEY
+,  "changed_at" timestamp NOT NULL
+,  "did" varchar(255) NOT NULL
+);
+DROP INDEX IF EXISTS "accountchange_changed_at";
+CREATE INDEX "accountchange_changed_at" ON "accountchange" ("changed_at");
+COMMIT;
@@ -5,6 +5,9 @@
 \i subscriptionstate.sql
 
 \i normalizedfeedstats.sql
+\i postlike.sql
+\i toppost.sql
+\i accountchange.sql
 
 
 
@@ -26,6 +26,8 @@ DROP INDEX IF EXISTS "botactions_stage";
 CREATE INDEX "botactions_stage" ON "botactions" ("stage");
 DROP INDEX IF EXISTS "botactions_type";
 CREATE INDEX "botactions_type" ON "botactions" ("type");
+DROP INDEX IF EXISTS "botactions_type_stage_complete_indexed_at_id";
+CREATE INDEX "botactions_type_stage_complete_indexed_at_id" ON "botactions" ("type","stage","complete","indexed_at","id");
 DROP INDEX IF EXISTS "idx_botactions_botactions_authorized";
 CREATE INDEX "idx_botactions_botactions_authorized" ON "botactions" ("authorized");
 DROP INDEX IF EXISTS "idx_botactions_botactions_checked_at";
@@ -27,6 +27,8 @@ CREATE TABLE "post" (
 ,  "feed_research" boolean NOT NULL DEFAULT FALSE
 ,  "feed_solar" boolean NOT NULL DEFAULT FALSE
 ,  "feed_questions" boolean NOT NULL DEFAULT FALSE
+,  "is_reply" boolean NOT NULL DEFAULT FALSE
+,  "reply_root" bigint DEFAULT NULL
 );
 DROP INDEX IF EXISTS "idx_post_cid";
 CREATE INDEX "idx_post_cid" ON "post" ("cid");
@@ -72,6 +74,12 @@ DROP INDEX IF EXISTS "idx_post_post_hidden";
 CREATE INDEX "idx_post_post_hidden" ON "post" ("hidden");
 DROP INDEX IF EXISTS "idx_post_post_indexed_at";
 CREATE INDEX "idx_post_post_indexed_at" ON "post" ("indexed_at");
+DROP INDEX IF EXISTS "post_indexed_at_id";
+CREATE INDEX "post_indexed_at_id" ON "post" ("indexed_at","id");
+DROP INDEX IF EXISTS "post_is_reply_indexed_at_id";
+CREATE INDEX "post_is_reply_indexed_at_id" ON "post" ("is_reply","indexed_at","id");
+DROP INDEX IF EXISTS "post_reply_root";
+CREATE INDEX "post_reply_root" ON "post" ("reply_root");
 DROP INDEX IF EXISTS "idx_post_post_uri";
 CREATE INDEX "idx_post_post_uri" ON "post" ("uri");
 COMMIT;
@@ -0,0 +1,15 @@
+BEGIN TRANSACTION;
+DROP TABLE IF EXISTS "postlike";
+CREATE TABLE "postlike" (
+  "id" SERIAL PRIMARY KEY
+,  "indexed_at" timestamp NOT NULL
+,  "uri" varchar(255) NOT NULL
+,  "post_uri" varchar(255) NOT NULL
+);
+DROP INDEX IF EXISTS "postlike_indexed_at";
+CREATE INDEX "postlike_indexed_at" ON "postlike" ("indexed_at");
+DROP INDEX IF EXISTS "postlike_post_uri";
+CREATE INDEX "postlike_post_uri" ON "postlike" ("post_uri");
+DROP INDEX IF EXISTS "postlike_uri";
+CREATE UNIQUE INDEX "postlike_uri" ON "postlike" ("uri");
+COMMIT;
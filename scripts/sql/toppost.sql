@@ -0,0 +1,13 @@
+BEGIN TRANSACTION;
+DROP TABLE IF EXISTS "toppost";
+CREATE TABLE "toppost" (
+  "id" SERIAL PRIMARY KEY
+,  "feed" varchar(255) NOT NULL
+,  "rank" integer NOT NULL
+,  "uri" varchar(255) NOT NULL
+,  "score" real NOT NULL
+,  "computed_at" timestamp NOT NULL
+);
+DROP INDEX IF EXISTS "toppost_feed_rank";
+CREATE UNIQUE INDEX "toppost_feed_rank" ON "toppost" ("feed","rank");
+COMMIT;
@@ -35,4 +35,22 @@ SELECT setval(pg_get_serial_sequence('subscriptionstate', 'id')
             , false)
 FROM   subscriptionstate;
 
+
+SELECT setval(pg_get_serial_sequence('postlike', 'id')
+            , COALESCE(max(id) + 1, 1)
+            , false)
+FROM   postlike;
+
+
+SELECT setval(pg_get_serial_sequence('toppost', 'id')
+            , COALESCE(max(id) + 1, 1)
+            , false)
+FROM   toppost;
+
+
+SELECT setval(pg_get_serial_sequence('accountchange', 'id')
+            , COALESCE(max(id) + 1, 1)
+            , false)
+FROM   accountchange;
+
 COMMIT;
\ No newline at end of file
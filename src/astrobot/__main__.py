@@ -18,10 +18,14 @@ from .config import (
     PASSWORD,
 )
 from astrofeed_lib import logger
+from astrofeed_lib.config import METRICS_PORT
+from astrofeed_lib.metrics import serve_metrics_in_background
 
 
 def run_bot():
     logger.info("Starting the astrobot!")
+    if METRICS_PORT is not None:
+        serve_metrics_in_background(METRICS_PORT)
     i = 0
     while True:
         start_time = time.time()
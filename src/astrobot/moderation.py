@@ -1,6 +1,7 @@
 """Moderation-related actions."""
 
 from astrofeed_lib.accounts import CachedModeratorList, CachedBannedList
+from astrofeed_lib.account_changes import publish_account_change
 from astrobot.database import (
     new_mod_action,
     new_signup,
@@ -11,8 +12,8 @@ from astrofeed_lib import logger
 
 
 # Setup list of moderators
-MODERATORS = CachedModeratorList(query_interval=60)
-BANNED_USERS = CachedBannedList(query_interval=60)
+MODERATORS = CachedModeratorList(query_interval=600)
+BANNED_USERS = CachedBannedList(query_interval=600)
 
 
 def ban_user(did: str, did_mod: str, reason: str):
@@ -24,6 +25,7 @@ def ban_user(did: str, did_mod: str, reason: str):
             f"Banning account with DID {did} from the feeds. Mod: {did_mod}. Reason: {reason}."
         )
         new_mod_action(did_mod, did, "ban")
+        _publish_account_change(did)
     else:
         logger.info(f"Failed to ban accound with DID {did}. Mod: {did_mod}")
 
@@ -44,11 +46,24 @@ def signup_user(did: str, did_mod: str, handle: str = "undefined", valid: bool =
     logger.info(f"Signing up {handle} to the feeds. Mod: {did_mod}")
     new_mod_action(did_mod, did, "signup")
     new_signup(did, handle, valid=valid)
+    _publish_account_change(did)
 
 
 def cancel_signup(did: str, did_mod: str):
     logger.info(f"Cancelling signup for user {did}. Mod: {did_mod}")
     new_mod_action(did_mod, did, "signup_cancelled")
+    _publish_account_change(did)
+
+
+def _publish_account_change(did: str):
+    """Tells cached account lists about a change that has already been made. If that
+    fails, the change has still happened, and the lists pick it up on their next full
+    refresh anyway.
+    """
+    try:
+        publish_account_change(did)
+    except Exception:
+        logger.exception(f"Unable to publish a change to the account with DID {did}.")
 
 
 def hide_post(uri: str, did: str, did_mod: str):
@@ -1,22 +1,39 @@
 """Logic for how commits are filtered."""
 
 # import logging
-from astrofeed_lib.database import (
-    Post,
-    get_database,
-    setup_connection,
-    teardown_connection,
-)
+from astrofeed_lib.database import hash_uri
 from astrofeed_lib.accounts import CachedAccountQuery
 from astrofeed_lib.feeds import post_in_feeds
+from astrofeed_firehose.likes import LikeCounter
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_firehose.worker_stats import STATS
 from atproto import CAR, AtUri
 from atproto import models
-from astrofeed_lib import logger
 
 
 # This is our set of accounts that are signed up, including those that are muted/banned
-# (as those could be later reversed.) We keep it updated once every 60 seconds.
-VALID_ACCOUNTS = CachedAccountQuery(query_interval=60)
+# (as those could be later reversed.) When running under the FirehoseProcessingManager,
+# it's replaced with a set shared between all commit processors (see
+# use_shared_accounts.)
+VALID_ACCOUNTS = CachedAccountQuery(query_interval=600)
+
+# Likes of posts, which are written to the database in batches (see
+# LikeCounter.flush_if_due)
+LIKES = LikeCounter()
+
+# Posts to create, edit and delete, which are written to the database in batches (see
+# PostWriter.flush_if_due)
+POSTS = PostWriter()
+
+_TAG_FEATURE = f"{models.ids.AppBskyRichtextFacet}#tag"
+
+
+def use_shared_accounts(accounts) -> None:
+    """Replaces VALID_ACCOUNTS with another account list with a get_accounts() method,
+    such as an astrofeed_firehose.shared_accounts.SharedAccountSet.
+    """
+    global VALID_ACCOUNTS
+    VALID_ACCOUNTS = accounts
 
 
 def apply_commit(
@@ -24,60 +41,39 @@ def apply_commit(
 ):
     """Applies the operations in a commit based on which ones are necessary to process."""
     # Sort the initial commit into everything we're interested in
-    ops = _get_ops_by_type(commit)
-    posts_to_create, posts_to_delete = _get_required_ops(ops)
-    if not posts_to_create and not posts_to_delete:
-        return
-
-    # If we have posts to create, then we'll also need to classify them
-    posts_to_create_classified, feed_counts = _classify_posts(posts_to_create)
-
-    # Perform database operations
-    cursor = commit.seq
-    setup_connection(get_database())
-    _delete_posts(cursor, posts_to_delete)
-    _create_posts(cursor, posts_to_create_classified, feed_counts)
-    teardown_connection(get_database())
+    with STATS.timer("parse"):
+        ops = _get_ops_by_type(commit)
+    apply_ops(ops, commit.seq)
 
 
-def _create_posts(
-    cursor: int, posts_to_create_classified: list[dict], feed_counts: dict
-):
-    """Adds posts to the database."""
-    if not posts_to_create_classified:
-        return
+def apply_jetstream_event(event: dict):
+    """Applies the operation in a Jetstream event (see astrofeed_firehose.jetstream.)"""
+    with STATS.timer("parse"):
+        ops = _get_ops_from_jetstream_event(event)
+    apply_ops(ops, event["time_us"])
 
-    # Remove duplicate posts
-    # Todo: change to do this in one query (doesn't matter atm as this function is almost always called one post at a time, but eventually...)
-    initial_length = len(posts_to_create_classified)
-    posts_to_create_classified = [
-        post
-        for post in posts_to_create_classified
-        if not Post.select().where(Post.uri == post["uri"]).exists()
-    ]
-    if (current_length := len(posts_to_create_classified)) != initial_length:
-        logger.info(f"Ignored duplicate posts: {initial_length - current_length}")
 
-    if not posts_to_create_classified:
+def apply_ops(ops: dict, cursor: int):
+    """Applies operations sorted by _get_ops_by_type, based on which ones are necessary
+    to process.
+    """
+    LIKES.add_ops(ops)
+    posts_to_create, posts_to_delete, posts_to_update = _get_required_ops(ops)
+    if not posts_to_create and not posts_to_delete and not posts_to_update:
         return
 
-    # Add the posts
-    with get_database().atomic():
-        for post_dict in posts_to_create_classified:
-            Post.create(**post_dict)
-    feed_counts_string = ", ".join(
-        [f"{key[5:]}-{value}" for key, value in feed_counts.items() if value > 0]
+    # If we have posts to create or update, then we'll also need to classify them
+    with STATS.timer("classify"):
+        posts_to_create_classified, _ = _classify_posts(posts_to_create)
+        posts_to_update_classified, _ = _classify_posts(posts_to_update)
+
+    # Database operations wait to be written along with those of other commits
+    POSTS.add(
+        cursor,
+        created=posts_to_create_classified,
+        updated=posts_to_update_classified,
+        deleted=posts_to_delete,
     )
-    logger.info(f"Added posts: {feed_counts_string} (cursor={cursor})")
-
-
-def _delete_posts(cursor: int, posts_to_delete: list[str]):
-    """Removes posts from the database."""
-    if not posts_to_delete:
-        return
-
-    Post.delete().where(Post.uri.in_(posts_to_delete))  # type: ignore (pylance is wrong)
-    logger.info(f"Deleted posts: {len(posts_to_delete)} (cursor={cursor})")
 
 
 def _classify_posts(posts_to_create: list[dict]) -> tuple[list[dict], dict]:
@@ -94,10 +90,16 @@ def _classify_posts(posts_to_create: list[dict]) -> tuple[list[dict], dict]:
             "cid": created_post["cid"],
             "author": created_post["author"],
             "text": post_text,
+            **_get_reply_info(created_post["record"]),
         }
 
         # Add labels to the post for
-        feed_labels = post_in_feeds(post_text)
+        record = created_post["record"]
+        feed_labels = post_in_feeds(
+            post_text,
+            facet_tags=_get_facet_tags(record),
+            record_tags=record["tags"] or (),
+        )
         post_dict.update(feed_labels)
         posts_to_create_classified.append(post_dict)
 
@@ -112,30 +114,54 @@ def _classify_posts(posts_to_create: list[dict]) -> tuple[list[dict], dict]:
     return posts_to_create_classified, feed_counts
 
 
-def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> dict:  # noqa: C901
-    """Sorts all commits/operations by type into a convenient to process dictionary."""
-    operation_by_type = {
-        "posts": {"created": [], "deleted": []},
+def _get_facet_tags(record) -> list[str]:
+    """Gets the hashtags in the tag facets of a post."""
+    tags = []
+    for facet in record["facets"] or ():
+        for feature in facet["features"] or ():
+            # Records with anything that doesn't validate (like a new kind of facet)
+            # are DotDicts, which only have a $type
+            feature_type = getattr(feature, "py_type", None) or feature["$type"]
+            if feature_type == _TAG_FEATURE and isinstance(feature["tag"], str):
+                tags.append(feature["tag"])
+    return tags
+
+
+def _get_reply_info(record) -> dict:
+    """Gets whether or not a post is a reply, and a hash of the URI of the root of its
+    thread if so.
+    """
+    reply = record["reply"]
+    if reply is None:
+        return {"is_reply": False, "reply_root": None}
+    return {"is_reply": True, "reply_root": hash_uri(reply.root.uri)}
+
+
+def _new_ops() -> dict:
+    return {
+        "posts": {"created": [], "deleted": [], "updated": []},
         "reposts": {"created": [], "deleted": []},
         "likes": {"created": [], "deleted": []},
         "follows": {"created": [], "deleted": []},
     }
 
+
+def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> dict:  # noqa: C901
+    """Sorts all commits/operations by type into a convenient to process dictionary."""
+    operation_by_type = _new_ops()
+
     # Handle occasional empty commit (not in ATProto spec but seems to happen sometimes.
     # Can be a blank binary string sometimes, for no reason)
     if not commit.blocks:
         return operation_by_type
 
-    car = CAR.from_bytes(commit.blocks)  # type: ignore
+    with STATS.timer("car"):
+        car = CAR.from_bytes(commit.blocks)  # type: ignore
 
     for op in commit.ops:
         uri = AtUri.from_str(f"at://{commit.repo}/{op.path}")
 
-        if op.action == "update":
-            # not supported yet
-            continue
-
-        if op.action == "create" and car is not None:
+        if op.action in ("create", "update") and car is not None:
             if not op.cid:
                 continue
 
@@ -145,18 +171,31 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> dict
             if not record_raw_data:
                 continue
 
-            record = models.get_or_create(record_raw_data, strict=False)
+            with STATS.timer("records"):
+                record = models.get_or_create(record_raw_data, strict=False)
             if uri.collection == models.ids.AppBskyFeedPost and models.is_record_type(
                 record,  # type: ignore
                 models.ids.AppBskyFeedPost,
             ):
-                operation_by_type["posts"]["created"].append(
+                # Edited posts are "update" ops
+                action = "created" if op.action == "create" else "updated"
+                operation_by_type["posts"][action].append(
+                    {"record": record, **create_info}
+                )
+
+            # Only edits of posts matter to us
+            elif op.action == "update":
+                continue
+
+            elif uri.collection == models.ids.AppBskyFeedLike and models.is_record_type(
+                record,  # type: ignore
+                models.ids.AppBskyFeedLike,
+            ):
+                operation_by_type["likes"]["created"].append(
                     {"record": record, **create_info}
                 )
 
             # The following types of event don't need to be tracked by the feed right now, and are removed.
-            # elif uri.collection == ids.AppBskyFeedLike and is_record_type(record, ids.AppBskyFeedLike):
-            #     operation_by_type['likes']['created'].append({'record': record, **create_info})
             # elif uri.collection == ids.AppBskyFeedRepost and is_record_type(record, ids.AppBskyFeedRepost):
             #     operation_by_type['reposts']['created'].append({'record': record, **create_info})
             # elif uri.collection == ids.AppBskyGraphFollow and is_record_type(record, ids.AppBskyGraphFollow):
@@ -168,9 +207,10 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> dict
                     {"uri": str(uri), "author": commit.repo}
                 )
 
+            elif uri.collection == models.ids.AppBskyFeedLike:
+                operation_by_type["likes"]["deleted"].append({"uri": str(uri)})
+
             # The following types of event don't need to be tracked by the feed right now.
-            # elif uri.collection == ids.AppBskyFeedLike:
-            #     operation_by_type['likes']['deleted'].append({'uri': str(uri)})
             # elif uri.collection == ids.AppBskyFeedRepost:
             #     operation_by_type['reposts']['deleted'].append({'uri': str(uri)})
             # elif uri.collection == ids.AppBskyGraphFollow:
@@ -179,7 +219,48 @@ def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> dict
     return operation_by_type
 
 
-def _get_required_ops(ops: dict) -> tuple[list[dict], list[str]]:
+def _get_ops_from_jetstream_event(event: dict) -> dict:
+    """Sorts the operation in a Jetstream event in the same way as _get_ops_by_type.
+    Jetstream sends records as JSON, so there's no CAR file to decode.
+    """
+    operation_by_type = _new_ops()
+    commit = event.get("commit")
+    if event.get("kind") != "commit" or not commit:
+        return operation_by_type
+
+    collection, author = commit["collection"], event["did"]
+    uri = f"at://{author}/{collection}/{commit['rkey']}"
+
+    if commit["operation"] in ("create", "update") and commit.get("record"):
+        with STATS.timer("records"):
+            record = models.get_or_create(commit["record"], strict=False)
+        create_info = {"uri": uri, "cid": commit["cid"], "author": author}
+        if collection == models.ids.AppBskyFeedPost and models.is_record_type(
+            record,  # type: ignore
+            models.ids.AppBskyFeedPost,
+        ):
+            action = "created" if commit["operation"] == "create" else "updated"
+            operation_by_type["posts"][action].append({"record": record, **create_info})
+        elif commit["operation"] == "update":
+            pass  # Only edits of posts matter to us
+        elif collection == models.ids.AppBskyFeedLike and models.is_record_type(
+            record,  # type: ignore
+            models.ids.AppBskyFeedLike,
+        ):
+            operation_by_type["likes"]["created"].append(
+                {"record": record, **create_info}
+            )
+
+    elif commit["operation"] == "delete":
+        if collection == models.ids.AppBskyFeedPost:
+            operation_by_type["posts"]["deleted"].append({"uri": uri, "author": author})
+        elif collection == models.ids.AppBskyFeedLike:
+            operation_by_type["likes"]["deleted"].append({"uri": uri})
+
+    return operation_by_type
+
+
+def _get_required_ops(ops: dict) -> tuple[list[dict], list[str], list[dict]]:
     """Fetches the required operations from a _get_ops_by_type dict."""
     good_accounts = VALID_ACCOUNTS.get_accounts()
 
@@ -195,5 +276,8 @@ def _get_required_ops(ops: dict) -> tuple[list[dict], list[str]]:
         for post in ops["posts"]["deleted"]
         if post["author"] in good_accounts
     ]
+    posts_to_update = [
+        post for post in ops["posts"]["updated"] if post["author"] in good_accounts
+    ]
 
-    return posts_to_create, posts_to_delete
+    return posts_to_create, posts_to_delete, posts_to_update
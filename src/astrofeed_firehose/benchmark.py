@@ -0,0 +1,289 @@
+"""Throughput benchmarks for the firehose, using synthetic commits (see
+astrofeed_firehose.synthetic) and a throwaway SQLite database.
+
+Each stage of commit processing is timed separately, from classifying post text up to
+running the whole multiprocess FirehoseProcessingManager on a replayed capture. Results
+(ops/sec, median and p99 latency per op, and peak memory usage) are printed and saved
+as JSON, so that runs before and after a change can be compared.
+
+It also measures how long each service's modules take to import (with Python's
+`-X importtime`), which is most of the time that it takes to start a process.
+
+Usage: python -m astrofeed_firehose.benchmark [--commits N] [--output FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import peewee
+from atproto import parse_subscribe_repos_message
+
+from astrofeed_firehose import apply_commit
+from astrofeed_firehose.apply_commit import _get_ops_by_type
+from astrofeed_firehose.capture import CaptureWriter
+from astrofeed_firehose.commit_processor import _process_commit
+from astrofeed_firehose.synthetic import SyntheticFirehose
+from astrofeed_lib import database
+from astrofeed_lib.database import (
+    Account,
+    AccountChange,
+    DBConnection,
+    Post,
+    PostLike,
+    SubscriptionState,
+    TopPost,
+)
+from astrofeed_lib.feeds import post_in_feeds
+
+_MODELS = [Post, SubscriptionState, Account, AccountChange, PostLike, TopPost]
+
+# Modules that each service (or a firehose worker) imports to start, whose import times
+# are measured
+IMPORT_TIME_MODULES = {
+    "astrofeed_lib": "astrofeed_lib.database",
+    "astrofeed_firehose": "astrofeed_firehose.commit_processor",
+    "astrofeed_server": "astrofeed_server.app",
+}
+
+
+def _peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """Peak resident memory so far, in MB. (This only ever goes up, so for stages after
+    the first it's the peak of every stage so far.)
+    """
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def time_each(function: Callable, items: Iterable) -> dict[str, Any]:
+    """Calls function on each item, returning its throughput and latency."""
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        item_start = time.perf_counter_ns()
+        function(item)
+        latencies.append(time.perf_counter_ns() - item_start)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "ops_per_second": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) / 1e6,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] / 1e6,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _process_commit_and_write_posts(raw_commit: bytes) -> None:
+    """Processes a commit like a commit processor does, including writing its posts
+    to the database whenever they're due to be (see PostWriter.flush_if_due.)
+    """
+    _process_commit(raw_commit)
+    apply_commit.POSTS.flush_if_due()
+
+
+def measure_import_time(module: str) -> dict[str, Any]:
+    """Imports module in a fresh interpreter with `-X importtime`, returning the total
+    import time in ms, and the time spent in each top-level package (e.g. atproto),
+    slowest first.
+    """
+    # Some modules start threads when imported (like astrofeed_server.app), so the
+    # interpreter exits without waiting for them
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import {module}; import os; os._exit(0)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        # Find modules in the same places as this interpreter
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | imported package", with
+    # nested imports indented
+    packages: dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(self_us) / 1e3
+
+    return {
+        "total_ms": sum(packages.values()),
+        "packages_ms": dict(sorted(packages.items(), key=lambda item: -item[1])),
+    }
+
+
+def _setup_database(path: Path, firehose: SyntheticFirehose) -> peewee.Database:
+    """Points astrofeed_lib at a fresh SQLite database with every signed up account."""
+    db = peewee.SqliteDatabase(
+        path, autoconnect=False, timeout=30, pragmas={"journal_mode": "wal"}
+    )
+    database.get_database().initialize(db)
+    with DBConnection(), db.atomic():
+        db.create_tables(_MODELS)
+        Account.insert_many(
+            [
+                dict(handle=f"account{i}", did=firehose.signed_up_did(i), is_valid=True)
+                for i in range(firehose.signed_up_accounts)
+            ]
+        ).execute()
+    return db
+
+
+def _benchmark_manager(raw_commits: list[bytes], capture_path: Path) -> dict:
+    from astrofeed_firehose.replay import replay
+
+    with CaptureWriter(str(capture_path)) as writer:
+        for raw_commit in raw_commits:
+            writer.write_raw(raw_commit)
+
+    # The workers need to use the benchmark's database, which only forked processes
+    # inherit
+    commits_per_second = replay(str(capture_path), worker_start_method="fork")
+
+    # Make sure that every child has been waited on, so that it counts towards
+    # RUSAGE_CHILDREN
+    for process in multiprocessing.active_children():
+        process.join(timeout=5)
+
+    return {
+        "ops": len(raw_commits),
+        "ops_per_second": commits_per_second,
+        "p50_ms": None,
+        "p99_ms": None,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_benchmarks(
+    commits: int = 20000,
+    directory: str | None = None,
+    include_manager: bool = True,
+    include_imports: bool = True,
+    **synthetic_firehose_kwargs,
+) -> dict[str, Any]:
+    """Runs every benchmark on the given number of synthetic commits, in a temporary
+    SQLite database in directory, and measures the import time of each service (see
+    IMPORT_TIME_MODULES) if include_imports is True. synthetic_firehose_kwargs are
+    passed on to SyntheticFirehose to control the mix of commits.
+    """
+    database_previous = database.get_database().obj
+    firehose = SyntheticFirehose(**synthetic_firehose_kwargs)
+    results: dict[str, Any] = {
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "commits": commits,
+        "synthetic_firehose": synthetic_firehose_kwargs,
+        "stages": {},
+        "imports": {},
+    }
+    stages = results["stages"]
+
+    if include_imports:
+        for service, module in IMPORT_TIME_MODULES.items():
+            results["imports"][service] = measure_import_time(module)
+
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory:
+        try:
+            _setup_database(Path(temporary_directory) / "benchmark.db", firehose)
+
+            raw_commits = firehose.raw_commits(commits)
+            parsed_commits = [
+                parse_subscribe_repos_message(frame)
+                for frame in firehose.commits(commits)
+            ]
+            texts = [firehose.post_text() for _ in range(commits)]
+
+            stages["post_in_feeds"] = time_each(post_in_feeds, texts)
+            stages["get_ops_by_type"] = time_each(_get_ops_by_type, parsed_commits)
+            with DBConnection():
+                stages["process_commit"] = time_each(
+                    _process_commit_and_write_posts, raw_commits
+                )
+                apply_commit.POSTS.flush()
+
+            if include_manager:
+                stages["manager"] = _benchmark_manager(
+                    firehose.raw_commits(commits),
+                    Path(temporary_directory) / "capture.bin",
+                )
+
+            with DBConnection():
+                results["posts_added"] = Post.select().count()
+        finally:
+            database.get_database().initialize(database_previous)
+
+    return results
+
+
+def _print_results(results: dict[str, Any]) -> None:
+    print(f"\nFirehose benchmark, {results['commits']} synthetic commits per stage:")
+    for stage, result in results["stages"].items():
+        latency = ""
+        if result["p99_ms"] is not None:
+            latency = (
+                f"p50 {result['p50_ms']:.3f} ms | p99 {result['p99_ms']:.3f} ms | "
+            )
+        print(
+            f"  {stage:<16} {result['ops_per_second']:>10.0f} ops/sec | {latency}"
+            f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+
+    if results["imports"]:
+        print("\nImport times (slowest packages):")
+    for service, result in results["imports"].items():
+        slowest = ", ".join(
+            f"{package} {ms:.0f} ms"
+            for package, ms in list(result["packages_ms"].items())[:3]
+        )
+        print(f"  {service:<18} {result['total_ms']:>7.0f} ms | {slowest}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--commits", type=int, default=20000)
+    parser.add_argument(
+        "--signed-up-ratio",
+        type=float,
+        default=0.01,
+        help="fraction of commits made by signed up accounts",
+    )
+    parser.add_argument("--no-manager", action="store_true")
+    parser.add_argument("--no-imports", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        default=f"firehose_benchmark_{datetime.now():%Y%m%d_%H%M%S}.json",
+        help="file to save the results to",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.commits,
+        include_manager=not args.no_manager,
+        include_imports=not args.no_imports,
+        signed_up_ratio=args.signed_up_ratio,
+        seed=args.seed,
+    )
+    _print_results(results)
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"Saved results to {args.output}")
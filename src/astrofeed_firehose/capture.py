@@ -0,0 +1,154 @@
+"""Recording firehose frames to a capture file, and reading them back.
+
+A capture file is CAPTURE_MAGIC followed by one record per frame: the frame's length
+as a 4-byte big-endian integer, then the raw frame, exactly as it was sent by the relay
+(a DAG-CBOR header and body.) Captures can be replayed through the commit processors
+with `python -m astrofeed_firehose.replay`.
+"""
+
+import mmap
+import os
+import struct
+from collections import deque
+from threading import Condition, Thread
+from typing import BinaryIO, Iterator
+
+import libipld
+from atproto import firehose_models
+
+from astrofeed_lib import logger
+
+CAPTURE_MAGIC = b"AFCAPT01"
+
+_LENGTH_FORMAT = struct.Struct(">I")
+
+
+def encode_frame(frame: firehose_models.MessageFrame) -> bytes:
+    """Turns a frame back into the bytes it was decoded from. (The client doesn't give
+    us the raw frame, but DAG-CBOR has only one encoding of any value, so re-encoding
+    it gives the same bytes.)
+    """
+    header = {"op": frame.header.op, "t": frame.header.t}
+    return libipld.encode_dag_cbor(header) + libipld.encode_dag_cbor(frame.body)
+
+
+class CaptureWriter:
+    def __init__(self, path: str):
+        """Appends frames to the capture file at path, creating it if necessary."""
+        self.path = path
+        self.file: BinaryIO = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+        self.frames_written = 0
+
+    def write(self, frame: firehose_models.MessageFrame) -> None:
+        self.write_raw(encode_frame(frame))
+
+    def write_raw(self, raw_frame: bytes) -> None:
+        self.file.write(_LENGTH_FORMAT.pack(len(raw_frame)))
+        self.file.write(raw_frame)
+        self.frames_written += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class BackgroundCaptureWriter:
+    def __init__(self, path: str):
+        """Appends frames to the capture file at path from a background thread, so that
+        encoding and writing them doesn't hold up the firehose client's event loop.
+        Frames that haven't been written yet wait in memory, and are all written when
+        the writer is closed. If writing fails, the error is logged and later frames
+        aren't recorded, rather than stopping the client.
+        """
+        self.path = path
+        self.writer = CaptureWriter(path)
+        self.buffer: deque[firehose_models.MessageFrame] = deque()
+        self.closing = False
+        self.failed = False
+        self.condition = Condition()
+        self.thread = Thread(target=self._run, name="Capture writer", daemon=True)
+        self.thread.start()
+
+    def write(self, frame: firehose_models.MessageFrame) -> None:
+        with self.condition:
+            if self.closing:
+                raise RuntimeError("Capture writer is closed.")
+            if self.failed:
+                return
+            self.buffer.append(frame)
+            self.condition.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.buffer and not self.closing:
+                        self.condition.wait()
+                    if not self.buffer:
+                        return
+                    frames, self.buffer = self.buffer, deque()
+                for frame in frames:
+                    self.writer.write(frame)
+        except Exception:
+            logger.exception(f"Unable to record frames to {self.path}; stopping.")
+            with self.condition:
+                self.failed = True
+                self.buffer.clear()
+        finally:
+            self.writer.close()
+
+    def close(self) -> None:
+        """Writes every frame that's waiting, and closes the capture file."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    @property
+    def frames_written(self) -> int:
+        return self.writer.frames_written
+
+    def __enter__(self) -> "BackgroundCaptureWriter":
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def read_capture(path: str) -> Iterator[memoryview]:
+    """Yields every raw frame in a capture file. The file is memory-mapped, so frames
+    are views into it rather than copies, and are only valid until the next one is
+    read.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size <= len(CAPTURE_MAGIC):
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            if capture[: len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+                raise ValueError(f"{path} is not a firehose capture file.")
+
+            data = memoryview(capture)
+            try:
+                position, end = len(CAPTURE_MAGIC), len(data)
+                while position + _LENGTH_FORMAT.size <= end:
+                    (length,) = _LENGTH_FORMAT.unpack_from(data, position)
+                    position += _LENGTH_FORMAT.size
+                    # A capture that was still being written may end with a partial
+                    # frame, which we ignore
+                    if position + length > end:
+                        break
+                    frame = data[position : position + length]
+                    try:
+                        yield frame
+                    finally:
+                        frame.release()
+                    position += length
+            finally:
+                data.release()
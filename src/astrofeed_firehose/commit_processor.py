@@ -2,76 +2,148 @@
 added to the feeds.
 """
 
+import json
 import time
 import traceback
 from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Event
 from astrofeed_lib.config import SERVICE_DID
 from astrofeed_firehose.config import (
     EMPTY_QUEUE_SLEEP_TIME,
+    EMPTY_QUEUE_TIMEOUT,
     COMMITS_TO_FETCH_AT_ONCE,
     FIREHOSE_CURSOR_UPDATE,
     DATABASE_CURSOR_UPDATE,
+    JETSTREAM_CURSOR_SAVE_INTERVAL,
+    SOURCE,
 )
-from astrofeed_firehose.apply_commit import apply_commit
-from astrofeed_lib.database import (
-    SubscriptionState,
-    get_database,
-    setup_connection,
-    teardown_connection,
+from astrofeed_firehose.apply_commit import (
+    LIKES,
+    POSTS,
+    apply_commit,
+    apply_jetstream_event,
+    use_shared_accounts,
 )
+from astrofeed_firehose.jetstream import JETSTREAM_CURSOR_SERVICE
+from astrofeed_firehose.shared_accounts import SharedAccountSet
+from astrofeed_firehose.worker_stats import STATS, SharedWorkerStats
+from astrofeed_lib.database import SubscriptionState, DBConnection
 from faster_fifo import Queue
 from queue import Empty
 from atproto import parse_subscribe_repos_message
 from atproto import models
+from atproto import firehose_models
 from atproto.exceptions import ModelError
 from astrofeed_lib import logger
 
+# Row of SubscriptionState that the cursor is saved to
+CURSOR_SERVICE = JETSTREAM_CURSOR_SERVICE if SOURCE == "jetstream" else SERVICE_DID
+
+# When this worker next saves the Jetstream cursor to the database (see _update_cursor)
+_next_jetstream_cursor_save = 0.0
+
 
 def run_commit_processor(
     queue: Queue,
     cursor: Synchronized,  # Return value of multiprocessing.Value
     process_time: Synchronized,  # Return value of multiprocessing.Value
     op_counter: Synchronized | None = None,
+    shared_accounts: SharedAccountSet | None = None,
+    should_stop: Event | None = None,
+    stats: SharedWorkerStats | None = None,
+    processed_seq: Synchronized | None = None,
 ) -> None:
     """Main commit processing method. This method takes commits from a faster_fifo Queue
     object and sees if they need to be added to the feeds or not.
+
+    The manager can ask the worker to stop (after finishing its current batch of
+    commits) by setting should_stop. After each batch, the worker adds what it's been
+    doing (including the time it spent processing commits) to stats, and the sequence
+    number of the last commit it processed to processed_seq, so that the manager can
+    tell how busy the workers are.
+
+    Posts are written to the database in batches that can span many reads from the
+    queue (see astrofeed_firehose.post_writer), so the worker waits on the queue for at
+    most as long as the posts it has can wait.
     """
     logger.info("... commit processing worker started")
+    if shared_accounts is not None:
+        use_shared_accounts(shared_accounts)
     error_count = 0
 
-    while True:
-        messages = _get_messages_from_queue(queue)
+    while should_stop is None or not should_stop.is_set():
+        messages = _get_messages_from_queue(queue, process_time, should_stop)
+        start_time = time.perf_counter()
 
+        # Every commit in this batch shares one database connection (if it needs one),
+        # rather than checking one out of the pool for each individual commit
         # Todo update downstream functions to handle many at once, instead of having this for loop
-        for message in messages:
-            error_count = _process_commit_with_exception_wrapper(
-                message, cursor, error_count
-            )
-            _update_process_time(process_time)
-            _increment_op_count(op_counter)
+        with DBConnection():
+            for message in messages:
+                error_count = _process_commit_with_exception_wrapper(
+                    message, cursor, error_count, processed_seq
+                )
+                _update_process_time(process_time)
+                _increment_op_count(op_counter)
+            POSTS.flush_if_due()
+            with STATS.timer("database"):
+                LIKES.flush_if_due()
 
+        STATS.add("commits", len(messages))
+        STATS.add("busy_time", time.perf_counter() - start_time)
+        if stats is not None:
+            STATS.flush(stats)
 
-def _get_messages_from_queue(queue: Queue):
-    """Continually waits on the queue and tries to get messages from it."""
+    # Don't lose any posts or likes that haven't been written yet
+    POSTS.flush()
+    LIKES.flush()
+    logger.info("... commit processing worker stopped")
+
+
+def _get_messages_from_queue(
+    queue: Queue,
+    process_time: Synchronized | None = None,
+    should_stop: Event | None = None,
+) -> list:
+    """Continually waits on the queue and tries to get messages from it. Returns no
+    messages if the worker is asked to stop while waiting, or if posts waiting to be
+    written are due before any commits arrive.
+    """
     while True:
+        time_until_due = POSTS.time_until_due()
+        timeout = EMPTY_QUEUE_TIMEOUT
+        if time_until_due is not None:
+            timeout = min(timeout, time_until_due)
         try:
             messages = queue.get_many(
-                timeout=300, max_messages_to_get=COMMITS_TO_FETCH_AT_ONCE
+                timeout=timeout,
+                max_messages_to_get=COMMITS_TO_FETCH_AT_ONCE,
             )
             break
         except Empty:
+            # Waiting for commits isn't the same as being hung
+            if process_time is not None:
+                _update_process_time(process_time)
+            if should_stop is not None and should_stop.is_set():
+                return []
+            if time_until_due is not None:
+                return []
             time.sleep(EMPTY_QUEUE_SLEEP_TIME)
             continue
     return messages
 
 
 def _process_commit_with_exception_wrapper(
-    message, cursor: Synchronized, error_count: int
+    message,
+    cursor: Synchronized,
+    error_count: int,
+    processed_seq: Synchronized | None = None,
 ) -> int:
     """Attempt to process a single commit. This is a total exception wrapper that tries
     to catch any other random issues that could occur (out of spec commits can cause
     problems, for instance.)
     """
+    trace = STATS.start_trace()
     try:
         cursor_value = _process_commit(message)
     except Exception:
@@ -83,19 +155,34 @@ def _process_commit_with_exception_wrapper(
         error_count += 1
         logger.info(f"Error count: {error_count}")
     else:
+        if processed_seq is not None and cursor_value is not None:
+            processed_seq.value = cursor_value
         _update_cursor(cursor, cursor_value)
+        if trace is not None:
+            STATS.finish_trace(trace, cursor_value)
 
     return error_count
 
 
 def _process_commit(message) -> int | None:
     """Attempt to process a single commit. Returns cursor value if successful."""
-    # Skip any commits that do not pass this model (which can occur sometimes)
-    try:
-        commit = parse_subscribe_repos_message(message)
-    except ModelError:
-        logger.info("Unable to process a commit due to validation issue")
-        return None
+    # Jetstream events are JSON (see astrofeed_firehose.jetstream)
+    if isinstance(message, str):
+        return _process_jetstream_event(message)
+
+    with STATS.timer("parse"):
+        # Frames replayed from a capture file are sent to us still encoded
+        if isinstance(message, bytes):
+            message = firehose_models.Frame.from_bytes(message)
+            if not isinstance(message, firehose_models.MessageFrame):
+                return None
+
+        # Skip any commits that do not pass this model (which can occur sometimes)
+        try:
+            commit = parse_subscribe_repos_message(message)
+        except ModelError:
+            logger.info("Unable to process a commit due to validation issue")
+            return None
 
     # Final check that this is in fact a commit, and not e.g. a handle change
     if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
@@ -103,29 +190,66 @@ def _process_commit(message) -> int | None:
 
     # Apply commit to our database, looking for posts to add etc
     apply_commit(commit)
+    STATS.set_commit_time(commit.time)
 
     # We return the current cursor value to the commit processor
     return commit.seq
 
 
+def _process_jetstream_event(message: str) -> int | None:
+    """Attempt to process a single Jetstream event. Returns its time as the cursor value
+    if successful.
+    """
+    with STATS.timer("parse"):
+        event = json.loads(message)
+    apply_jetstream_event(event)
+    STATS.set_latest("latest_commit_time", event["time_us"] / 1e6)
+    return event["time_us"]
+
+
 def _update_cursor(cursor: Synchronized, value: int | None):
     """Updates the cursor in both the database & for what the firehose client holds."""
     if value is None:
         return
 
-    # Update stored state every FIREHOSE_CURSOR_UPDATE events
-    if value % FIREHOSE_CURSOR_UPDATE != 0:
+    # Relay cursors are sequence numbers, so we update stored state every
+    # FIREHOSE_CURSOR_UPDATE commits, and the database every DATABASE_CURSOR_UPDATE.
+    # Jetstream cursors are times in microseconds, and there are only a few events a
+    # minute, so we update stored state on every event and the database every
+    # JETSTREAM_CURSOR_SAVE_INTERVAL seconds instead.
+    if SOURCE == "jetstream":
+        update_database = _jetstream_cursor_save_is_due()
+    elif value % FIREHOSE_CURSOR_UPDATE != 0:
         return
+    else:
+        update_database = value % DATABASE_CURSOR_UPDATE == 0
     cursor.value = value
+    if not update_database:
+        return
 
-    # We also update the stored database state every DATABASE_CURSOR_UPDATE events
-    if value % DATABASE_CURSOR_UPDATE != 0:
+    # This worker's posts from before the cursor are written first, so that a restart
+    # doesn't skip them. (Other workers may still have older posts waiting.) If they
+    # can't be written, the cursor isn't saved this time, but that isn't worth stopping
+    # the commit processor over.
+    try:
+        POSTS.flush()
+        with STATS.timer("database"), DBConnection():
+            SubscriptionState.update(cursor=value).where(
+                SubscriptionState.service == CURSOR_SERVICE
+            ).execute()
+    except Exception:
+        logger.exception("Unable to save the cursor to the database.")
         return
-    setup_connection(get_database())
-    SubscriptionState.update(cursor=value).where(
-        SubscriptionState.service == SERVICE_DID
-    ).execute()
-    teardown_connection(get_database())
+    STATS.set_latest("saved_cursor", value)
+
+
+def _jetstream_cursor_save_is_due() -> bool:
+    global _next_jetstream_cursor_save
+    now = time.monotonic()
+    if now < _next_jetstream_cursor_save:
+        return False
+    _next_jetstream_cursor_save = now + JETSTREAM_CURSOR_SAVE_INTERVAL
+    return True
 
 
 def _update_process_time(time_object: Synchronized):
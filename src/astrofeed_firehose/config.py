@@ -1,4 +1,5 @@
 import os
+import tempfile
 from typing import Final
 # from astrofeed_lib import logger
 
@@ -11,6 +12,16 @@ BASE_URI: Final[str] = os.getenv(
     "FIREHOSE_BASE_URI", "wss://bsky.network/xrpc"
 )  # Which relay to fetch commits from
 
+# Where to read commits from: "relay" for the full firehose from BASE_URI, or
+# "jetstream" for a Jetstream server at JETSTREAM_URI, which only sends us the posts of
+# signed up accounts (as JSON)
+SOURCE: Final[str] = os.getenv("FIREHOSE_SOURCE", "relay")
+if SOURCE not in ("relay", "jetstream"):
+    raise ValueError(f"FIREHOSE_SOURCE must be 'relay' or 'jetstream', not '{SOURCE}'.")
+JETSTREAM_URI: Final[str] = os.getenv(
+    "FIREHOSE_JETSTREAM_URI", "wss://jetstream2.us-east.bsky.network/subscribe"
+)
+
 # Fetch cursor override
 _cursor_override = os.getenv("FIREHOSE_CURSOR_OVERRIDE", None)
 if _cursor_override is not None:
@@ -26,6 +37,58 @@ if _cpu_count < 1:
     _cpu_count = 1
 CPU_COUNT: Final[int] = _cpu_count
 
+# Bounds on the number of workers when autoscaling. The manager starts with CPU_COUNT
+# workers, and then adds or removes them depending on how busy they are.
+MIN_WORKER_COUNT: Final[int] = max(1, int(os.getenv("FIREHOSE_MIN_WORKER_COUNT", 1)))
+MAX_WORKER_COUNT: Final[int] = max(
+    MIN_WORKER_COUNT, int(os.getenv("FIREHOSE_MAX_WORKER_COUNT", CPU_COUNT))
+)
+
+# How commit processors are started: "forkserver" starts them from a template process
+# that has already imported everything they need, which makes restarting and adding
+# workers fast (see WORKER_PRELOAD_MODULES), while "fork" forks them from the manager.
+WORKER_START_METHOD: Final[str] = os.getenv(
+    "FIREHOSE_WORKER_START_METHOD", "forkserver"
+)
+if WORKER_START_METHOD not in ("fork", "forkserver"):
+    raise ValueError(
+        "FIREHOSE_WORKER_START_METHOD must be 'fork' or 'forkserver', not "
+        f"'{WORKER_START_METHOD}'."
+    )
+
+# Optional file to record every frame received from the firehose to, for replaying later
+# with `python -m astrofeed_firehose.replay`
+CAPTURE_PATH: Final[str | None] = os.getenv("FIREHOSE_CAPTURE_PATH", None)
+
+# Port that the manager serves throughput & lag metrics for the whole firehose on, at
+# http://127.0.0.1:PORT/metrics (see astrofeed_firehose.metrics.) Unset = not served.
+_manager_metrics_port = os.getenv("FIREHOSE_MANAGER_METRICS_PORT", None)
+if _manager_metrics_port is not None:
+    _manager_metrics_port = int(_manager_metrics_port)
+MANAGER_METRICS_PORT: Final[int | None] = _manager_metrics_port
+
+# Directory to write cProfile snapshots of the commit processors to. If set, every
+# commit processor runs under cProfile, and sending SIGUSR1 to the manager has each of
+# them write a snapshot, which the manager then combines (see
+# astrofeed_firehose.profiling.) Unset = not profiled.
+PROFILE_DIRECTORY: Final[str | None] = os.getenv("FIREHOSE_PROFILE_DIRECTORY", None)
+
+# Directory that the firehose client writes commits to when the commit processors can't
+# keep up and its in-memory buffer is full (see astrofeed_firehose.queue_writer.) Set it
+# to an empty string to have the client wait for space instead, which eventually gets it
+# disconnected by the relay.
+OVERFLOW_DIRECTORY: Final[str | None] = (
+    os.getenv("FIREHOSE_OVERFLOW_DIRECTORY", tempfile.gettempdir()) or None
+)
+
+# Longest time (in milliseconds) that commit processors hold on to new, edited and
+# deleted posts before writing them to the database, so that they can write many at
+# once (see astrofeed_firehose.post_writer.) Lower keeps the feeds fresher, while higher
+# means fewer, larger writes.
+POST_LATENCY_TARGET: Final[float] = (
+    float(os.getenv("FIREHOSE_POST_LATENCY_TARGET_MS", 1000)) / 1000
+)
+
 
 # ------------------------
 # SPECIFIC SETTINGS
@@ -34,9 +97,83 @@ CPU_COUNT: Final[int] = _cpu_count
 # ------------------------
 
 # OVERALL MANAGER -----------------------
-# How often the watchdog should check that all processes are running (in seconds)
+# Modules that the template process for commit processors imports before starting any
+# (when WORKER_START_METHOD is forkserver), so that new workers start with them already
+# imported. This includes atproto's models, which take seconds to import, and the
+# compiled feed classifier.
+WORKER_PRELOAD_MODULES = [
+    "astrofeed_firehose.manager",
+    "astrofeed_firehose.commit_processor",
+    "astrofeed_firehose.profiling",
+]
+
+# Processes that haven't reported any activity for this long (in seconds) are
+# considered hung. Ops/sec are also logged this often.
 MANAGER_CHECK_INTERVAL = 60
 
+# How often the watchdog checks on processes and decides whether to add or remove
+# workers (in seconds)
+MANAGER_MONITOR_INTERVAL = 10
+
+# Dead or hung processes are restarted individually, unless one has had to be restarted
+# more than MANAGER_MAX_RESTARTS times in the last MANAGER_RESTART_WINDOW seconds, in
+# which case something is more seriously wrong and the whole service stops.
+MANAGER_MAX_RESTARTS = 5
+MANAGER_RESTART_WINDOW = 3600
+
+# How long the manager waits for commit processors to write their profiles after
+# SIGUSR1 before combining them (in seconds.) Workers only handle the signal between
+# reads from the queue, so this is longer than EMPTY_QUEUE_TIMEOUT.
+PROFILE_COMBINE_DELAY = 15
+
+# AUTOSCALING ---------------------------
+# A worker is added when commits back up in the queue, when we fall this many commits
+# behind the latest commit from the firehose, or when the workers are busy for this
+# fraction of the time; and removed when all three are comfortably low.
+SCALE_UP_QUEUE_SIZE = 2000
+SCALE_UP_LAG = 5000
+SCALE_UP_UTILIZATION = 0.85
+SCALE_DOWN_QUEUE_SIZE = 200
+SCALE_DOWN_LAG = 500
+SCALE_DOWN_UTILIZATION = 0.4
+
+# Minimum time between adding or removing workers (in seconds), to give the last
+# change time to take effect
+SCALING_COOLDOWN = 60
+
+# SHARED ACCOUNT SET --------------------
+# Directory for the file that the set of valid accounts is shared between processes in.
+# /dev/shm keeps it in memory on Linux.
+SHARED_MEMORY_DIRECTORY = (
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+
+# How often the account publisher checks for changed accounts (in seconds.) Changes
+# pushed by the bot are picked up on the next check; see astrofeed_lib.account_changes.
+ACCOUNT_PUBLISH_INTERVAL = 1.0
+
+# POSTS ---------------------------------
+# Number of posts to create, edit or delete that each commit processor writes to the
+# database at once, if it has that many before POST_LATENCY_TARGET is reached
+POST_BATCH_SIZE = 500
+
+# LIKES & TOP FEEDS ---------------------
+# How often each commit processor writes the likes it has seen to the database
+LIKE_FLUSH_INTERVAL = 10
+
+# Likes are only counted for posts made in this many days. After this, a like is also
+# forgotten, and unliking it no longer lowers its post's like count.
+LIKE_TRACKING_DAYS = 7
+
+# How often each commit processor fetches the likes counted by other processes, so that
+# it can recognise unlikes of them (in seconds.) Every LIKE_TRACKING_RELOAD_INTERVAL
+# seconds, the list is instead reloaded in full to drop old and deleted rows.
+LIKE_TRACKING_REFRESH_INTERVAL = 60
+LIKE_TRACKING_RELOAD_INTERVAL = 3600
+
+# How often the top feeds are recomputed (in seconds)
+TOP_FEED_REFRESH_INTERVAL = 300
+
 # QUEUE PRIMITIVE -----------------------
 # Buffer size of the internal process queue (I think it's in bytes?)
 # N.B.: one commit is about ~1-2 KB
@@ -46,6 +183,10 @@ QUEUE_BUFFER_SIZE = 1024**2 * 8
 # Number of commits the firehose client should try to send at once.
 COMMITS_TO_ADD_AT_ONCE = 100
 
+# Number of commits the firehose client keeps in memory when the queue is full, before
+# writing them to OVERFLOW_DIRECTORY instead
+CLIENT_BUFFER_SIZE = 50000
+
 # Maximum number of commits each processing worker should try to get at once.
 COMMITS_TO_FETCH_AT_ONCE = 100
 
@@ -53,6 +194,32 @@ COMMITS_TO_FETCH_AT_ONCE = 100
 FULL_QUEUE_SLEEP_TIME = 0.1
 EMPTY_QUEUE_SLEEP_TIME = 0.01
 
+# How long workers wait for commits before checking in with the manager (in seconds)
+EMPTY_QUEUE_TIMEOUT = 10
+
+# STATS ---------------------------------
+# Each commit processor traces the time that one in this many commits spends in each
+# stage of processing (see astrofeed_firehose.worker_stats)
+TRACE_SAMPLE_INTERVAL = 1000
+
+# RECONNECTING --------------------------
+# When the relay disconnects the client, it waits a random time of up to
+# RECONNECT_BASE_DELAY * 2 ** (failed attempts in a row) seconds before reconnecting,
+# capped at RECONNECT_MAX_DELAY. A connection that lasted RECONNECT_RESET_TIME seconds
+# doesn't count as a failed attempt.
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_RESET_TIME = 60.0
+
+# JETSTREAM -----------------------------
+# How often the Jetstream client checks for newly signed up (or removed) accounts, to
+# update which accounts the server sends us posts from (in seconds)
+JETSTREAM_OPTIONS_INTERVAL = 10
+# How often each worker saves the Jetstream cursor to the database (in seconds.)
+# Jetstream cursors are times rather than sequence numbers, and we only get a few
+# events a minute, so they aren't saved every DATABASE_CURSOR_UPDATE events.
+JETSTREAM_CURSOR_SAVE_INTERVAL = 60
+
 # CURSOR SYNCHRONIZATION ----------------
 # How often to update the cursor for the firehose client & in the database
 # I.e., on each nth commit we update the cursor in each place
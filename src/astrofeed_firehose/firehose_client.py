@@ -1,5 +1,8 @@
 """Code for client that connects to firehose."""
 
+import asyncio
+import contextlib
+import random
 from multiprocessing.sharedctypes import Synchronized
 import time
 from atproto.exceptions import FirehoseError
@@ -8,67 +11,130 @@ from atproto import firehose_models
 from atproto import models
 from atproto_client.models.common import XrpcError
 from astrofeed_lib.config import SERVICE_DID
-from astrofeed_lib.database import (
-    SubscriptionState,
-    setup_connection,
-    teardown_connection,
-    get_database,
+from astrofeed_lib.database import SubscriptionState, DBConnection
+from astrofeed_firehose.capture import BackgroundCaptureWriter
+from astrofeed_firehose.config import (
+    BASE_URI,
+    CURSOR_OVERRIDE,
+    CAPTURE_PATH,
+    FIREHOSE_CURSOR_UPDATE,
+    RECONNECT_BASE_DELAY,
+    RECONNECT_MAX_DELAY,
+    RECONNECT_RESET_TIME,
 )
-from astrofeed_firehose.config import BASE_URI, CURSOR_OVERRIDE, COMMITS_TO_ADD_AT_ONCE
+from astrofeed_firehose.queue_writer import QueueWriter
 import uvloop
 from faster_fifo import Queue
-from queue import Full
 from astrofeed_lib import logger
+from astrofeed_lib.metrics import METRICS
+
+FIREHOSE_RECONNECTS = METRICS.counter(
+    "firehose_client_reconnects_total",
+    "Times that the firehose client has reconnected to the relay after an error.",
+    labelnames=("error",),
+)
+FIREHOSE_REPLAYED_COMMITS = METRICS.counter(
+    "firehose_client_replayed_commits_total",
+    "Commits sent again by the relay after reconnecting, which were skipped.",
+)
 
 
 def run_client(
     queue: Queue,
     cursor: Synchronized,  # Return value of multiprocessing.Value
     firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    received_seq: Synchronized | None = None,
+    received_count: Synchronized | None = None,
 ):
     # We run the client with uvloop as it's a little bit quicker than basic Python
-    uvloop.run(run_client_async(queue, cursor, firehose_time))
-
-
-_queue_cache = []
+    uvloop.run(
+        run_client_async(queue, cursor, firehose_time, received_seq, received_count)
+    )
 
 
 async def run_client_async(
     queue: Queue,
     cursor: Synchronized,  # Return value of multiprocessing.Value
     firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    received_seq: Synchronized | None = None,
+    received_count: Synchronized | None = None,
 ):
     """Primary function for running the client that connects to Bluesky. New commits are
-    immediately sent to the separate post processing worker.
+    immediately handed to a QueueWriter, which sends them on to the separate post
+    processing workers without holding up the client. The sequence number of the
+    latest commit received is kept in received_seq, for the manager to compare with how
+    far the workers have got, and the number of frames received in received_count.
+
+    If FIREHOSE_CAPTURE_PATH is set, every frame is also appended to a capture file
+    there (see astrofeed_firehose.capture) from a background thread. The file is closed
+    when the client stops, after writing every frame that it received.
+
+    When the relay disconnects us, we reconnect after a jittered exponential backoff,
+    resuming from the latest commit that we received. (Everything before it is already
+    waiting for the workers, so nothing needs processing twice.)
     """
+    with _open_capture() as recorder:
+        await _run_client_async(
+            queue, cursor, firehose_time, received_seq, received_count, recorder
+        )
+
+
+def _open_capture():
+    if CAPTURE_PATH is None:
+        return contextlib.nullcontext()
+    logger.info(f"Recording firehose frames to {CAPTURE_PATH}")
+    return BackgroundCaptureWriter(CAPTURE_PATH)
+
+
+async def _run_client_async(
+    queue: Queue,
+    cursor: Synchronized,
+    firehose_time: Synchronized,
+    received_seq: Synchronized | None,
+    received_count: Synchronized | None,
+    recorder: BackgroundCaptureWriter | None,
+):
+    writer = QueueWriter(queue)
+    writer.start()
+
+    # Sequence number of the latest commit received by this process
+    last_seq = 0
 
     async def on_message_handler(message: firehose_models.MessageFrame) -> None:
         """This handler tells the client what to do when a new commit is encountered."""
-        _queue_cache.append(message)
-        if len(_queue_cache) > COMMITS_TO_ADD_AT_ONCE:
-            while True:
-                try:
-                    queue.put_many(_queue_cache, timeout=1.0)
-                    _queue_cache.clear()
-                    break
-                except Full:
-                    logger.warning("Queue is full! Consider increasing queue size.")
-                    time.sleep(0.1)
-
-        # Update local client cursor value
-        if cursor.value:
-            client.update_params(
-                models.ComAtprotoSyncSubscribeRepos.Params(cursor=cursor.value)
-            )
-            cursor.value = 0
+        nonlocal last_seq
 
         # Update current working time so that the watchdog knows this process is running
         firehose_time.value = time.time()
 
+        seq = message.body.get("seq")
+        if seq:
+            # The relay may resend commits that we already have after reconnecting
+            if seq <= last_seq:
+                FIREHOSE_REPLAYED_COMMITS.inc()
+                return
+            last_seq = seq
+
+        if recorder is not None:
+            recorder.write(message)
+        writer.put(message)
+
+        # Keep the client's cursor up to date, as it uses it to resume from when it
+        # reconnects by itself (e.g. after a dropped connection)
+        if seq and seq % FIREHOSE_CURSOR_UPDATE == 0:
+            client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=seq))
+
+        if received_seq is not None and seq:
+            received_seq.value = seq
+        if received_count is not None:
+            received_count.value += 1
+
     # Continually restarts the client if ConsumerTooSlow errors are encountered. This
     # can happen due to the Bluesky network being busy or internet connection issues.
+    failed_attempts = 0
     while True:
-        client = _get_client()
+        client = _get_client(_get_resume_cursor(last_seq, cursor))
+        connected_at = time.time()
 
         try:
             logger.info("... firehose client worker started")
@@ -77,36 +143,82 @@ async def run_client_async(
         except FirehoseError as e:
             if not _is_client_too_slow_error(e):
                 raise e
-            logger.warning("Reconnecting to Firehose due to ConsumerTooSlow...")
+            FIREHOSE_RECONNECTS.inc(error="ConsumerTooSlow")
+
+            # Only back off further if the last connection didn't last long
+            if time.time() - connected_at > RECONNECT_RESET_TIME:
+                failed_attempts = 0
+            delay = get_reconnect_delay(failed_attempts)
+            failed_attempts += 1
+            logger.warning(
+                f"Reconnecting to Firehose due to ConsumerTooSlow in {delay:.1f}s "
+                f"(resuming after seq {last_seq})..."
+            )
+            await _wait_before_reconnecting(delay, firehose_time)
 
 
-def _get_client():
-    start_cursor = CURSOR_OVERRIDE
-    if start_cursor is None:
-        start_cursor = _get_start_cursor()
+def get_reconnect_delay(failed_attempts: int) -> float:
+    """How long to wait before reconnecting, which doubles with every failed attempt in
+    a row up to RECONNECT_MAX_DELAY. The delay is random between zero and that, so that
+    we don't keep reconnecting at the same moment as other clients.
+    """
+    ceiling = min(RECONNECT_BASE_DELAY * 2**failed_attempts, RECONNECT_MAX_DELAY)
+    return random.uniform(0, ceiling)
+
+
+async def _wait_before_reconnecting(delay: float, firehose_time: Synchronized):
+    """Waits for delay seconds, while still telling the watchdog that we're running."""
+    end_time = time.time() + delay
+    while (remaining := end_time - time.time()) > 0:
+        firehose_time.value = time.time()
+        await asyncio.sleep(min(remaining, 1.0))
+
+
+def _get_resume_cursor(
+    last_seq: int, cursor: Synchronized, service: str = SERVICE_DID
+) -> int | None:
+    """Works out where to start reading the firehose from. In order of preference:
+
+    1. The latest commit received by this process, if it's already connected before
+    2. FIREHOSE_CURSOR_OVERRIDE, if set
+    3. The latest commit processed by the workers (kept by the manager, so it lasts
+       over restarts of this process)
+    4. The cursor saved in the database for service, which can be up to
+       DATABASE_CURSOR_UPDATE commits behind
+    """
+    if last_seq:
+        return last_seq
+    if CURSOR_OVERRIDE is not None:
+        return CURSOR_OVERRIDE
+    if cursor.value:
+        return cursor.value
+    return _get_start_cursor(service)
+
+
+def _get_client(start_cursor: int | None):
     params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=start_cursor)
     return AsyncFirehoseSubscribeReposClient(params, base_uri=BASE_URI)
 
 
-def _get_start_cursor():
+def _get_start_cursor(service: str = SERVICE_DID):
     # Get current saved cursor value
-    setup_connection(get_database())
-    start_cursor = (
-        SubscriptionState.select()
-        .where(SubscriptionState.service == SERVICE_DID)
-        .execute()[0]
-        .cursor
-    )
-    if start_cursor:
-        if not isinstance(start_cursor, int):
-            teardown_connection(get_database())
-            raise ValueError(f"Saved cursor with value '{start_cursor}' is invalid.")
-        return start_cursor
-
-    # If there isn't one, then make sure the DB has a cursor
-    logger.info("Generating a cursor for the first time...")
-    SubscriptionState.create(service=SERVICE_DID, cursor=0)
-    teardown_connection(get_database())
+    with DBConnection():
+        state = (
+            SubscriptionState.select()
+            .where(SubscriptionState.service == service)
+            .first()
+        )
+        if state is not None:
+            start_cursor = state.cursor
+            if start_cursor and not isinstance(start_cursor, int):
+                raise ValueError(
+                    f"Saved cursor with value '{start_cursor}' is invalid."
+                )
+            return start_cursor or None
+
+        # If there isn't one, then make sure the DB has a cursor
+        logger.info("Generating a cursor for the first time...")
+        SubscriptionState.create(service=service, cursor=0)
     return None
 
 
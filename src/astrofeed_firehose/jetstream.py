@@ -0,0 +1,208 @@
+"""A client for Jetstream (https://github.com/bluesky-social/jetstream), which can be
+used instead of the relay's firehose by setting FIREHOSE_SOURCE=jetstream.
+
+Jetstream sends commits as small JSON events, and can filter them by collection and
+author for us. We only ask for posts by signed up accounts, which is a tiny fraction of
+the full firehose, and saves decoding CBOR and CAR files. Events are passed to the
+commit processors as JSON strings, where they go through the same classification and
+storage as commits from the relay (see apply_commit.apply_jetstream_event.)
+
+Like counts (and so the top feeds) aren't updated in this mode, as that would need
+every like on the network.
+
+Jetstream's cursor is the time of an event in microseconds, rather than a sequence
+number, so it's saved in its own row of SubscriptionState (JETSTREAM_CURSOR_SERVICE.)
+"""
+
+import asyncio
+import json
+import re
+import time
+from multiprocessing.sharedctypes import Synchronized
+from urllib.parse import urlencode
+
+import uvloop
+import websockets
+from atproto import models
+from faster_fifo import Queue
+from websockets.asyncio.client import ClientConnection, connect
+
+from astrofeed_firehose.config import (
+    JETSTREAM_OPTIONS_INTERVAL,
+    JETSTREAM_URI,
+    RECONNECT_RESET_TIME,
+)
+from astrofeed_firehose.firehose_client import (
+    FIREHOSE_RECONNECTS,
+    FIREHOSE_REPLAYED_COMMITS,
+    _get_resume_cursor,
+    _wait_before_reconnecting,
+    get_reconnect_delay,
+)
+from astrofeed_firehose.queue_writer import QueueWriter
+from astrofeed_lib import logger
+from astrofeed_lib.accounts import CachedAccountQuery
+from astrofeed_lib.config import SERVICE_DID
+
+JETSTREAM_CURSOR_SERVICE = f"{SERVICE_DID}#jetstream"
+
+WANTED_COLLECTIONS = [models.ids.AppBskyFeedPost]
+
+# Jetstream only filters on up to this many accounts. With more, we get every post.
+MAX_WANTED_DIDS = 10000
+
+# How often to tell the watchdog that we're running while connected, in seconds
+WATCHDOG_UPDATE_INTERVAL = 1.0
+
+# Events are only fully decoded by the commit processors
+_TIME_US = re.compile(r'"time_us":\s*(\d+)')
+
+
+def run_jetstream_client(
+    queue: Queue,
+    cursor: Synchronized,  # Return value of multiprocessing.Value
+    firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    received_count: Synchronized | None = None,
+):
+    uvloop.run(run_jetstream_client_async(queue, cursor, firehose_time, received_count))
+
+
+async def run_jetstream_client_async(
+    queue: Queue,
+    cursor: Synchronized,  # Return value of multiprocessing.Value
+    firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    received_count: Synchronized | None = None,
+    uri: str = JETSTREAM_URI,
+    accounts: CachedAccountQuery | None = None,
+):
+    """Reads posts by signed up accounts from the Jetstream server at uri, and hands
+    them to a QueueWriter for the commit processors. Reconnects in the same way as
+    firehose_client.run_client_async, resuming from the latest event received.
+    """
+    if accounts is None:
+        accounts = CachedAccountQuery(query_interval=600)
+    writer = QueueWriter(queue)
+    writer.start()
+
+    # Time of the latest event received by this process
+    last_time_us = 0
+
+    failed_attempts = 0
+    while True:
+        start_cursor = _get_resume_cursor(
+            last_time_us, cursor, JETSTREAM_CURSOR_SERVICE
+        )
+        connected_at = time.time()
+        # The server closing the connection normally ends the loop below without an
+        # error, but we still want to reconnect
+        error = "ConnectionClosedOK"
+        try:
+            async with connect(
+                _get_subscribe_uri(uri, start_cursor), max_size=None
+            ) as websocket:
+                logger.info("... Jetstream client worker started")
+                tasks = [
+                    asyncio.create_task(_keep_options_updated(websocket, accounts)),
+                    asyncio.create_task(_keep_watchdog_updated(firehose_time)),
+                ]
+                try:
+                    async for event in websocket:
+                        firehose_time.value = time.time()
+                        if isinstance(event, bytes):
+                            event = event.decode()
+
+                        # The server may resend events that we already have after
+                        # reconnecting
+                        match = _TIME_US.search(event)
+                        if match is not None:
+                            time_us = int(match[1])
+                            if time_us < last_time_us:
+                                FIREHOSE_REPLAYED_COMMITS.inc()
+                                continue
+                            last_time_us = time_us
+
+                        writer.put(event)
+                        if received_count is not None:
+                            received_count.value += 1
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+        except (websockets.ConnectionClosed, OSError) as e:
+            error = type(e).__name__
+
+        FIREHOSE_RECONNECTS.inc(error=error)
+        if time.time() - connected_at > RECONNECT_RESET_TIME:
+            failed_attempts = 0
+        delay = get_reconnect_delay(failed_attempts)
+        failed_attempts += 1
+        logger.warning(
+            f"Reconnecting to Jetstream due to {error} in {delay:.1f}s "
+            f"(resuming from {last_time_us})..."
+        )
+        await _wait_before_reconnecting(delay, firehose_time)
+
+
+def _get_subscribe_uri(uri: str, cursor: int | None) -> str:
+    """The accounts to follow are sent after connecting (there are too many to fit in
+    the URI), so we ask the server to wait for them with requireHello.
+    """
+    params = [("wantedCollections", collection) for collection in WANTED_COLLECTIONS]
+    params.append(("requireHello", "true"))
+    if cursor:
+        params.append(("cursor", str(cursor)))
+    return f"{uri}?{urlencode(params)}"
+
+
+async def _keep_options_updated(
+    websocket: ClientConnection, accounts: CachedAccountQuery
+):
+    """Sends the server the accounts to send us posts from, and then again whenever
+    they change. If the accounts can't be fetched (e.g. the database is down), we try
+    again after JETSTREAM_OPTIONS_INTERVAL, as the server sends us nothing until it has
+    them.
+    """
+    sent_version = None
+    while True:
+        try:
+            dids = await asyncio.to_thread(accounts.get_accounts)
+            if accounts.version != sent_version:
+                await websocket.send(json.dumps(_get_options_update(dids)))
+                sent_version = accounts.version
+        except websockets.ConnectionClosed:
+            # The client reconnects once it notices
+            return
+        except Exception:
+            logger.exception(
+                "Unable to send Jetstream the accounts to send us posts from."
+            )
+        await asyncio.sleep(JETSTREAM_OPTIONS_INTERVAL)
+
+
+async def _keep_watchdog_updated(firehose_time: Synchronized):
+    """Tells the watchdog that we're running for as long as we're connected. We only
+    get posts by signed up accounts, so there can be minutes between events. (A
+    connection that stops responding is closed by the websocket's keepalive pings, so
+    we still reconnect if the server goes away.)
+    """
+    while True:
+        firehose_time.value = time.time()
+        await asyncio.sleep(WATCHDOG_UPDATE_INTERVAL)
+
+
+def _get_options_update(dids) -> dict:
+    wanted_dids = sorted(dids)
+    if len(wanted_dids) > MAX_WANTED_DIDS:
+        logger.warning(
+            f"There are too many accounts ({len(wanted_dids)}) for Jetstream to filter "
+            "posts by, so we'll receive every post."
+        )
+        wanted_dids = []
+    return {
+        "type": "options_update",
+        "payload": {
+            "wantedCollections": WANTED_COLLECTIONS,
+            "wantedDids": wanted_dids,
+            "maxMessageSizeBytes": 0,
+        },
+    }
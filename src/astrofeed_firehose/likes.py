@@ -0,0 +1,274 @@
+"""Counting likes of the posts in our database, and keeping the top feeds that are
+ranked by them up to date.
+
+The firehose carries every like on the network (millions an hour), but only a tiny
+fraction are of our posts. So, each commit processor collects likes in memory, and
+every LIKE_FLUSH_INTERVAL seconds looks up which are of our posts with a few bulk
+queries, and writes the changes in like counts with one bulk UPDATE. Each processor
+also keeps an in-memory set of the likes that we've counted, so that unlikes can be
+checked without touching the database.
+"""
+
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from multiprocessing.sharedctypes import Synchronized
+
+import peewee
+
+from astrofeed_firehose.config import (
+    LIKE_FLUSH_INTERVAL,
+    LIKE_TRACKING_DAYS,
+    LIKE_TRACKING_REFRESH_INTERVAL,
+    LIKE_TRACKING_RELOAD_INTERVAL,
+    TOP_FEED_REFRESH_INTERVAL,
+)
+from astrofeed_lib import logger
+from astrofeed_lib.database import (
+    BaseModel,
+    DBConnection,
+    Post,
+    PostLike,
+    datetime_now_utc_naive,
+    get_database,
+)
+
+LIKE_TRACKING_WINDOW = timedelta(days=LIKE_TRACKING_DAYS)
+
+# Maximum number of values in one IN (...) or VALUES clause
+_CHUNK_SIZE = 500
+
+# Refreshes also fetch rows from a little before the last one, in case of rows that were
+# committed late or clock differences between processes
+_REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+class RecentUriSet:
+    def __init__(
+        self,
+        model: type[BaseModel],
+        window: timedelta = LIKE_TRACKING_WINDOW,
+        refresh_interval: float = LIKE_TRACKING_REFRESH_INTERVAL,
+        reload_interval: float = LIKE_TRACKING_RELOAD_INTERVAL,
+    ):
+        """Set of the URIs in a table (with uri and indexed_at columns) that were added
+        in the last window of time.
+
+        URIs are stored by their hash, which takes a fraction of the memory of storing
+        the strings. Membership tests can hence have (very rare) false
+        positives, as can URIs that were deleted since the last reload, so anything that
+        passes the test should still be checked against the database in bulk later.
+        """
+        self.model = model
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.reload_interval = reload_interval
+        self.hashes: set[int] = set()
+        self.last_refresh: float = 0.0
+        self.last_reload: float = 0.0
+        self.last_indexed_at = None
+
+    def __contains__(self, uri: str) -> bool:
+        return hash(uri) in self.hashes
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, uri: str) -> None:
+        self.hashes.add(hash(uri))
+
+    def discard(self, uri: str) -> None:
+        self.hashes.discard(hash(uri))
+
+    def refresh_if_due(self) -> None:
+        current_time = time.time()
+        if current_time - self.last_reload > self.reload_interval:
+            self.reload()
+        elif current_time - self.last_refresh > self.refresh_interval:
+            self.refresh()
+
+    def reload(self) -> None:
+        """Replaces the set with every URI from the last window of time."""
+        self.last_indexed_at = datetime_now_utc_naive() - self.window
+        self.hashes = set()
+        self.refresh()
+        self.last_reload = self.last_refresh
+        logger.info(f"Loaded {len(self.hashes)} recent {self.model.__name__} URIs")
+
+    def refresh(self) -> None:
+        """Adds URIs that were added since the last refresh."""
+        start = datetime_now_utc_naive()
+        query = (
+            self.model.select(self.model.uri)
+            .where(self.model.indexed_at >= self.last_indexed_at)
+            .tuples()
+        )
+        with DBConnection():
+            self.hashes.update(hash(uri) for (uri,) in query)
+        self.last_indexed_at = start - _REFRESH_OVERLAP
+        self.last_refresh = time.time()
+
+
+class LikeCounter:
+    def __init__(self, flush_interval: float = LIKE_FLUSH_INTERVAL):
+        """Collects like and unlike operations from the firehose in memory, and writes
+        them to the database in one transaction every flush_interval seconds.
+        """
+        self.flush_interval = flush_interval
+        self.last_flush_time = time.time()
+
+        # Likes of our posts that we've counted. (There's no such set of our posts: a
+        # post written by another commit processor isn't in its set until the next
+        # refresh, so likes in its first minute would be missed, which are the ones that
+        # matter most for the top feeds. Likes are checked against Post when flushed.)
+        self.recent_likes = RecentUriSet(PostLike)
+
+        # Like URI -> URI of the liked post
+        self.created: dict[str, str] = {}
+        # URIs of deleted likes
+        self.deleted: set[str] = set()
+
+    def add_ops(self, ops: dict) -> None:
+        """Adds the likes from a _get_ops_by_type dict."""
+        if not ops["likes"]["created"] and not ops["likes"]["deleted"]:
+            return
+        self.recent_likes.refresh_if_due()
+
+        for like in ops["likes"]["created"]:
+            self.created[like["uri"]] = like["record"].subject.uri
+        for like in ops["likes"]["deleted"]:
+            # Likes that are created and deleted between flushes just cancel out
+            if self.created.pop(like["uri"], None) is None:
+                if like["uri"] in self.recent_likes:
+                    self.deleted.add(like["uri"])
+
+    def flush_if_due(self) -> None:
+        if time.time() - self.last_flush_time <= self.flush_interval:
+            return
+        try:
+            self.flush()
+        except Exception:
+            # Like counts aren't worth stopping the commit processor over
+            logger.exception("Unable to write likes to the database; skipping them.")
+
+    def flush(self) -> None:
+        """Updates Post.likes with the likes seen since the last flush."""
+        created, deleted = self.created, self.deleted
+        self.created, self.deleted = {}, set()
+        self.last_flush_time = time.time()
+        if not created and not deleted:
+            return
+
+        with DBConnection() as db, db.atomic():
+            new_likes = _filter_new_likes_of_our_posts(created)
+            for batch in peewee.chunked(new_likes.items(), _CHUNK_SIZE):
+                PostLike.insert_many(
+                    batch, fields=[PostLike.uri, PostLike.post_uri]
+                ).execute()
+            removed_likes = _remove_likes(deleted)
+
+            like_changes = Counter(new_likes.values())
+            like_changes.subtract(removed_likes.values())
+            _update_like_counts(like_changes)
+
+        for uri in new_likes:
+            self.recent_likes.add(uri)
+        for uri in deleted:
+            self.recent_likes.discard(uri)
+
+        if new_likes or removed_likes:
+            logger.info(
+                f"Updated likes: {len(new_likes)} new, {len(removed_likes)} removed"
+            )
+
+
+def _filter_new_likes_of_our_posts(created: dict[str, str]) -> dict[str, str]:
+    """Returns the likes of posts in our database from the last LIKE_TRACKING_WINDOW
+    that we haven't counted yet.
+    """
+    oldest = datetime_now_utc_naive() - LIKE_TRACKING_WINDOW
+    our_posts = set()
+    for batch in peewee.chunked(set(created.values()), _CHUNK_SIZE):
+        query = Post.select(Post.uri).where(
+            Post.uri.in_(batch), Post.indexed_at >= oldest
+        )
+        our_posts.update(uri for (uri,) in query.tuples())
+    likes = {uri: post for uri, post in created.items() if post in our_posts}
+
+    # The firehose may replay commits after a restart, so some may already be counted
+    for batch in peewee.chunked(list(likes), _CHUNK_SIZE):
+        query = PostLike.select(PostLike.uri).where(PostLike.uri.in_(batch))
+        for (uri,) in query.tuples():
+            del likes[uri]
+    return likes
+
+
+def _remove_likes(deleted: set[str]) -> dict[str, str]:
+    """Deletes any of the given likes that were counted, returning them."""
+    removed = {}
+    for batch in peewee.chunked(deleted, _CHUNK_SIZE):
+        query = PostLike.select(PostLike.uri, PostLike.post_uri).where(
+            PostLike.uri.in_(batch)
+        )
+        removed.update(query.tuples())
+    for batch in peewee.chunked(list(removed), _CHUNK_SIZE):
+        PostLike.delete().where(PostLike.uri.in_(batch)).execute()
+    return removed
+
+
+def _update_like_counts(like_changes: Counter) -> None:
+    """Adds the changes to Post.likes, with one UPDATE ... FROM (VALUES ...) per
+    _CHUNK_SIZE posts.
+    """
+    changes = [(uri, change) for uri, change in like_changes.items() if change != 0]
+    if not changes:
+        return
+
+    if isinstance(get_database().obj, peewee.MySQLDatabase):
+        _update_like_counts_mysql(changes)
+        return
+
+    for batch in peewee.chunked(changes, _CHUNK_SIZE):
+        # N.B.: PostgreSQL and SQLite both name the columns of a VALUES list column1,
+        # column2 etc., so we don't give them names (which SQLite doesn't support)
+        values = peewee.ValuesList(batch, alias="changes")
+        Post.update(likes=Post.likes + values.c.column2).from_(values).where(
+            Post.uri == values.c.column1
+        ).execute()
+
+
+def _update_like_counts_mysql(changes: list[tuple[str, int]]) -> None:
+    """MySQL doesn't support UPDATE ... FROM, so instead we do one UPDATE per distinct
+    change in likes (which are almost all +1.)
+    """
+    posts_by_change = defaultdict(list)
+    for uri, change in changes:
+        posts_by_change[change].append(uri)
+    for change, uris in posts_by_change.items():
+        for batch in peewee.chunked(uris, _CHUNK_SIZE):
+            Post.update(likes=Post.likes + change).where(Post.uri.in_(batch)).execute()
+
+
+def run_top_feed_ranker(process_time: Synchronized) -> None:
+    """Recomputes the top feeds every TOP_FEED_REFRESH_INTERVAL seconds, and forgets
+    likes older than LIKE_TRACKING_WINDOW.
+    """
+    from astrofeed_lib.ranking import refresh_top_feeds
+
+    logger.info("... top feed ranker started")
+    last_refresh_time = 0.0
+
+    while True:
+        if time.time() - last_refresh_time > TOP_FEED_REFRESH_INTERVAL:
+            refresh_top_feeds()
+            with DBConnection():
+                PostLike.delete().where(
+                    PostLike.indexed_at
+                    < datetime_now_utc_naive() - LIKE_TRACKING_WINDOW
+                ).execute()
+            last_refresh_time = time.time()
+
+        # We update this often (rather than just after each refresh) so that the manager
+        # doesn't think that we've hung
+        process_time.value = time.time()
+        time.sleep(1)
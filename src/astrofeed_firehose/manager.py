@@ -1,40 +1,189 @@
+import os
+import signal
 import time
+from collections import deque
 from faster_fifo import Queue
-from multiprocessing import Process, Value
+import multiprocessing
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
 from multiprocessing.sharedctypes import Synchronized
+from typing import Callable
 from astrofeed_firehose.config import (
     QUEUE_BUFFER_SIZE,
     MANAGER_CHECK_INTERVAL,
+    MANAGER_MONITOR_INTERVAL,
+    MANAGER_MAX_RESTARTS,
+    MANAGER_RESTART_WINDOW,
+    MANAGER_METRICS_PORT,
+    PROFILE_COMBINE_DELAY,
+    PROFILE_DIRECTORY,
     CPU_COUNT,
+    MIN_WORKER_COUNT,
+    MAX_WORKER_COUNT,
+    SCALE_UP_QUEUE_SIZE,
+    SCALE_UP_LAG,
+    SCALE_UP_UTILIZATION,
+    SCALE_DOWN_QUEUE_SIZE,
+    SCALE_DOWN_LAG,
+    SCALE_DOWN_UTILIZATION,
+    SCALING_COOLDOWN,
+    SHARED_MEMORY_DIRECTORY,
+    SOURCE,
+    WORKER_PRELOAD_MODULES,
+    WORKER_START_METHOD,
 )
+from astrofeed_firehose.metrics import FirehoseMetrics
+from astrofeed_firehose.profiling import (
+    PROFILE_SIGNAL,
+    combine_profiles,
+    request_snapshots,
+)
+from astrofeed_firehose.shared_accounts import SharedAccountSet
+from astrofeed_firehose.worker_stats import SharedWorkerStats, combine_snapshots
 from astrofeed_lib import logger
+from astrofeed_lib.config import METRICS_PORT
+
+
+class ManagedProcess:
+    def __init__(
+        self,
+        name: str,
+        target: Callable,
+        args: tuple = (),
+        kwargs: dict | None = None,
+        context: BaseContext | None = None,
+    ):
+        """A child process that can be restarted. The target is called with args, then
+        a shared last-active time that it should keep updating so that the manager knows
+        it hasn't hung, then kwargs. The process is started with the given
+        multiprocessing context, or by forking if there isn't one.
+        """
+        self.name = name
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.context = context or multiprocessing.get_context("fork")
+        self.last_active: Synchronized = self.context.Value("d", time.time())
+        self.process: BaseProcess | None = None
+        self.restart_times: deque[float] = deque()
+
+    def start(self):
+        self.last_active.value = time.time()
+        self.process = self.context.Process(
+            target=self.target,
+            args=(*self.args, self.last_active),
+            kwargs=self.kwargs,
+            name=self.name,
+        )
+        self.process.start()
+
+    def kill(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=5)
+
+    def restart(self):
+        """Kills the process (if it's still running) and starts it again."""
+        self.kill()
+        self.restart_times.append(time.time())
+        self.start()
+
+    def restarts_in_last(self, seconds: float) -> int:
+        while self.restart_times and self.restart_times[0] < time.time() - seconds:
+            self.restart_times.popleft()
+        return len(self.restart_times)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def is_hung(self, timeout: float = MANAGER_CHECK_INTERVAL) -> bool:
+        return self.last_active.value < time.time() - timeout
 
 
 class FirehoseProcessingManager:
-    def __init__(self):
+    def __init__(
+        self,
+        replay_path: str | None = None,
+        worker_start_method: str = WORKER_START_METHOD,
+    ):
         """An overall management class ran on the main thread. It owns & starts the
         queue and processes in the processing flow. It also has an additional monitor
         function that can be called to continuously monitor the individual subprocesses,
-        looking for hung processes or other issues.
+        restarting hung or dead processes and adding or removing commit processors
+        depending on how busy they are.
+
+        If replay_path is given, commits are read from that capture file (see
+        astrofeed_firehose.capture) instead of from the firehose. Otherwise, they're
+        read from the relay or a Jetstream server, depending on FIREHOSE_SOURCE.
+
+        Commit processors are started with worker_start_method. With forkserver, they're
+        forked from a template process that has imported WORKER_PRELOAD_MODULES, rather
+        than each importing them after starting. Everything shared with them has to be
+        created with the same multiprocessing context.
         """
+        self.worker_context = multiprocessing.get_context(worker_start_method)
+        if worker_start_method == "forkserver":
+            self.worker_context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+        context = self.worker_context
+
         # Fixed resources
-        self.cursor: Synchronized = Value("L", 0)
-        self.op_count: Synchronized = Value("L", 0)
+        self.cursor: Synchronized = context.Value("L", 0)
+        self.op_count: Synchronized = context.Value("L", 0)
+        self.replay_path = replay_path
+        self.frames_replayed: Synchronized = context.Value("L", 0)
+
+        # Sequence numbers of the latest commit received from the firehose and the
+        # latest one processed by any worker, to see how far behind we are
+        self.received_seq: Synchronized = context.Value("L", 0, lock=False)
+        self.processed_seq: Synchronized = context.Value("L", 0, lock=False)
+        self.received_count: Synchronized = context.Value("L", 0, lock=False)
+
+        # Stats of workers that have been removed, so that totals don't go backwards
+        self.retired_stats: dict[str, float] = combine_snapshots([])
+
+        # Valid accounts, built once by the account publisher and shared with every
+        # commit processor
+        self.accounts_path = os.path.join(
+            SHARED_MEMORY_DIRECTORY, f"astrofeed-valid-accounts-{os.getpid()}"
+        )
+        self.accounts_version: Synchronized = context.Value("L", 0)
 
         # Multiprocessing primitives
         self.queue: Queue = Queue(QUEUE_BUFFER_SIZE)
-        self.processes: list[Process] = []
-        self.times: list[Synchronized] = []
-        self._initialize_processes()
+        self.client: ManagedProcess = self._create_client()
+        self.workers: list[ManagedProcess] = [
+            self._create_worker(i + 1)
+            for i in range(min(max(CPU_COUNT, MIN_WORKER_COUNT), MAX_WORKER_COUNT))
+        ]
+        self.services: list[ManagedProcess] = self._create_services()
 
         # Values to help FirehoseProcessingManager.monitor() work
         self.last_check_time: float = time.time()
         self.last_op_count: int = 0
+        self.last_scaling_time: float = time.time()
+        self.last_utilization_check: tuple[float, float] = (time.time(), 0.0)
+        self.metrics = FirehoseMetrics(self)
+
+        # When workers were last asked for a snapshot of their profiles, if they
+        # haven't been combined yet (see astrofeed_firehose.profiling)
+        self.pid = os.getpid()
+        self.profile_requested_at: float | None = None
+
+    @property
+    def processes(self) -> list[ManagedProcess]:
+        return [self.client, *self.workers, *self.services]
 
     def start_processes(self):
-        """Starts all child processes."""
+        """Starts all child processes, and serves the firehose's metrics if
+        FIREHOSE_MANAGER_METRICS_PORT is set. If FIREHOSE_PROFILE_DIRECTORY is set,
+        sending PROFILE_SIGNAL to the manager asks every worker for its profile.
+        """
+        if PROFILE_DIRECTORY is not None:
+            signal.signal(PROFILE_SIGNAL, self._request_profiles)
         for process in self.processes:
             process.start()
+        if MANAGER_METRICS_PORT is not None:
+            self.metrics.serve(MANAGER_METRICS_PORT)
 
     def stop_processes(self):
         """Tries to kill child processes."""
@@ -44,66 +193,207 @@ class FirehoseProcessingManager:
             except Exception as ex:
                 logger.error(f"Exception stopping worker {process.name} ({ex})")
                 pass
+        try:
+            os.remove(self.accounts_path)
+        except FileNotFoundError:
+            pass
 
     def monitor(self):
-        """Monitors running processes and asserts that they are still running."""
+        """Monitors running processes, restarting any that die or hang, and scales the
+        number of commit processors up or down as needed.
+        """
         while True:
-            self._print_ops_per_second()
-            dead_processes, hung_processes = self._check_processes()
-            if dead_processes or hung_processes:
-                logger.critical(
-                    "Crticial exception encountered! Stopping child processes."
-                )
-                self.stop_processes()
-                raise RuntimeError(
-                    "Processes encountered critical errors and hung/died."
-                    f"\nProcesses that died: {', '.join(sorted(dead_processes))}"
-                    f"\nProcesses that hung: {', '.join(sorted(hung_processes))}"
-                )
-            time.sleep(MANAGER_CHECK_INTERVAL)
+            if time.time() - self.last_check_time >= MANAGER_CHECK_INTERVAL:
+                self._print_ops_per_second()
+            self._restart_failed_processes()
+            self.autoscale()
+            self.metrics.update_rates()
+            self._combine_profiles_if_ready()
+            time.sleep(MANAGER_MONITOR_INTERVAL)
+
+    def _request_profiles(self, signum=None, frame=None):
+        # Child processes inherit this handler until they set their own
+        if os.getpid() != self.pid:
+            return
+        logger.info("Asking commit processors for their profiles")
+        self.profile_requested_at = time.time()
+        request_snapshots(
+            [worker.process.pid for worker in self.workers if worker.is_alive()]
+        )
 
-    def _initialize_processes(self):
-        """Performs set up on all initial processes, creating a firehose_client process
-        and CPU_COUNT commit processor processes.
+    def _combine_profiles_if_ready(self):
+        """Combines the profiles that workers wrote after the last request for them,
+        once they've had PROFILE_COMBINE_DELAY seconds to write them.
         """
-        name = "Firehose client"
-        target = _run_firehose_client
-        kwargs = dict()
-
-        for i in range(CPU_COUNT + 1):
-            # Create resources for one process
-            self.times.append(Value("d", time.time()))
-            self.processes.append(
-                Process(
-                    target=target,
-                    args=(self.queue, self.cursor, self.times[-1]),
-                    kwargs=kwargs,
-                    name=name,
-                )
+        requested_at = self.profile_requested_at
+        if requested_at is None or time.time() - requested_at < PROFILE_COMBINE_DELAY:
+            return
+        self.profile_requested_at = None
+        path = combine_profiles(PROFILE_DIRECTORY, since=requested_at)
+        if path is None:
+            logger.warning("No commit processors wrote a profile!")
+        else:
+            logger.info(f"Wrote combined profile of all commit processors to {path}")
+
+    def _create_client(self) -> ManagedProcess:
+        if self.replay_path is not None:
+            return ManagedProcess(
+                "Capture replayer",
+                _run_capture_replayer,
+                args=(self.queue, self.cursor),
+                kwargs=dict(
+                    path=self.replay_path, frames_replayed=self.frames_replayed
+                ),
             )
+        if SOURCE == "jetstream":
+            # Jetstream cursors are times rather than sequence numbers, so we can't
+            # count how many commits behind the workers are
+            return ManagedProcess(
+                "Jetstream client",
+                _run_jetstream_client,
+                args=(self.queue, self.cursor),
+                kwargs=dict(
+                    metrics_port=_get_metrics_port(0),
+                    received_count=self.received_count,
+                ),
+            )
+        return ManagedProcess(
+            "Firehose client",
+            _run_firehose_client,
+            args=(self.queue, self.cursor),
+            kwargs=dict(
+                metrics_port=_get_metrics_port(0),
+                received_seq=self.received_seq,
+                received_count=self.received_count,
+            ),
+        )
 
-            # Set up a couple of things for the next loop
-            name = f"Commit processor {i + 1}"
-            target = _run_commit_processor
-            kwargs = dict(op_counter=self.op_count)
+    def _create_worker(self, number: int) -> ManagedProcess:
+        return ManagedProcess(
+            f"Commit processor {number}",
+            _run_commit_processor,
+            args=(self.queue, self.cursor),
+            kwargs=dict(
+                op_counter=self.op_count,
+                shared_accounts=SharedAccountSet(
+                    self.accounts_path, self.accounts_version
+                ),
+                metrics_port=_get_metrics_port(number),
+                should_stop=self.worker_context.Event(),
+                stats=SharedWorkerStats(),
+                processed_seq=self.processed_seq,
+            ),
+            context=self.worker_context,
+        )
+
+    def _create_services(self) -> list[ManagedProcess]:
+        """Creates an account publisher process and a top feed ranker process."""
+        return [
+            ManagedProcess(
+                "Account publisher",
+                _run_account_publisher,
+                args=(self.accounts_path, self.accounts_version),
+            ),
+            ManagedProcess("Top feed ranker", _run_top_feed_ranker),
+        ]
 
-    def _check_processes(self) -> tuple[list[str], list[str]]:
+    def _check_processes(self) -> tuple[list[ManagedProcess], list[ManagedProcess]]:
         """Checks all processes and works out which are hung or dead."""
-        latest_possible_update = time.time() - MANAGER_CHECK_INTERVAL
         dead_processes = []
         hung_processes = []
-        for process, process_last_update in zip(self.processes, self.times):
+        for process in self.processes:
             # Check for outright dead processes
             if not process.is_alive():
-                dead_processes.append(process.name)
-                continue
+                dead_processes.append(process)
 
             # Check for hung processes
-            if process_last_update.value < latest_possible_update:
-                hung_processes.append(process.name)
+            elif process.is_hung():
+                hung_processes.append(process)
 
         return dead_processes, hung_processes
 
+    def _restart_failed_processes(self):
+        """Restarts any dead or hung processes. If a process keeps failing, stops
+        everything instead.
+        """
+        dead_processes, hung_processes = self._check_processes()
+        for process in dead_processes + hung_processes:
+            status = "died" if process in dead_processes else "hung"
+            restarts = process.restarts_in_last(MANAGER_RESTART_WINDOW)
+            if restarts >= MANAGER_MAX_RESTARTS:
+                logger.critical(
+                    "Crticial exception encountered! Stopping child processes."
+                )
+                self.stop_processes()
+                raise RuntimeError(
+                    f"Process {process.name} {status} after being restarted "
+                    f"{restarts} times in the last {MANAGER_RESTART_WINDOW}s."
+                )
+
+            logger.error(f"Process {process.name} {status}! Restarting it.")
+            process.restart()
+
+    def _get_worker_utilization(self) -> float:
+        """Fraction of the time that workers have spent processing commits since the
+        last time this was called.
+        """
+        current_time, busy_time = time.time(), self._get_total_busy_time()
+        last_time, last_busy_time = self.last_utilization_check
+        self.last_utilization_check = (current_time, busy_time)
+
+        elapsed = (current_time - last_time) * len(self.workers)
+        if elapsed <= 0:
+            return 0.0
+        return min(max((busy_time - last_busy_time) / elapsed, 0.0), 1.0)
+
+    def _get_total_busy_time(self) -> float:
+        return sum(worker.kwargs["stats"].get("busy_time") for worker in self.workers)
+
+    def autoscale(self):
+        """Adds or removes a commit processor if needed."""
+        queue_size = self.queue.qsize()
+        lag = max(self.received_seq.value - self.processed_seq.value, 0)
+        utilization = self._get_worker_utilization()
+
+        if time.time() - self.last_scaling_time < SCALING_COOLDOWN:
+            return
+        worker_count = get_target_worker_count(
+            len(self.workers), queue_size, lag, utilization
+        )
+        if worker_count == len(self.workers):
+            return
+
+        logger.info(
+            f"Scaling to {worker_count} commit processors "
+            f"(queue: {queue_size}, lag: {lag} commits, "
+            f"utilization: {utilization:.0%})"
+        )
+        if worker_count > len(self.workers):
+            self.add_worker()
+        else:
+            self.remove_worker()
+
+    def add_worker(self):
+        worker = self._create_worker(len(self.workers) + 1)
+        worker.start()
+        self.workers.append(worker)
+        self.last_scaling_time = time.time()
+        self.last_utilization_check = (time.time(), self._get_total_busy_time())
+
+    def remove_worker(self):
+        """Asks the newest worker to stop once it's finished its current batch."""
+        worker = self.workers.pop()
+        worker.kwargs["should_stop"].set()
+        worker.process.join(timeout=MANAGER_CHECK_INTERVAL)
+        if worker.is_alive():
+            logger.warning(f"{worker.name} didn't stop in time; killing it.")
+            worker.kill()
+        self.retired_stats = combine_snapshots(
+            [self.retired_stats, worker.kwargs["stats"].snapshot()]
+        )
+        self.last_scaling_time = time.time()
+        self.last_utilization_check = (time.time(), self._get_total_busy_time())
+
     def _print_ops_per_second(self):
         """Prints the total number of ops/second."""
         current_time, current_op_count = time.time(), self.op_count.value
@@ -113,16 +403,56 @@ class FirehoseProcessingManager:
         logger.info(
             f"Running at {ops_elapsed / time_elapsed:.2f} ops/sec "
             f"| Total: {current_op_count:.2e} ops "
-            f"| Commits in queue: {self.queue.qsize()}"
+            f"| Commits in queue: {self.queue.qsize()} "
+            f"| Workers: {len(self.workers)}"
         )
 
         self.last_check_time, self.last_op_count = current_time, current_op_count
 
 
+def get_target_worker_count(
+    worker_count: int, queue_size: int, lag: int, utilization: float
+) -> int:
+    """Decides how many commit processors there should be, moving by at most one at a
+    time and staying within MIN_WORKER_COUNT and MAX_WORKER_COUNT.
+    """
+    if (
+        queue_size > SCALE_UP_QUEUE_SIZE
+        or lag > SCALE_UP_LAG
+        or utilization > SCALE_UP_UTILIZATION
+    ):
+        worker_count += 1
+    elif (
+        queue_size < SCALE_DOWN_QUEUE_SIZE
+        and lag < SCALE_DOWN_LAG
+        and utilization < SCALE_DOWN_UTILIZATION
+    ):
+        worker_count -= 1
+    return min(max(worker_count, MIN_WORKER_COUNT), MAX_WORKER_COUNT)
+
+
+def _get_metrics_port(process_index: int) -> int | None:
+    """Each process serves its own metrics, so they each get their own port, starting
+    from ASTROFEED_METRICS_PORT for the firehose client.
+    """
+    if METRICS_PORT is None:
+        return None
+    return METRICS_PORT + process_index
+
+
+def _start_metrics_server(metrics_port: int | None):
+    if metrics_port is None:
+        return
+    from astrofeed_lib.metrics import serve_metrics_in_background
+
+    serve_metrics_in_background(metrics_port)
+
+
 def _run_firehose_client(
     queue: Queue,
     cursor: Synchronized,  # Return value of multiprocessing.Value
     firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    metrics_port: int | None = None,
     **kwargs,
 ):
     """Entry point for the firehose client subprocess.
@@ -132,6 +462,8 @@ def _run_firehose_client(
     """
     from astrofeed_firehose.firehose_client import run_client
 
+    _start_metrics_server(metrics_port)
+
     try:
         run_client(queue, cursor, firehose_time, **kwargs)
     except Exception as e:
@@ -141,10 +473,53 @@ def _run_firehose_client(
         raise e
 
 
+def _run_jetstream_client(
+    queue: Queue,
+    cursor: Synchronized,  # Return value of multiprocessing.Value
+    firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    metrics_port: int | None = None,
+    **kwargs,
+):
+    """Entry point for the Jetstream client subprocess, which takes the place of the
+    firehose client when FIREHOSE_SOURCE is jetstream.
+    """
+    from astrofeed_firehose.jetstream import run_jetstream_client
+
+    _start_metrics_server(metrics_port)
+
+    try:
+        run_jetstream_client(queue, cursor, firehose_time, **kwargs)
+    except Exception as e:
+        logger.critical(
+            "Critical exception when running Jetstream client", exc_info=True
+        )
+        raise e
+
+
+def _run_capture_replayer(
+    queue: Queue,
+    cursor: Synchronized,  # Return value of multiprocessing.Value
+    firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    path: str = "",
+    frames_replayed: Synchronized | None = None,
+):
+    """Entry point for the capture replayer subprocess, which takes the place of the
+    firehose client when replaying a capture file.
+    """
+    from astrofeed_firehose.replay import run_replayer
+
+    try:
+        run_replayer(queue, path, firehose_time, frames_replayed)
+    except Exception as e:
+        logger.critical("Critical exception when replaying capture", exc_info=True)
+        raise e
+
+
 def _run_commit_processor(
     queue: Queue,
     cursor: Synchronized,  # Return value of multiprocessing.Value
     firehose_time: Synchronized,  # Return value of multiprocessing.Value
+    metrics_port: int | None = None,
     **kwargs,
 ):
     """Entry point for the commit processor subprocesses.
@@ -154,6 +529,14 @@ def _run_commit_processor(
     """
     from astrofeed_firehose.commit_processor import run_commit_processor
 
+    _start_metrics_server(metrics_port)
+    if PROFILE_DIRECTORY is not None:
+        from multiprocessing import current_process
+
+        from astrofeed_firehose.profiling import start_profiling
+
+        start_profiling(current_process().name, PROFILE_DIRECTORY)
+
     try:
         run_commit_processor(queue, cursor, firehose_time, **kwargs)
     except Exception as e:
@@ -161,3 +544,39 @@ def _run_commit_processor(
             "Critical exception when running commit processor", exc_info=True
         )
         raise e
+
+
+def _run_account_publisher(
+    path: str,
+    version: Synchronized,  # Return value of multiprocessing.Value
+    process_time: Synchronized,  # Return value of multiprocessing.Value
+):
+    """Entry point for the account publisher subprocess, which keeps the set of valid
+    accounts shared with the commit processors up to date.
+    """
+    from astrofeed_firehose.shared_accounts import run_account_publisher
+
+    try:
+        run_account_publisher(path, version, process_time)
+    except Exception as e:
+        logger.critical(
+            "Critical exception when running account publisher", exc_info=True
+        )
+        raise e
+
+
+def _run_top_feed_ranker(
+    process_time: Synchronized,  # Return value of multiprocessing.Value
+):
+    """Entry point for the top feed ranker subprocess, which periodically recomputes the
+    "top of the day" feeds from the likes counted by the commit processors.
+    """
+    from astrofeed_firehose.likes import run_top_feed_ranker
+
+    try:
+        run_top_feed_ranker(process_time)
+    except Exception as e:
+        logger.critical(
+            "Critical exception when running top feed ranker", exc_info=True
+        )
+        raise e
@@ -0,0 +1,184 @@
+"""Throughput and lag metrics for the whole firehose, served by the manager.
+
+Every process also serves metrics of its own (like database query timings) if
+ASTROFEED_METRICS_PORT is set, but only the manager can see the firehose as a whole: how
+quickly commits arrive and are processed, how far behind the workers are, and what they
+spend their time on. Workers report this through shared memory (see
+astrofeed_firehose.worker_stats), which the manager reads whenever it's scraped.
+"""
+
+import time
+from threading import Lock
+from typing import TYPE_CHECKING
+
+from astrofeed_firehose.worker_stats import (
+    FEEDS,
+    STAGES,
+    TRACE_BUCKETS,
+    TRACE_STAGES,
+    combine_snapshots,
+)
+from astrofeed_lib.metrics import MetricsRegistry, serve_metrics_in_background
+
+if TYPE_CHECKING:
+    from astrofeed_firehose.manager import FirehoseProcessingManager
+
+
+class FirehoseMetrics:
+    def __init__(self, manager: "FirehoseProcessingManager"):
+        """Metrics of a FirehoseProcessingManager and its processes. These are kept in a
+        registry of their own, so that they aren't copied into forked child processes.
+
+        Totals are read from shared memory when rendered, while rates are worked out
+        each time update_rates is called (by FirehoseProcessingManager.monitor.)
+        """
+        self.manager = manager
+        self.registry = MetricsRegistry()
+        registry = self.registry
+
+        self.commits = registry.counter(
+            "firehose_commits_total",
+            "Commits received from the relay and processed by workers.",
+            labelnames=("stage",),
+        )
+        self.commits_per_second = registry.gauge(
+            "firehose_commits_per_second",
+            "Commits received and processed per second over the last monitor interval.",
+            labelnames=("stage",),
+        )
+        self.queue_commits = registry.gauge(
+            "firehose_queue_commits", "Commits waiting in the queue for a worker."
+        )
+        self.queue_bytes = registry.gauge(
+            "firehose_queue_bytes", "Size of the commits waiting in the queue."
+        )
+        self.workers = registry.gauge(
+            "firehose_workers", "Number of running commit processors."
+        )
+        self.busy_fraction = registry.gauge(
+            "firehose_worker_busy_fraction",
+            "Fraction of the last monitor interval that each worker spent processing "
+            "commits.",
+            labelnames=("worker",),
+        )
+        self.stage_seconds = registry.counter(
+            "firehose_stage_seconds_total",
+            "Time spent by all workers in each stage of commit processing.",
+            labelnames=("stage",),
+        )
+        self.traced_commits = registry.histogram(
+            "firehose_traced_commit_seconds",
+            "Time that a sample of commits spent in each stage of processing, and in "
+            "total.",
+            labelnames=("stage",),
+            buckets=TRACE_BUCKETS,
+        )
+        self.posts = registry.counter(
+            "firehose_posts_total",
+            "Posts inserted into and deleted from each feed.",
+            labelnames=("feed", "action"),
+        )
+        self.relay_lag = registry.gauge(
+            "firehose_relay_lag_seconds",
+            "Time since the relay sent the latest commit that's been processed.",
+        )
+        self.seq = registry.gauge(
+            "firehose_seq",
+            "Sequence number of the latest commit received, the latest processed, and "
+            "the cursor last saved to the database.",
+            labelnames=("position",),
+        )
+        self.lag = registry.gauge(
+            "firehose_lag_commits",
+            "Number of commits that workers are behind the latest commit received.",
+        )
+
+        self.last_rate_check: tuple[float, float, float] = (time.time(), 0.0, 0.0)
+        self.last_busy_times: dict[str, float] = {}
+        self.lock = Lock()
+
+    def _get_stats(self) -> dict[str, float]:
+        """Stats of every worker, including ones that have since been removed."""
+        return combine_snapshots(
+            [self.manager.retired_stats]
+            + [worker.kwargs["stats"].snapshot() for worker in self.manager.workers]
+        )
+
+    def _set_total(self, counter, value: float, **labels):
+        counter.inc(max(value - counter.get(**labels), 0.0), **labels)
+
+    def update(self):
+        """Updates every metric read straight from shared memory."""
+        manager, stats = self.manager, self._get_stats()
+
+        self._set_total(self.commits, manager.received_count.value, stage="received")
+        self._set_total(self.commits, stats["commits"], stage="processed")
+        for stage in STAGES:
+            self._set_total(self.stage_seconds, stats[f"{stage}_time"], stage=stage)
+        if stats["traced_commits"]:
+            for stage in TRACE_STAGES:
+                self.traced_commits.set(
+                    [
+                        int(stats[f"trace_{stage}_{bucket}"])
+                        for bucket in range(len(TRACE_BUCKETS) + 1)
+                    ],
+                    stats[f"trace_{stage}_sum"],
+                    stage=stage,
+                )
+        for feed in FEEDS:
+            for action in ("inserted", "deleted"):
+                self._set_total(
+                    self.posts, stats[f"{action}_{feed}"], feed=feed, action=action
+                )
+
+        self.queue_commits.set(manager.queue.qsize())
+        self.queue_bytes.set(manager.queue.data_size())
+        self.workers.set(len(manager.workers))
+
+        if stats["latest_commit_time"]:
+            self.relay_lag.set(time.time() - stats["latest_commit_time"])
+        received, processed = manager.received_seq.value, manager.processed_seq.value
+        self.seq.set(received, position="received")
+        self.seq.set(processed, position="processed")
+        self.seq.set(stats["saved_cursor"], position="saved_cursor")
+        self.lag.set(max(received - processed, 0))
+
+    def update_rates(self):
+        """Works out commits per second and how busy each worker has been since this
+        was last called.
+        """
+        stats = self._get_stats()
+        current_time = time.time()
+        received, processed = self.manager.received_count.value, stats["commits"]
+        last_time, last_received, last_processed = self.last_rate_check
+        self.last_rate_check = (current_time, received, processed)
+
+        elapsed = current_time - last_time
+        if elapsed <= 0:
+            return
+        self.commits_per_second.set(
+            max(received - last_received, 0) / elapsed, stage="received"
+        )
+        self.commits_per_second.set(
+            max(processed - last_processed, 0) / elapsed, stage="processed"
+        )
+
+        busy_times = {
+            worker.name: worker.kwargs["stats"].get("busy_time")
+            for worker in self.manager.workers
+        }
+        self.busy_fraction.clear()  # Forget any workers that have been removed
+        for name, busy_time in busy_times.items():
+            busy = busy_time - self.last_busy_times.get(name, busy_time)
+            self.busy_fraction.set(min(max(busy / elapsed, 0.0), 1.0), worker=name)
+        self.last_busy_times = busy_times
+
+    def render(self) -> str:
+        # Totals are increased by how much they've changed, so scrapes mustn't overlap
+        with self.lock:
+            self.update()
+            return self.registry.render()
+
+    def serve(self, port: int):
+        """Serves these metrics at http://127.0.0.1:port/metrics."""
+        return serve_metrics_in_background(port, render=self.render)
@@ -0,0 +1,220 @@
+"""Writing the posts that commit processors find to the database in batches.
+
+Only a few commits in a hundred have anything to do with our posts, so writing each one
+as it comes means lots of tiny transactions. Instead, each commit processor collects
+the (already classified) posts to create, edit and delete in a PostWriter, across as
+many reads from the queue as it takes to have POST_BATCH_SIZE of them, or until the
+oldest has waited for POST_LATENCY_TARGET seconds. They're then written in one
+transaction, with one query per kind of operation. The latency target keeps the feeds
+fresh when the firehose is quiet, while the size limit keeps transactions short when
+it's busy.
+"""
+
+import time
+from typing import Iterable
+
+import peewee
+
+from astrofeed_firehose.config import POST_BATCH_SIZE, POST_LATENCY_TARGET
+from astrofeed_firehose.worker_stats import FEEDS, STATS
+from astrofeed_lib import logger
+from astrofeed_lib.database import DBConnection, Post
+
+# Maximum number of values in one IN (...) clause or INSERT
+_CHUNK_SIZE = 500
+
+
+class PostWriter:
+    def __init__(
+        self,
+        batch_size: int = POST_BATCH_SIZE,
+        latency_target: float = POST_LATENCY_TARGET,
+    ):
+        """Collects posts to create, edit and delete, and writes them to the database
+        in one transaction once there are batch_size of them, or once the oldest has
+        waited latency_target seconds (see flush_if_due.)
+        """
+        self.batch_size = batch_size
+        self.latency_target = latency_target
+
+        # Posts by URI (in the order they arrived), and URIs of deleted posts
+        self.created: dict[str, dict] = {}
+        self.updated: dict[str, dict] = {}
+        self.deleted: set[str] = set()
+
+        # When the oldest waiting operation arrived, and the cursor of the latest
+        self.first_added_time: float | None = None
+        self.cursor: int | None = None
+
+        # Whether the waiting posts already failed to be written once
+        self.retrying = False
+
+    def __len__(self) -> int:
+        return len(self.created) + len(self.updated) + len(self.deleted)
+
+    def add(
+        self,
+        cursor: int,
+        created: Iterable[dict] = (),
+        updated: Iterable[dict] = (),
+        deleted: Iterable[str] = (),
+    ) -> None:
+        """Adds classified posts to create and edit, and the URIs of posts to delete,
+        from a commit with the given cursor.
+        """
+        for post in created:
+            self.created[post["uri"]] = post
+        for post in updated:
+            # Edits of posts that haven't been written yet can just replace them
+            if post["uri"] in self.created:
+                self.created[post["uri"]] = post
+            else:
+                self.updated[post["uri"]] = post
+        for uri in deleted:
+            # The post may also be in the database already (e.g. if it was replayed), so
+            # it's still deleted from there
+            self.created.pop(uri, None)
+            self.updated.pop(uri, None)
+            self.deleted.add(uri)
+
+        if self.first_added_time is None and len(self) > 0:
+            self.first_added_time = time.monotonic()
+        self.cursor = cursor
+
+    def time_until_due(self) -> float | None:
+        """Seconds until the waiting posts are due to be written, or None if there are
+        none.
+        """
+        if self.first_added_time is None:
+            return None
+        waited = time.monotonic() - self.first_added_time
+        return max(self.latency_target - waited, 0.0)
+
+    def flush_if_due(self) -> None:
+        if len(self) < self.batch_size and self.time_until_due() != 0.0:
+            return
+        try:
+            self.flush()
+        except Exception:
+            # A failed batch is tried once more (see flush), but isn't worth stopping
+            # the commit processor over
+            logger.exception("Unable to write posts to the database.")
+
+    def flush(self) -> None:
+        """Writes every waiting post to the database in one transaction. If that fails,
+        the posts wait to be written again with the next batch, unless they already
+        failed once before.
+        """
+        created, updated, deleted = self.created, self.updated, self.deleted
+        cursor = self.cursor
+        self.created, self.updated, self.deleted = {}, {}, set()
+        self.first_added_time = None
+        if not created and not updated and not deleted:
+            return
+
+        try:
+            with STATS.timer("database"), DBConnection() as db, db.atomic():
+                _delete_posts(cursor, list(deleted))
+                _create_posts(cursor, list(created.values()))
+                _update_posts(cursor, list(updated.values()))
+        except Exception:
+            if self.retrying:
+                self.retrying = False
+                count = len(created) + len(updated) + len(deleted)
+                logger.error(f"Unable to write {count} posts twice; skipping them.")
+            else:
+                self.retrying = True
+                self.created, self.updated, self.deleted = created, updated, deleted
+                self.first_added_time = time.monotonic()
+            raise
+        self.retrying = False
+
+
+def _create_posts(cursor: int | None, posts_to_create_classified: list[dict]):
+    """Adds posts to the database."""
+    if not posts_to_create_classified:
+        return
+
+    # Remove duplicate posts (which the firehose may replay after a restart)
+    initial_length = len(posts_to_create_classified)
+    existing_posts = set()
+    for batch in peewee.chunked(
+        [post["uri"] for post in posts_to_create_classified], _CHUNK_SIZE
+    ):
+        query = Post.select(Post.uri).where(Post.uri.in_(batch))
+        existing_posts.update(uri for (uri,) in query.tuples())
+    posts_to_create_classified = [
+        post for post in posts_to_create_classified if post["uri"] not in existing_posts
+    ]
+    if (current_length := len(posts_to_create_classified)) != initial_length:
+        logger.info(f"Ignored duplicate posts: {initial_length - current_length}")
+
+    if not posts_to_create_classified:
+        return
+
+    # Add the posts
+    for batch in peewee.chunked(posts_to_create_classified, _CHUNK_SIZE):
+        Post.insert_many(batch).execute()
+    STATS.count_posts("inserted", posts_to_create_classified)
+
+    feed_counts = {
+        f"feed_{feed}": sum(
+            bool(post.get(f"feed_{feed}")) for post in posts_to_create_classified
+        )
+        for feed in FEEDS
+    }
+    feed_counts_string = ", ".join(
+        [f"{key[5:]}-{value}" for key, value in feed_counts.items() if value > 0]
+    )
+    logger.info(f"Added posts: {feed_counts_string} (cursor={cursor})")
+
+
+def _delete_posts(cursor: int | None, posts_to_delete: list[str]):
+    """Removes posts from the database."""
+    if not posts_to_delete:
+        return
+
+    # Count which feeds the posts were in before they go
+    feed_columns = [getattr(Post, f"feed_{feed}") for feed in FEEDS]
+    for batch in peewee.chunked(posts_to_delete, _CHUNK_SIZE):
+        STATS.count_posts(
+            "deleted",
+            Post.select(*feed_columns).where(Post.uri.in_(batch)).dicts(),
+        )
+        Post.delete().where(Post.uri.in_(batch)).execute()  # type: ignore (pylance is wrong)
+    logger.info(f"Deleted posts: {len(posts_to_delete)} (cursor={cursor})")
+
+
+def _update_posts(cursor: int | None, posts_to_update_classified: list[dict]):
+    """Updates the text and feed labels of posts that have been edited, if they've
+    changed. Every changed post is updated in one query (per _CHUNK_SIZE posts.)
+    """
+    if not posts_to_update_classified:
+        return
+
+    fields = [Post.text] + [getattr(Post, f"feed_{feed}") for feed in FEEDS]
+    new_posts = {post["uri"]: post for post in posts_to_update_classified}
+
+    # Posts that we don't have (e.g. from before the author signed up) are ignored
+    changed_posts = []
+    for batch in peewee.chunked(list(new_posts), _CHUNK_SIZE):
+        query = Post.select(Post.uri, *fields).where(Post.uri.in_(batch))
+        changed_posts.extend(
+            new_posts[uri]
+            for uri, *values in query.tuples()
+            if values != [new_posts[uri][field.name] for field in fields]
+        )
+    if not changed_posts:
+        return
+
+    for batch in peewee.chunked(changed_posts, _CHUNK_SIZE):
+        new_values = {
+            field: peewee.Case(
+                Post.uri, [(post["uri"], post[field.name]) for post in batch]
+            )
+            for field in fields + [Post.cid]
+        }
+        Post.update(new_values).where(
+            Post.uri.in_([post["uri"] for post in batch])
+        ).execute()
+    logger.info(f"Updated posts: {len(changed_posts)} (cursor={cursor})")
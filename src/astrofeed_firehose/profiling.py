@@ -0,0 +1,84 @@
+"""Opt-in profiling of the commit processors with cProfile.
+
+When FIREHOSE_PROFILE_DIRECTORY is set, every commit processor runs under cProfile for
+as long as it's alive. Sending SIGUSR1 to the manager (e.g. `kill -USR1 <pid>`) has it
+pass the signal on to each commit processor, which writes a snapshot of its profile so
+far to the directory. Once they've had time to do so, the manager combines them into one
+profile of all the workers, which can be read with `python -m pstats <path>` (or e.g.
+snakeviz.)
+
+cProfile slows the workers down noticeably, so this is for finding out where the time
+goes rather than for leaving on. The per-stage timings that the manager serves as
+metrics (see astrofeed_firehose.worker_stats) are always on.
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import signal
+from datetime import datetime
+
+from astrofeed_lib import logger
+
+PROFILE_SIGNAL = signal.SIGUSR1
+
+_PREFIX = "astrofeed-firehose-profile-"
+_COMBINED = "combined"
+
+
+def start_profiling(name: str, directory: str) -> cProfile.Profile:
+    """Profiles this process from now on, writing a snapshot of the profile to
+    directory whenever it receives PROFILE_SIGNAL. Snapshot files are named after the
+    process's name.
+    """
+    profiler = cProfile.Profile()
+    slug = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+
+    def write_snapshot(signum, frame):
+        path = os.path.join(
+            directory, f"{_PREFIX}{slug}-{os.getpid()}-{_timestamp()}.prof"
+        )
+        profiler.disable()
+        try:
+            profiler.dump_stats(path)
+        finally:
+            profiler.enable()
+        logger.info(f"Wrote profile to {path}")
+
+    signal.signal(PROFILE_SIGNAL, write_snapshot)
+    profiler.enable()
+    return profiler
+
+
+def request_snapshots(pids: list[int]) -> None:
+    """Asks each of the processes to write a snapshot of its profile."""
+    for pid in pids:
+        try:
+            os.kill(pid, PROFILE_SIGNAL)
+        except ProcessLookupError:
+            pass
+
+
+def combine_profiles(directory: str, since: float) -> str | None:
+    """Combines every snapshot written to directory since the given time into one
+    profile, returning its path (or None if there weren't any.)
+    """
+    paths = [
+        entry.path
+        for entry in os.scandir(directory)
+        if entry.name.startswith(_PREFIX)
+        and not entry.name.startswith(_PREFIX + _COMBINED)
+        and entry.name.endswith(".prof")
+        and entry.stat().st_mtime >= since
+    ]
+    if not paths:
+        return None
+
+    path = os.path.join(directory, f"{_PREFIX}{_COMBINED}-{_timestamp()}.prof")
+    pstats.Stats(*sorted(paths)).dump_stats(path)
+    return path
+
+
+def _timestamp() -> str:
+    return datetime.now().strftime("%Y%m%d-%H%M%S-%f")
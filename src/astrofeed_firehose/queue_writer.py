@@ -0,0 +1,187 @@
+"""Sending commits from the firehose client to the commit processors, without ever
+blocking the client's event loop.
+
+When the commit processors fall behind, the queue between them and the client fills up.
+Waiting for space in it would stop the client from reading from the relay, which
+disconnects clients that fall behind (ConsumerTooSlow.) Instead, the client hands
+commits to a QueueWriter, which puts them on the queue from a thread of its own.
+Commits that the queue can't take yet wait in a bounded buffer in memory, and then (if
+that fills up too) in overflow files on disk, which are sent on in order once the
+queue has space again. Overflow files use the capture file format (see
+astrofeed_firehose.capture), and are deleted once they've been sent.
+"""
+
+import itertools
+import os
+import time
+from collections import deque
+from queue import Full
+from threading import Condition, Thread
+
+from atproto import firehose_models
+from faster_fifo import Queue
+
+from astrofeed_firehose.capture import CaptureWriter, read_capture
+from astrofeed_firehose.config import (
+    CLIENT_BUFFER_SIZE,
+    COMMITS_TO_ADD_AT_ONCE,
+    FULL_QUEUE_SLEEP_TIME,
+    OVERFLOW_DIRECTORY,
+)
+from astrofeed_lib import logger
+from astrofeed_lib.metrics import METRICS
+
+# How often to warn that the client is waiting for space, if it has no overflow files
+FULL_QUEUE_WARNING_INTERVAL = 60
+
+FIREHOSE_BUFFERED_COMMITS = METRICS.gauge(
+    "firehose_client_buffered_commits",
+    "Commits received by the firehose client that are waiting for space in the queue.",
+    labelnames=("location",),
+)
+FIREHOSE_OVERFLOWED_COMMITS = METRICS.counter(
+    "firehose_client_overflowed_commits_total",
+    "Commits that the firehose client had to write to disk because its buffer was full.",
+)
+
+
+class QueueWriter:
+    def __init__(
+        self,
+        queue: Queue,
+        buffer_size: int = CLIENT_BUFFER_SIZE,
+        overflow_directory: str | None = OVERFLOW_DIRECTORY,
+    ):
+        """Puts commits on queue from a background thread. Up to buffer_size commits
+        wait in memory for space in the queue; after that, they're written to files in
+        overflow_directory. If overflow_directory is None, put waits for space in the
+        buffer instead.
+        """
+        self.queue = queue
+        self.buffer: deque = deque()
+        self.buffer_size = buffer_size
+        self.overflow_directory = overflow_directory
+
+        # The overflow file being written to, and those waiting to be sent (oldest first)
+        self.overflow: CaptureWriter | None = None
+        self.overflow_files: deque[str] = deque()
+        self.overflow_numbers = itertools.count()
+        self.commits_on_disk = 0
+
+        self.condition = Condition()
+        self.error: Exception | None = None
+        self.last_full_warning = 0.0
+        self.thread = Thread(target=self._run, name="Queue writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, message: firehose_models.MessageFrame | str) -> None:
+        """Hands a commit to the writer thread."""
+        if self.error is not None:
+            raise RuntimeError("Queue writer thread stopped.") from self.error
+
+        with self.condition:
+            if self.overflow is None and len(self.buffer) < self.buffer_size:
+                self.buffer.append(message)
+                self.condition.notify_all()
+                return
+
+            if self.overflow_directory is None:
+                if time.time() - self.last_full_warning > FULL_QUEUE_WARNING_INTERVAL:
+                    logger.warning("Queue is full! Waiting for space in the buffer.")
+                    self.last_full_warning = time.time()
+                while len(self.buffer) >= self.buffer_size and self.error is None:
+                    self.condition.wait(timeout=1.0)
+                self.buffer.append(message)
+                self.condition.notify_all()
+                return
+
+            # Once anything is on disk, later commits go there too, to keep them in order
+            if self.overflow is None:
+                path = os.path.join(
+                    self.overflow_directory,
+                    f"astrofeed-firehose-overflow-{os.getpid()}-"
+                    f"{next(self.overflow_numbers)}.bin",
+                )
+                logger.warning(f"Queue is full! Writing commits to {path}")
+                self.overflow = CaptureWriter(path)
+            if isinstance(message, str):
+                # A Jetstream event (which can't be mistaken for a frame, as a frame
+                # always starts with a DAG-CBOR map)
+                self.overflow.write_raw(message.encode())
+            else:
+                self.overflow.write(message)
+            self.commits_on_disk += 1
+            FIREHOSE_BUFFERED_COMMITS.set(self.commits_on_disk, location="disk")
+        FIREHOSE_OVERFLOWED_COMMITS.inc()
+
+    def _run(self):
+        try:
+            while True:
+                self._send_next()
+        except Exception as e:
+            logger.critical("Queue writer thread stopped!", exc_info=True)
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def _send_next(self):
+        """Sends the oldest commits waiting to be sent, waiting for some if there are
+        none.
+        """
+        batch, path = [], None
+        with self.condition:
+            while not self.buffer and not self.overflow_files and self.overflow is None:
+                self.condition.wait()
+
+            # Overflow files that have been closed are older than anything in memory
+            if self.overflow_files:
+                path = self.overflow_files.popleft()
+            elif self.buffer:
+                for _ in range(min(len(self.buffer), COMMITS_TO_ADD_AT_ONCE)):
+                    batch.append(self.buffer.popleft())
+                self.condition.notify_all()
+            else:
+                # Everything older than the current overflow file has been sent, so it
+                # can be closed and sent, and new commits can go in memory again
+                self.overflow.close()
+                self.overflow_files.append(self.overflow.path)
+                self.overflow = None
+            FIREHOSE_BUFFERED_COMMITS.set(len(self.buffer), location="memory")
+
+        if batch:
+            self._put(batch)
+        elif path is not None:
+            self._send_overflow_file(path)
+
+    def _send_overflow_file(self, path: str):
+        # Commits are sent still encoded, like replayed captures
+        batch = []
+        for frame in read_capture(path):
+            if frame[:1] == b"{":
+                batch.append(str(frame, "utf-8"))
+            else:
+                batch.append(bytes(frame))
+            if len(batch) >= COMMITS_TO_ADD_AT_ONCE:
+                self._put(batch)
+                self._forget_commits_on_disk(len(batch))
+                batch = []
+        self._put(batch)
+        self._forget_commits_on_disk(len(batch))
+        os.remove(path)
+        logger.info(f"Finished sending commits from {path}")
+
+    def _forget_commits_on_disk(self, count: int):
+        with self.condition:
+            self.commits_on_disk -= count
+            FIREHOSE_BUFFERED_COMMITS.set(self.commits_on_disk, location="disk")
+
+    def _put(self, batch: list):
+        """Puts a batch of commits on the queue, waiting for space if it's full."""
+        while batch:
+            try:
+                self.queue.put_many(batch, timeout=1.0)
+                return
+            except Full:
+                time.sleep(FULL_QUEUE_SLEEP_TIME)
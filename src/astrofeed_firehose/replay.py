@@ -0,0 +1,134 @@
+"""Replays a firehose capture file (see astrofeed_firehose.capture) through the commit
+processors, as fast as they can process it, and reports how many commits per second
+they sustained. This is both an offline throughput benchmark and a way to rebuild posts
+from an archived capture.
+
+Usage: python -m astrofeed_firehose.replay CAPTURE_FILE
+
+N.B.: like the live firehose, this writes posts and the cursor to the database set by
+BLUESKY_DATABASE, so stop the live firehose first. Afterwards, it will resume from the
+end of the capture.
+"""
+
+import argparse
+import time
+from multiprocessing.sharedctypes import Synchronized
+from queue import Full
+
+from faster_fifo import Queue
+
+from astrofeed_firehose.capture import read_capture
+from astrofeed_firehose.config import (
+    COMMITS_TO_ADD_AT_ONCE,
+    FULL_QUEUE_SLEEP_TIME,
+    MANAGER_CHECK_INTERVAL,
+    WORKER_START_METHOD,
+)
+from astrofeed_firehose.manager import FirehoseProcessingManager
+from astrofeed_lib import logger
+
+# How often to check on progress while replaying, and to log it (in seconds)
+REPLAY_CHECK_INTERVAL = 0.1
+REPLAY_LOG_INTERVAL = 10.0
+
+
+def run_replayer(
+    queue: Queue,
+    path: str,
+    process_time: Synchronized,  # Return value of multiprocessing.Value
+    frames_replayed: Synchronized | None = None,
+) -> int:
+    """Sends every frame in a capture file to the commit processors, still encoded (so
+    that decoding is spread across the processors.) Returns the number of frames sent.
+    """
+    logger.info(f"... replaying capture {path}")
+    count, batch = 0, []
+    for frame in read_capture(path):
+        batch.append(bytes(frame))
+        if len(batch) >= COMMITS_TO_ADD_AT_ONCE:
+            count += _put_batch(queue, batch, process_time, frames_replayed)
+    count += _put_batch(queue, batch, process_time, frames_replayed)
+    logger.info(f"Finished replaying {count} frames")
+    return count
+
+
+def _put_batch(
+    queue: Queue,
+    batch: list[bytes],
+    process_time: Synchronized,
+    frames_replayed: Synchronized | None,
+) -> int:
+    """Puts a batch of frames on the queue, waiting for space if it's full."""
+    size = len(batch)
+    while batch:
+        try:
+            queue.put_many(batch, timeout=1.0)
+            batch.clear()
+        except Full:
+            time.sleep(FULL_QUEUE_SLEEP_TIME)
+        process_time.value = time.time()
+
+    if frames_replayed is not None:
+        frames_replayed.value += size
+    return size
+
+
+def replay(path: str, worker_start_method: str = WORKER_START_METHOD) -> float:
+    """Replays a capture file through a FirehoseProcessingManager, returning the
+    sustained rate of processing in commits per second.
+    """
+    manager = FirehoseProcessingManager(
+        replay_path=path, worker_start_method=worker_start_method
+    )
+    replayer, other_processes = manager.client, manager.workers + manager.services
+    manager.start_processes()
+
+    try:
+        start_time, last_log_time = None, time.time()
+        while (
+            replayer.is_alive()
+            or manager.op_count.value < manager.frames_replayed.value
+        ):
+            time.sleep(REPLAY_CHECK_INTERVAL)
+            if start_time is None and manager.op_count.value > 0:
+                start_time = time.time()
+
+            if replayer.process.exitcode not in (None, 0):
+                raise RuntimeError("Capture replayer failed.")
+            dead_processes = [p.name for p in other_processes if not p.is_alive()]
+            if dead_processes:
+                raise RuntimeError(f"Processes died: {', '.join(dead_processes)}")
+
+            if time.time() - last_log_time > REPLAY_LOG_INTERVAL:
+                logger.info(
+                    f"Processed {manager.op_count.value} of "
+                    f"{manager.frames_replayed.value} replayed commits"
+                )
+                last_log_time = time.time()
+        end_time = time.time()
+
+        # Workers hold on to posts for a little while before writing them, so they're
+        # asked to stop (and write them) rather than being killed
+        for worker in manager.workers:
+            worker.kwargs["should_stop"].set()
+        for worker in manager.workers:
+            worker.process.join(timeout=MANAGER_CHECK_INTERVAL)
+    finally:
+        manager.stop_processes()
+
+    commits = manager.op_count.value
+    elapsed = end_time - start_time if start_time is not None else 0.0
+    commits_per_second = commits / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        f"Replayed {commits} commits in {elapsed:.1f}s "
+        f"({commits_per_second:.0f} commits/sec)"
+    )
+    return commits_per_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a firehose capture file through the commit processors."
+    )
+    parser.add_argument("path", help="capture file to replay")
+    replay(parser.parse_args().path)
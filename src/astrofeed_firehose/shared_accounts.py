@@ -0,0 +1,133 @@
+"""A compact set of valid accounts that's built once by the manager and shared with
+every commit processor, instead of each processor querying and holding its own copy.
+
+The set is stored as a sorted array of 64-bit DID hashes in a file (in shared memory
+where possible.) Each commit processor memory-maps it and checks DIDs with a binary
+search. When the accounts change, the file is written again under a temporary name and
+moved into place, which atomically swaps the mapping: processors that still have the
+old file mapped keep using it until they notice the new version.
+"""
+
+import mmap
+import os
+import time
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from multiprocessing.sharedctypes import Synchronized
+from typing import Iterable
+
+from astrofeed_firehose.config import ACCOUNT_PUBLISH_INTERVAL
+from astrofeed_lib import logger
+
+
+def hash_did(did: str) -> int:
+    """Returns a 64-bit hash of a DID that's the same in every process (unlike hash().)
+
+    With ~10^5 accounts, the chance of any other DID colliding with one of them is
+    ~10^-14, and the only consequence would be one extra post in the database.
+    """
+    return int.from_bytes(blake2b(did.encode(), digest_size=8).digest(), "little")
+
+
+def write_account_hashes(path: str, dids: Iterable[str]) -> int:
+    """Atomically replaces the file at path with a sorted array of DID hashes. Returns
+    the number of hashes written.
+    """
+    hashes = array("Q", sorted({hash_did(did) for did in dids}))
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        hashes.tofile(file)
+    os.replace(temporary_path, path)
+    return len(hashes)
+
+
+class SharedAccountSet:
+    def __init__(self, path: str, version: Synchronized):
+        """Read-only view of the account set published at path. version is a shared
+        counter that the publisher increments every time it replaces the file; 0 means
+        that nothing has been published yet.
+
+        Has the same get_accounts() method as astrofeed_lib.accounts.AccountQuery, so
+        it can be used in place of one.
+        """
+        self.path = path
+        self.version = version
+        self.loaded_version: int | None = None
+        self.hashes = memoryview(array("Q"))
+        self._mmap: mmap.mmap | None = None
+
+    def __reduce__(self):
+        # Only the path and version are sent to processes that aren't forked (the file
+        # is mapped again when it's first read)
+        return SharedAccountSet, (self.path, self.version)
+
+    def get_accounts(self) -> "SharedAccountSet":
+        if self.version.value != self.loaded_version:
+            self._load()
+        return self
+
+    def __contains__(self, did: str) -> bool:
+        hashed_did = hash_did(did)
+        index = bisect_left(self.hashes, hashed_did)
+        return index < len(self.hashes) and self.hashes[index] == hashed_did
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def _load(self) -> None:
+        if self.version.value == 0:
+            logger.info("Waiting for the set of valid accounts to be published...")
+            while self.version.value == 0:
+                time.sleep(0.1)
+
+        # Read the version first, so that if the file changes while we load it, we just
+        # load it again next time
+        version = self.version.value
+        with open(self.path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            # (Empty files can't be memory-mapped)
+            new_mmap = None
+            if size > 0:
+                new_mmap = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+
+        self.close()
+        self._mmap = new_mmap
+        if new_mmap is not None:
+            self.hashes = memoryview(new_mmap).cast("Q")
+        self.loaded_version = version
+
+    def close(self) -> None:
+        self.hashes.release()
+        self.hashes = memoryview(array("Q"))
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def run_account_publisher(
+    path: str,
+    version: Synchronized,  # Return value of multiprocessing.Value
+    process_time: Synchronized,  # Return value of multiprocessing.Value
+) -> None:
+    """Keeps the set of valid accounts at path up to date for all commit processors."""
+    from astrofeed_lib.accounts import CachedAccountQuery
+
+    logger.info("... account publisher started")
+
+    # This is our set of accounts that are signed up, including those that are
+    # muted/banned (as those could be later reversed.)
+    accounts = CachedAccountQuery(query_interval=600)
+    published_version = None
+
+    while True:
+        dids = accounts.get_accounts()
+        if accounts.version != published_version:
+            count = write_account_hashes(path, dids)
+            published_version = accounts.version
+            with version.get_lock():
+                version.value += 1
+            logger.info(f"Published {count} valid accounts")
+
+        process_time.value = time.time()
+        time.sleep(ACCOUNT_PUBLISH_INTERVAL)
@@ -0,0 +1,363 @@
+"""Generates realistic-looking firehose commits for benchmarking and testing, without
+needing a connection to a relay.
+
+Commits are built the same way that a relay sends them: a DAG-CBOR frame containing a
+CAR file of the commit's records. They can be written to a capture file (see
+astrofeed_firehose.capture) to be replayed through the whole firehose. The same commits
+can also be made as Jetstream events, and served by LocalJetstream (see
+astrofeed_firehose.jetstream.)
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import string
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+import libipld
+from atproto import firehose_models
+from websockets.asyncio.server import Server, ServerConnection, serve
+
+from astrofeed_lib.config import FEED_TERMS, GENERAL_FEEDS
+
+# Every term that puts a post in one of our feeds
+_FEED_EMOJI = sorted(
+    {emoji for terms in FEED_TERMS.values() if terms for emoji in terms["emoji"]}
+)
+_FEED_HASHTAGS = sorted(
+    {
+        word
+        for terms in (FEED_TERMS | GENERAL_FEEDS).values()
+        if terms
+        for word in terms["words"]
+    }
+)
+
+# ... and some that don't
+_OTHER_EMOJI = ["😀", "🎉", "❤️", "🐈", "🌈", "🙏🏽", "👩‍🚀", "🏳️‍⚧️"]
+_OTHER_HASHTAGS = ["#caturday", "#science", "#space", "#art", "#news", "#bookclub"]
+
+_WORDS = (
+    "the a of to and in is it you that he was for on are with as his they be at one "
+    "have this from or had by hot word but what some we can out other were all there "
+    "when up use your how said an each she which do their time if will way about many "
+    "then them write would like so these her long make thing see him two has look more "
+    "telescope galaxy star night sky https://example.com/a/link"
+).split()
+
+_HASHTAG = re.compile(r"(?:^|\s)(#\S+)")
+
+_CID_PREFIX = bytes([0x01, 0x71, 0x12, 0x20])  # CIDv1, dag-cbor, sha2-256, 32 bytes
+
+
+def make_cid(data: bytes) -> bytes:
+    """Returns the binary CID of a DAG-CBOR block."""
+    return _CID_PREFIX + hashlib.sha256(data).digest()
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            result.append(byte | 0x80)
+        else:
+            result.append(byte)
+            return bytes(result)
+
+
+def make_tag_facets(text: str) -> list[dict]:
+    """Builds a tag facet for each hashtag in text, like the Bluesky app does (which
+    leaves out punctuation at the end of a hashtag.)
+    """
+    facets = []
+    for match in _HASHTAG.finditer(text):
+        hashtag = match[1].rstrip(string.punctuation)
+        if len(hashtag) < 2:
+            continue
+        start = len(text[: match.start(1)].encode())
+        facets.append(
+            {
+                "index": {"byteStart": start, "byteEnd": start + len(hashtag.encode())},
+                "features": [
+                    {"$type": "app.bsky.richtext.facet#tag", "tag": hashtag[1:]}
+                ],
+            }
+        )
+    return facets
+
+
+def make_car(root: bytes, blocks: dict[bytes, bytes]) -> bytes:
+    """Builds a CARv1 file from a root CID and a dict of CID: block."""
+    header = libipld.encode_dag_cbor({"version": 1, "roots": [root]})
+    parts = [_varint(len(header)), header]
+    for cid, block in blocks.items():
+        parts.extend((_varint(len(cid) + len(block)), cid, block))
+    return b"".join(parts)
+
+
+class SyntheticFirehose:
+    def __init__(
+        self,
+        signed_up_accounts: int = 1000,
+        other_accounts: int = 100000,
+        signed_up_ratio: float = 0.01,
+        post_ratio: float = 0.25,
+        like_ratio: float = 0.55,
+        follow_ratio: float = 0.2,
+        delete_ratio: float = 0.05,
+        reply_ratio: float = 0.4,
+        feed_emoji_ratio: float = 0.05,
+        feed_hashtag_ratio: float = 0.1,
+        other_emoji_ratio: float = 0.3,
+        other_hashtag_ratio: float = 0.1,
+        seed: int = 0,
+    ):
+        """Generates a stream of firehose commits, each with one operation (like most
+        commits on the real firehose.)
+
+        signed_up_ratio is the fraction of commits made by one of signed_up_accounts
+        (which are named by signed_up_did), with the rest made by other_accounts. The
+        *_ratio arguments after that set the mix of operations (normalized to sum to
+        one), the fraction of them that are deletes, the fraction of posts that are
+        replies, and how often post texts contain our feeds' emoji and hashtags (or
+        others that we don't care about.)
+        """
+        self.random = random.Random(seed)
+        self.signed_up_accounts = signed_up_accounts
+        self.other_accounts = other_accounts
+        self.signed_up_ratio = signed_up_ratio
+        total = post_ratio + like_ratio + follow_ratio
+        self.op_weights = [post_ratio / total, like_ratio / total, follow_ratio / total]
+        self.delete_ratio = delete_ratio
+        self.reply_ratio = reply_ratio
+        self.feed_emoji_ratio = feed_emoji_ratio
+        self.feed_hashtag_ratio = feed_hashtag_ratio
+        self.other_emoji_ratio = other_emoji_ratio
+        self.other_hashtag_ratio = other_hashtag_ratio
+
+        self.seq = 0
+        self.time = datetime(2025, 3, 1, tzinfo=timezone.utc)
+        # Recently created posts, to like and reply to
+        self.recent_posts: list[tuple[str, bytes]] = []
+
+    @staticmethod
+    def signed_up_did(index: int) -> str:
+        return f"did:plc:signedup{index:016d}"
+
+    def _random_did(self) -> str:
+        if self.random.random() < self.signed_up_ratio:
+            return self.signed_up_did(self.random.randrange(self.signed_up_accounts))
+        return f"did:plc:other{self.random.randrange(self.other_accounts):019d}"
+
+    def _rkey(self) -> str:
+        return f"3l{self.seq:011d}"
+
+    def _timestamp(self) -> str:
+        return self.time.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def post_text(self) -> str:
+        words = self.random.choices(_WORDS, k=self.random.randint(3, 40))
+        extras = (
+            (self.feed_emoji_ratio, _FEED_EMOJI),
+            (self.feed_hashtag_ratio, _FEED_HASHTAGS),
+            (self.other_emoji_ratio, _OTHER_EMOJI),
+            (self.other_hashtag_ratio, _OTHER_HASHTAGS),
+        )
+        for ratio, choices in extras:
+            if self.random.random() < ratio:
+                position = self.random.randrange(len(words) + 1)
+                words.insert(position, self.random.choice(choices))
+        return " ".join(words)[:300]
+
+    def _post_record(self) -> dict:
+        text = self.post_text()
+        record = {
+            "$type": "app.bsky.feed.post",
+            "text": text,
+            "createdAt": self._timestamp(),
+        }
+        if facets := make_tag_facets(text):
+            record["facets"] = facets
+        if self.recent_posts and self.random.random() < self.reply_ratio:
+            uri, cid = self.random.choice(self.recent_posts)
+            parent = {"uri": uri, "cid": libipld.encode_cid(cid)}
+            record["reply"] = {"root": parent, "parent": parent}
+        return record
+
+    def _like_record(self) -> dict:
+        if self.recent_posts:
+            uri, cid = self.random.choice(self.recent_posts)
+        else:
+            uri, cid = "at://did:plc:nobody/app.bsky.feed.post/1", make_cid(b"")
+        return {
+            "$type": "app.bsky.feed.like",
+            "subject": {"uri": uri, "cid": libipld.encode_cid(cid)},
+            "createdAt": self._timestamp(),
+        }
+
+    def _follow_record(self) -> dict:
+        return {
+            "$type": "app.bsky.graph.follow",
+            "subject": self._random_did(),
+            "createdAt": self._timestamp(),
+        }
+
+    def _next_op(self) -> tuple[str, str, dict | None, bytes | None]:
+        """Moves on to the next commit, returning its repo, the path of the record it
+        changes, and the new record and its CID (or None for deletes.)
+        """
+        self.seq += 1
+        self.time += timedelta(milliseconds=1)
+        repo = self._random_did()
+        collection, make_record = self.random.choices(
+            (
+                ("app.bsky.feed.post", self._post_record),
+                ("app.bsky.feed.like", self._like_record),
+                ("app.bsky.graph.follow", self._follow_record),
+            ),
+            weights=self.op_weights,
+        )[0]
+        path = f"{collection}/{self._rkey()}"
+
+        if self.random.random() < self.delete_ratio:
+            return repo, path, None, None
+
+        record = make_record()
+        cid = make_cid(libipld.encode_dag_cbor(record))
+        if collection == "app.bsky.feed.post":
+            self.recent_posts.append((f"at://{repo}/{path}", cid))
+            del self.recent_posts[:-1000]
+        return repo, path, record, cid
+
+    def raw_commit(self) -> bytes:
+        """Returns the next commit, as a raw frame."""
+        repo, path, record, cid = self._next_op()
+
+        blocks = {}
+        if record is None:
+            op = {"action": "delete", "path": path, "cid": None}
+        else:
+            blocks[cid] = libipld.encode_dag_cbor(record)
+            op = {"action": "create", "path": path, "cid": cid}
+
+        commit = make_cid(path.encode())
+        body = {
+            "seq": self.seq,
+            "rebase": False,
+            "tooBig": False,
+            "repo": repo,
+            "commit": commit,
+            "rev": self._rkey(),
+            "since": None,
+            "blocks": make_car(commit, blocks),
+            "ops": [op],
+            "blobs": [],
+            "time": self._timestamp(),
+        }
+        header = libipld.encode_dag_cbor({"op": 1, "t": "#commit"})
+        return header + libipld.encode_dag_cbor(body)
+
+    def raw_commits(self, count: int) -> list[bytes]:
+        return [self.raw_commit() for _ in range(count)]
+
+    def commits(self, count: int) -> list[firehose_models.MessageFrame]:
+        """Returns the next count commits, decoded as the firehose client would."""
+        return [
+            firehose_models.Frame.from_bytes(raw_commit)
+            for raw_commit in self.raw_commits(count)
+        ]
+
+    def jetstream_event(self) -> dict:
+        """Returns the next commit, as a Jetstream event."""
+        repo, path, record, cid = self._next_op()
+        collection, rkey = path.split("/")
+        commit = {"rev": rkey, "collection": collection, "rkey": rkey}
+        if record is None:
+            commit["operation"] = "delete"
+        else:
+            commit.update(
+                operation="create", record=record, cid=libipld.encode_cid(cid)
+            )
+        return {
+            "did": repo,
+            "time_us": int(self.time.timestamp() * 1e6),
+            "kind": "commit",
+            "commit": commit,
+        }
+
+    def jetstream_events(self, count: int) -> list[dict]:
+        return [self.jetstream_event() for _ in range(count)]
+
+
+class LocalJetstream:
+    def __init__(self, events: list[dict], disconnect_after: int | None = None):
+        """A stand-in for a Jetstream server, which sends events to every client that
+        connects. Like the real thing, it supports the wantedCollections, wantedDids,
+        cursor and requireHello query parameters, and options_update messages.
+
+        If disconnect_after is set, each connection is closed after sending that many
+        events, like a server that drops slow clients.
+        """
+        self.events = events
+        self.disconnect_after = disconnect_after
+        self.connections: list[dict] = []
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0) -> Server:
+        """Starts serving; the URI to connect to is then self.uri."""
+        self.server = await serve(self._handle_connection, host, port)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        self.uri = f"ws://{host}:{port}/subscribe"
+        return self.server
+
+    async def _handle_connection(self, websocket: ServerConnection):
+        query = parse_qs(urlparse(websocket.request.path).query)
+        options = {
+            "wantedCollections": query.get("wantedCollections", []),
+            "wantedDids": query.get("wantedDids", []),
+        }
+        # Kept for tests to check what clients asked for
+        self.connections.append(
+            {"cursor": query.get("cursor", [None])[0], "options": options}
+        )
+
+        if query.get("requireHello", ["false"])[0] == "true":
+            self._update_options(options, await websocket.recv())
+        options_task = asyncio.create_task(self._receive_options(websocket, options))
+
+        cursor = int(query["cursor"][0]) if "cursor" in query else 0
+        sent = 0
+        try:
+            for event in self.events:
+                if event["time_us"] <= cursor or not self._wanted(event, options):
+                    continue
+                await websocket.send(json.dumps(event))
+                sent += 1
+                if sent == self.disconnect_after:
+                    return
+            await websocket.wait_closed()
+        finally:
+            options_task.cancel()
+
+    async def _receive_options(self, websocket: ServerConnection, options: dict):
+        async for message in websocket:
+            self._update_options(options, message)
+
+    def _update_options(self, options: dict, message: str | bytes):
+        update = json.loads(message)
+        if update.get("type") == "options_update":
+            options.update(update["payload"])
+
+    @staticmethod
+    def _wanted(event: dict, options: dict) -> bool:
+        if options["wantedDids"] and event["did"] not in options["wantedDids"]:
+            return False
+        collection = event.get("commit", {}).get("collection")
+        return (
+            not options["wantedCollections"]
+            or collection in (options["wantedCollections"])
+        )
@@ -0,0 +1,217 @@
+"""Statistics that commit processors keep about their work, for the manager to report
+(see astrofeed_firehose.metrics.)
+
+Each worker adds up its numbers in STATS as it goes, and copies them into the
+SharedWorkerStats that the manager gave it after every batch of commits. Only one
+process ever writes to each SharedWorkerStats, so workers never wait on each other or
+on the manager.
+
+As well as the total time spent in each stage of processing, one in every
+TRACE_SAMPLE_INTERVAL commits is traced: the time it spent in each stage is counted
+into a histogram (and logged at debug level), which shows how long individual commits
+take rather than just the average.
+"""
+
+import time
+from datetime import datetime
+from multiprocessing import Array
+from typing import Iterable
+
+from astrofeed_firehose.config import TRACE_SAMPLE_INTERVAL
+from astrofeed_lib import logger
+from astrofeed_lib.config import FEED_TERMS, GENERAL_FEEDS
+
+# Parts of commit processing that are timed separately: decoding frames and sorting
+# their ops (parse), decoding the CAR files of commits (car), decoding the records in
+# them (records), classifying posts (classify), and writing to the database (database)
+STAGES = ("parse", "car", "records", "classify", "database")
+
+# Upper bounds (in seconds) of the histogram buckets for traced commits, which have
+# their total time traced as well as the time in each stage
+TRACE_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    1.0,
+)
+TRACE_STAGES = (*STAGES, "total")
+
+FEEDS = tuple(FEED_TERMS | GENERAL_FEEDS)
+
+# Totals, which are added to the shared stats on each flush...
+_SUMMED_FIELDS = (
+    "commits",
+    "busy_time",
+    *[f"{stage}_time" for stage in STAGES],
+    *[f"inserted_{feed}" for feed in FEEDS],
+    *[f"deleted_{feed}" for feed in FEEDS],
+    "traced_commits",
+    *[f"trace_{stage}_sum" for stage in TRACE_STAGES],
+    *[
+        f"trace_{stage}_{bucket}"
+        for stage in TRACE_STAGES
+        for bucket in range(len(TRACE_BUCKETS) + 1)
+    ],
+)
+# ... and the latest values seen, of which the shared stats keep the highest
+_LATEST_FIELDS = ("latest_commit_time", "saved_cursor")
+
+FIELDS = _SUMMED_FIELDS + _LATEST_FIELDS
+_INDEX = {field: i for i, field in enumerate(FIELDS)}
+
+
+class _StageTimer:
+    def __init__(self, stats: "WorkerStats", stage: str):
+        """Adds the time spent in a block to a stage of a WorkerStats. Time spent in
+        other stages' timers inside the block isn't counted, so that stages add up to
+        the total time.
+        """
+        self.stats = stats
+        self.index = _INDEX[f"{stage}_time"]
+
+    def __enter__(self):
+        stats, now = self.stats, time.perf_counter()
+        if stats.running:
+            # Pause the timer that this one is inside of
+            index, start = stats.running[-1]
+            stats.values[index] += now - start
+        stats.running.append((self.index, now))
+
+    def __exit__(self, *exc_info):
+        stats, now = self.stats, time.perf_counter()
+        index, start = stats.running.pop()
+        stats.values[index] += now - start
+        if stats.running:
+            stats.running[-1] = (stats.running[-1][0], now)
+
+
+class WorkerStats:
+    def __init__(self, trace_interval: int = TRACE_SAMPLE_INTERVAL):
+        """Statistics kept by a worker since they were last flushed to its
+        SharedWorkerStats. One in every trace_interval commits is traced (see
+        start_trace.)
+        """
+        self.values = [0.0] * len(FIELDS)
+        self.timers = {stage: _StageTimer(self, stage) for stage in STAGES}
+        self.running: list[tuple[int, float]] = []
+        self.trace_interval = trace_interval
+        self.commits_until_trace = trace_interval
+
+    def add(self, field: str, amount: float = 1.0) -> None:
+        self.values[_INDEX[field]] += amount
+
+    def set_latest(self, field: str, value: float) -> None:
+        index = _INDEX[field]
+        self.values[index] = max(self.values[index], value)
+
+    def timer(self, stage: str) -> _StageTimer:
+        """Adds the time spent in a with block to one of STAGES."""
+        return self.timers[stage]
+
+    def start_trace(self) -> tuple[float, list[float]] | None:
+        """Called before processing each commit. If this commit should be traced,
+        returns what finish_trace needs to trace it.
+        """
+        self.commits_until_trace -= 1
+        if self.commits_until_trace > 0:
+            return None
+        self.commits_until_trace = self.trace_interval
+        return time.perf_counter(), [self.values[_INDEX[f"{s}_time"]] for s in STAGES]
+
+    def finish_trace(
+        self, trace: tuple[float, list[float]], cursor: int | None = None
+    ) -> None:
+        """Counts the time that a traced commit spent in each stage."""
+        start, stage_times = trace
+        times = {
+            stage: self.values[_INDEX[f"{stage}_time"]] - stage_time
+            for stage, stage_time in zip(STAGES, stage_times)
+        }
+        times["total"] = time.perf_counter() - start
+
+        self.values[_INDEX["traced_commits"]] += 1
+        for stage, seconds in times.items():
+            self.values[_INDEX[f"trace_{stage}_sum"]] += seconds
+            bucket = next(
+                (i for i, bound in enumerate(TRACE_BUCKETS) if seconds <= bound),
+                len(TRACE_BUCKETS),
+            )
+            self.values[_INDEX[f"trace_{stage}_{bucket}"]] += 1
+
+        logger.debug(
+            f"Commit trace (cursor={cursor}): "
+            + " | ".join(
+                f"{stage} {seconds * 1000:.3f} ms" for stage, seconds in times.items()
+            )
+        )
+
+    def count_posts(self, action: str, posts: Iterable[dict]) -> None:
+        """Counts posts that were inserted or deleted, by the feeds they're in. Each
+        post is a dict of feed labels, as returned by post_in_feeds.
+        """
+        for post in posts:
+            for feed in FEEDS:
+                if post.get(f"feed_{feed}"):
+                    self.values[_INDEX[f"{action}_{feed}"]] += 1
+
+    def set_commit_time(self, commit_time: str) -> None:
+        """Records the time that the relay says a commit was made, as an ISO 8601
+        string.
+        """
+        try:
+            timestamp = datetime.fromisoformat(commit_time).timestamp()
+        except (TypeError, ValueError):
+            return
+        self.set_latest("latest_commit_time", timestamp)
+
+    def flush(self, shared: "SharedWorkerStats") -> None:
+        """Adds these stats to shared, then starts the totals again from zero."""
+        shared.add(self.values)
+        for field in _SUMMED_FIELDS:
+            self.values[_INDEX[field]] = 0.0
+
+
+class SharedWorkerStats:
+    def __init__(self):
+        """Statistics of one worker, kept in shared memory so that the manager can read
+        them. They're kept over restarts of the worker.
+        """
+        self.values = Array("d", len(FIELDS), lock=False)
+
+    def add(self, values: list[float]) -> None:
+        for field in _SUMMED_FIELDS:
+            self.values[_INDEX[field]] += values[_INDEX[field]]
+        for field in _LATEST_FIELDS:
+            index = _INDEX[field]
+            self.values[index] = max(self.values[index], values[index])
+
+    def get(self, field: str) -> float:
+        return self.values[_INDEX[field]]
+
+    def snapshot(self) -> dict[str, float]:
+        return dict(zip(FIELDS, self.values[:]))
+
+
+def combine_snapshots(snapshots: Iterable[dict[str, float]]) -> dict[str, float]:
+    """Combines the stats of many workers: totals are added together, and the highest
+    of the latest values is kept.
+    """
+    combined = dict.fromkeys(FIELDS, 0.0)
+    for snapshot in snapshots:
+        for field in _SUMMED_FIELDS:
+            combined[field] += snapshot[field]
+        for field in _LATEST_FIELDS:
+            combined[field] = max(combined[field], snapshot[field])
+    return combined
+
+
+# Stats of this process, which commit processing code adds to directly
+STATS = WorkerStats()
@@ -0,0 +1,198 @@
+"""Push-based notifications of changed accounts, so that cached account lists (see
+astrofeed_lib.accounts) can pick up signups and bans straight away instead of waiting
+for their next refresh.
+
+On PostgreSQL, changes are sent with NOTIFY and received by a background thread in each
+process that LISTENs for them. On SQLite and MySQL, changes are written to the
+AccountChange table instead, which each process polls every
+ACCOUNT_CHANGE_POLL_INTERVAL seconds.
+"""
+
+import select
+import time
+from datetime import timedelta
+from threading import Lock, Thread
+
+from astrofeed_lib import logger
+from .config import ASTROFEED_POSTGRES, ACCOUNT_CHANGE_POLL_INTERVAL
+from .database import (
+    AccountChange,
+    DBConnection,
+    datetime_now_utc_naive,
+    get_database,
+)
+
+ACCOUNT_CHANGE_CHANNEL = "account_changes"
+
+# Rows in the account change log older than this are deleted whenever a change is
+# published. Any process that's been away for longer than this will do a full reload
+# of its accounts anyway.
+_CHANGE_LOG_RETENTION = timedelta(days=1)
+
+
+def publish_account_change(did: str) -> None:
+    """Tells every process with a cached account list that the account with this DID
+    has changed.
+    """
+    with DBConnection() as db:
+        if ASTROFEED_POSTGRES:
+            db.execute_sql("SELECT pg_notify(%s, %s)", (ACCOUNT_CHANGE_CHANNEL, did))
+            return
+        with db.atomic():
+            AccountChange.create(did=did)
+            AccountChange.delete().where(
+                AccountChange.changed_at
+                < datetime_now_utc_naive() - _CHANGE_LOG_RETENTION
+            ).execute()
+
+
+class AccountChangeSubscription:
+    def __init__(self, listener: "AccountChangeListener"):
+        """Collects the DIDs of changed accounts for one subscriber (e.g. one cached
+        account list) until they're fetched with get_changes.
+        """
+        self.listener = listener
+        self.changed_dids: set[str] = set()
+
+    def get_changes(self) -> set[str]:
+        """Returns the DIDs of all accounts that changed since this was last called."""
+        self.listener.poll_if_due()
+        with self.listener.lock:
+            changed_dids, self.changed_dids = self.changed_dids, set()
+        return changed_dids
+
+
+class AccountChangeListener:
+    def __init__(self, poll_interval: float = ACCOUNT_CHANGE_POLL_INTERVAL):
+        """Receives account changes for this process and hands them out to every
+        subscription. This base version polls the AccountChange table at most every
+        poll_interval seconds, whenever a subscription asks for changes.
+        """
+        self.poll_interval = poll_interval
+        self.lock = Lock()
+        self.subscriptions: list[AccountChangeSubscription] = []
+        self.last_poll_time = 0.0
+        self.last_change_id: int | None = None
+
+    def subscribe(self) -> AccountChangeSubscription:
+        """Returns a new subscription. Subscribe *before* loading accounts, so that no
+        changes made during the load are missed.
+        """
+        # Notes where the change log currently ends, if this is the first subscriber
+        self.poll_if_due()
+        subscription = AccountChangeSubscription(self)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def dispatch(self, dids: set[str]) -> None:
+        """Passes the DIDs of changed accounts on to every subscription."""
+        if not dids:
+            return
+        with self.lock:
+            for subscription in self.subscriptions:
+                subscription.changed_dids.update(dids)
+
+    def poll_if_due(self) -> None:
+        if time.time() - self.last_poll_time <= self.poll_interval:
+            return
+        try:
+            self.poll()
+        except Exception as e:
+            logger.warning(f"Unable to poll the account change log: {e}")
+        self.last_poll_time = time.time()
+
+    def poll(self) -> None:
+        """Fetches any new entries in the account change log. The first poll only notes
+        where the log currently ends, as subscribers have just loaded all accounts.
+        """
+        with DBConnection():
+            if self.last_change_id is None:
+                last_change_id = (
+                    AccountChange.select(AccountChange.id)
+                    .order_by(AccountChange.id.desc())
+                    .limit(1)
+                    .scalar()
+                )
+                self.last_change_id = last_change_id or 0
+                return
+
+            changes = list(
+                AccountChange.select(AccountChange.id, AccountChange.did)
+                .where(AccountChange.id > self.last_change_id)
+                .order_by(AccountChange.id)
+                .tuples()
+            )
+        if changes:
+            self.last_change_id = changes[-1][0]
+            self.dispatch({did for _, did in changes})
+
+
+class PostgresAccountChangeListener(AccountChangeListener):
+    def __init__(self, reconnect_delay: float = 10.0):
+        """Listens for account changes sent with NOTIFY, using a dedicated connection
+        (outside of the connection pool) in a background thread.
+        """
+        super().__init__()
+        self.reconnect_delay = reconnect_delay
+        self.thread = Thread(
+            target=self._listen_forever, name="Account change listener", daemon=True
+        )
+        self.thread.start()
+
+    def poll_if_due(self) -> None:
+        # Changes arrive in the background, so there's nothing to poll for
+        pass
+
+    def _listen_forever(self) -> None:
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning(
+                    f"Lost connection while listening for account changes: {e}. "
+                    f"Reconnecting in {self.reconnect_delay}s."
+                )
+            time.sleep(self.reconnect_delay)
+
+    def _listen(self) -> None:
+        import psycopg2
+
+        database = get_database().obj
+        connection = psycopg2.connect(
+            database=database.database, **database.connect_params
+        )
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {ACCOUNT_CHANGE_CHANNEL}")
+            logger.info("Listening for account changes")
+
+            while True:
+                # Wake up every now and then to notice a dropped connection
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    continue
+                connection.poll()
+                dids = {notify.payload for notify in connection.notifies}
+                connection.notifies.clear()
+                self.dispatch(dids)
+        finally:
+            connection.close()
+
+
+listener: AccountChangeListener | None = None
+
+
+def get_account_change_listener() -> AccountChangeListener:
+    """Returns this process's account change listener, starting it if necessary."""
+    global listener
+
+    if listener is None:
+        if ASTROFEED_POSTGRES:
+            listener = PostgresAccountChangeListener()
+        else:
+            listener = AccountChangeListener()
+
+    return listener
@@ -1,11 +1,18 @@
 """Tools for handling lists of accounts and working with Bluesky DIDs etc."""
 
-from .database import Account
+from .database import Account, datetime_now_utc_naive
 from .database import (
     DBConnection,
 )  # get_database, setup_connection, teardown_connection
+from .config import ACCOUNT_FULL_QUERY_INTERVAL
+from .account_changes import AccountChangeSubscription, get_account_change_listener
+from datetime import datetime, timedelta
 import time
 
+# Changes made up to this long before the last refresh are fetched again, in case they
+# were committed late (or by a process with a slightly different clock)
+_UPDATE_OVERLAP = timedelta(minutes=1)
+
 
 class AccountQuery:
     def __init__(self, flags=None) -> None:
@@ -15,7 +22,7 @@ class AccountQuery:
         self.accounts = None
         self.flags = flags
         self.query_database = self.query_database
-    
+
     def get_accounts(self) -> set:
         """Fetches accounts given the query defined in self.account_query."""
         self.query_database()
@@ -26,44 +33,124 @@ class AccountQuery:
         with DBConnection():
             self.accounts = self.account_query()
 
-    def account_query(self):
-        """OVERWRITE ME IF SUBCLASSING. Returns a set of accounts."""
-        query = Account.select()
+    def account_query(self, dids: set[str] | None = None):
+        """OVERWRITE ME IF SUBCLASSING. Returns a set of accounts, optionally limited to
+        the given DIDs.
+        """
+        query = Account.select(Account.did)
         if self.flags is not None:
             query = query.where(*self.flags)
+        if dids is not None:
+            query = query.where(Account.did.in_(dids))
         return {account.did for account in query}
 
 
-
 class CachedAccountQuery(AccountQuery):
     def __init__(
         self,
         flags=None,
         query_interval: int = 60 * 60 * 24,
+        full_query_interval: int | None = None,
+        listen_for_changes: bool = True,
     ) -> None:
         """Generic refreshing account list. Will return all accounts that have flags
         matching the defined 'flags' parameter.
+
+        Every query_interval seconds, only the accounts that have changed since the last
+        refresh are fetched and applied to the cached accounts. Every
+        full_query_interval seconds (by default ACCOUNT_FULL_QUERY_INTERVAL, or
+        query_interval if that's longer), all accounts are reloaded instead.
+
+        If listen_for_changes is True, accounts that are published as changed (e.g. by
+        the bot after a signup or ban; see astrofeed_lib.account_changes) are also
+        refreshed as soon as possible, so query_interval can be fairly long.
         """
         super().__init__(flags=flags)
         self.query_interval = query_interval
+        if full_query_interval is None:
+            full_query_interval = max(query_interval, ACCOUNT_FULL_QUERY_INTERVAL)
+        self.full_query_interval = full_query_interval
         self.last_query_time = time.time()
+        self.last_full_query_time = time.time()
+        self.last_refresh: datetime | None = None
+        self.listen_for_changes = listen_for_changes
+        self.subscription: AccountChangeSubscription | None = None
+
+        # Goes up by one every time the cached accounts change
+        self.version = 0
 
     def get_accounts(self) -> set:
         """Fetches accounts given the query defined in self.account_query.
-        
+
         The result of this query is cached for the length of time defined by
         query_interval when initiating this class. By default, it's 24 hours.
         """
-        is_overdue = time.time() - self.last_query_time > self.query_interval
-        if is_overdue or self.accounts is None:
+        if self.listen_for_changes and self.subscription is None:
+            self.subscription = get_account_change_listener().subscribe()
+
+        current_time = time.time()
+        if (
+            self.accounts is None
+            or current_time - self.last_full_query_time > self.full_query_interval
+        ):
             self.query_database()
+            self.last_query_time = self.last_full_query_time = time.time()
+        elif current_time - self.last_query_time > self.query_interval:
+            self.query_changes()
             self.last_query_time = time.time()
+        elif self.subscription is not None:
+            changed_dids = self.subscription.get_changes()
+            if changed_dids:
+                with DBConnection():
+                    self.apply_changes(changed_dids)
         return self.accounts  # type ignore because pylance is a silly thing here. this should always be a set
 
+    def query_database(self) -> None:
+        """Reloads all accounts, noting when we did so, so that query_changes knows
+        where to carry on from.
+        """
+        # Noted first, so that changes made during the full query aren't missed
+        refresh_time = datetime_now_utc_naive()
+        with DBConnection():
+            self.accounts = self.account_query()
+        self.last_refresh = refresh_time
+        self.version += 1
+
+    def query_changes(self) -> None:
+        """Fetches only the accounts that changed since the last refresh, and updates
+        the cached accounts with them.
+        """
+        refresh_time = datetime_now_utc_naive()
+        query = Account.select(Account.did)
+        if self.last_refresh is not None:
+            query = query.where(
+                Account.updated_at >= self.last_refresh - _UPDATE_OVERLAP
+            )
+
+        with DBConnection():
+            changed_dids = {did for (did,) in query.tuples()}
+            if changed_dids:
+                self.apply_changes(changed_dids)
+        self.last_refresh = refresh_time
+
+    def apply_changes(self, changed_dids: set[str]) -> None:
+        """Re-fetches the given accounts and updates the cached accounts with them."""
+        changed_accounts = self.account_query(changed_dids)
+
+        # Accounts that no longer match the query aren't returned by it, so we remove
+        # all changed accounts before adding back those that still match
+        if isinstance(self.accounts, dict):
+            for did in changed_dids:
+                self.accounts.pop(did, None)
+        else:
+            self.accounts.difference_update(changed_dids)
+        self.accounts.update(changed_accounts)
+        self.version += 1
+
 
 class CachedModeratorList(CachedAccountQuery):
-    def account_query(self):
-        return get_moderators()
+    def account_query(self, dids: set[str] | None = None):
+        return get_moderators(dids)
 
     def get_accounts_above_level(self, minimum_level: int) -> set[str]:
         """Wraps get_accounts and returns only moderators with the desired minimum
@@ -75,19 +162,25 @@ class CachedModeratorList(CachedAccountQuery):
 
 
 class CachedBannedList(CachedAccountQuery):
-    def account_query(self):
-        return get_banned_accounts()
+    def account_query(self, dids: set[str] | None = None):
+        return get_banned_accounts(dids)
 
 
-def get_moderators() -> dict[str, int]:
-    """Returns a dict containing the DIDs of all current moderators as keys and their
-    mod level as values.
+def get_moderators(dids: set[str] | None = None) -> dict[str, int]:
+    """Returns a dict containing the DIDs of all current moderators (optionally limited
+    to the given DIDs) as keys and their mod level as values.
     """
     query = Account.select(Account.did, Account.mod_level).where(Account.mod_level >= 1)  # type: ignore
+    if dids is not None:
+        query = query.where(Account.did.in_(dids))
     return {user.did: user.mod_level for user in query.execute()}
 
 
-def get_banned_accounts() -> set[str]:
-    """Returns a set containing the DIDs of all banned accounts."""
+def get_banned_accounts(dids: set[str] | None = None) -> set[str]:
+    """Returns a set containing the DIDs of all banned accounts (optionally limited to
+    the given DIDs).
+    """
     query = Account.select(Account.did).where(Account.is_banned)
+    if dids is not None:
+        query = query.where(Account.did.in_(dids))
     return {user.did for user in query.execute()}
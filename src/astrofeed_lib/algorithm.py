@@ -1,23 +1,47 @@
+import base64
+import binascii
 import operator
-from datetime import datetime
+import struct
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
 from functools import reduce
 from typing import Optional, Final, Any
 
-from peewee import fn
+from peewee import fn, Tuple
 
 from astrofeed_lib import logger
 from .accounts import CachedAccountQuery
-from .database import Account, Post, BotActions, ActivityLog, NormalizedFeedStats
-
-VALID_ACCOUNTS = CachedAccountQuery(flags=[Account.is_valid], query_interval=60)
+from .config import NO_REPLIES_FEEDS, TOP_FEEDS
+from .database import (
+    Account,
+    Post,
+    TopPost,
+    BotActions,
+    ActivityLog,
+    NormalizedFeedStats,
+    DBConnection,
+    get_read_database,
+)
+
+VALID_ACCOUNTS = CachedAccountQuery(flags=[Account.is_valid], query_interval=600)
 
 CURSOR_END_OF_FEED: Final[str] = "eof"
 
+# Cursors are a version byte, then the microsecond timestamp and ID of the last post
+# sent, packed and base64 encoded. Cursors with no version (before version 1) were
+# "<millisecond timestamp>::<cid>" strings, which are still accepted. Ranked feeds have
+# their own version, holding the time the ranking was computed and the rank of the last
+# post sent, so that the two kinds of cursor can't be mistaken for each other.
+_CURSOR_VERSION: Final[int] = 1
+_RANK_CURSOR_VERSION: Final[int] = 2
+_CURSOR_FORMAT: Final[struct.Struct] = struct.Struct(">Bqq")
+_EPOCH: Final[datetime] = datetime(1970, 1, 1)
+
 
-def _select_posts(feed, limit):
+def _select_posts(feed, limit, exclude_replies=False):
     feed_boolean = getattr(Post, "feed_" + feed)
-    return (
-        Post.select(Post.indexed_at, Post.uri, Post.cid, Post.hidden)
+    query = (
+        Post.select(Post.id, Post.indexed_at, Post.uri)
         .join(Account, on=(Account.did == Post.author))
         .where(
             Account.is_valid,
@@ -26,9 +50,12 @@ def _select_posts(feed, limit):
             ~Account.is_banned,
             ~Account.is_muted,
         )
-        .order_by(Post.indexed_at.desc())
+        .order_by(Post.indexed_at.desc(), Post.id.desc())
         .limit(limit)
     )
+    if exclude_replies:
+        query = query.where(Post.is_reply == False)  # noqa: E712
+    return query
 
 
 def _select_activity_log_by_feed(feed: str, limit: int):
@@ -174,13 +201,28 @@ def _create_feed_stats(stats: list[NormalizedFeedStats]) -> list[dict[str, Any]]
     ]
 
 
-def _create_feed(posts):
-    """Turns list of posts into a sorted"""
-    return [{"post": post.uri} for post in posts]
+def _read(query) -> list:
+    """Runs a read-only query against the read replica (if one is configured and up to
+    date) or the primary database.
+    """
+    with DBConnection(get_read_database()) as database:
+        return list(query.execute(database))
+
+
+def _create_feed_and_cursor(rows: list[tuple], create=None) -> tuple[list[dict], str]:
+    """Turns (id, indexed_at, uri) rows into a feed and the cursor for the next page of
+    it, in one pass. create makes the cursor from the last row's indexed_at and id, and
+    is create_cursor by default.
+    """
+    feed = [{"post": uri} for _, _, uri in rows]
+    if not rows:
+        return feed, CURSOR_END_OF_FEED
+    post_id, indexed_at, _ = rows[-1]
+    return feed, (create or create_cursor)(indexed_at, post_id)
 
 
 def get_feed_logs_by_feed(feed: str, limit: int) -> dict:
-    logs = _select_activity_log_by_feed(feed, limit)
+    logs = _read(_select_activity_log_by_feed(feed, limit))
     logger.info(f"Loaded logs from DB: {logs}")
     # Create the actual feed to send back to the user!
     log_details: list[dict[str, Any]] = _create_activity_log(logs)
@@ -189,7 +231,7 @@ def get_feed_logs_by_feed(feed: str, limit: int) -> dict:
 
 
 def get_feed_logs_by_date(date: str, limit: int) -> dict:
-    logs = _select_activity_log_by_date(date, limit)
+    logs = _read(_select_activity_log_by_date(date, limit))
     logger.info(f"Loaded logs from DB: {logs}")
     # Create the actual feed to send back to the user!
     log_details: list[dict[str, Any]] = _create_activity_log(logs)
@@ -198,7 +240,7 @@ def get_feed_logs_by_date(date: str, limit: int) -> dict:
 
 
 def get_feed_logs_by_did(did: str, limit: int) -> dict:
-    logs = _select_activity_log_by_did(did, limit)
+    logs = _read(_select_activity_log_by_did(did, limit))
     logger.info(f"Loaded logs from DB: {logs}")
     # Create the actual feed to send back to the user!
     log_details: list[dict[str, Any]] = _create_activity_log(logs)
@@ -231,30 +273,76 @@ def get_feed_stats(
         group_by_day_of_week,
     )
     logger.debug(f"Loaded stats from DB with SQL: {stats.sql()}")
-    feed_stats: list[dict[str, Any]] = _create_feed_stats(stats)
+    feed_stats: list[dict[str, Any]] = _create_feed_stats(_read(stats))
     logger.debug(f"Processed stats: {feed_stats}")
     return {"stats": feed_stats}
 
 
-def _handle_cursor(cursor, posts):
-    """Handles cursor operations if one is included in the request"""
-    timestamp, cid = unpack_cursor(cursor)
-    posts = posts.where(
-        ((Post.indexed_at == timestamp) & (Post.cid < cid))
-        | (Post.indexed_at < timestamp)  # type: ignore
-    )
-    return posts
+def _handle_cursor(cursor, posts, model=Post, cid_field=Post.cid):
+    """Handles cursor operations if one is included in the request. Current cursors
+    become a single row-value comparison that matches the ORDER BY of the query, so
+    that the database can start an index range scan at the cursor.
+    """
+    if _is_legacy_cursor(cursor):
+        timestamp, cid = unpack_legacy_cursor(cursor)
+        return posts.where(
+            ((model.indexed_at == timestamp) & (cid_field < cid))
+            | (model.indexed_at < timestamp)  # type: ignore
+        )
+
+    timestamp, post_id = unpack_cursor(cursor)
+    return posts.where(Tuple(model.indexed_at, model.id) < Tuple(timestamp, post_id))
+
+
+def _is_legacy_cursor(cursor: str) -> bool:
+    return "::" in cursor
+
+
+def _unpack_versioned_cursor(
+    cursor: str, expected_version: int
+) -> tuple[datetime, int]:
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode())
+        version, microseconds, value = _CURSOR_FORMAT.unpack(data)
+    except (binascii.Error, struct.error, ValueError):
+        raise ValueError("Malformed cursor")
+    if version != expected_version:
+        raise ValueError(f"Unsupported cursor version {version}")
+    return _EPOCH + timedelta(microseconds=microseconds), value
 
 
-def _move_cursor_to_last_post(posts):
-    last_post = posts[-1] if posts else None
-    if last_post:
-        return create_cursor(last_post.indexed_at.timestamp(), last_post.cid)
-    return CURSOR_END_OF_FEED
+def _create_versioned_cursor(version: int, timestamp: datetime, value: int) -> str:
+    microseconds = (timestamp - _EPOCH) // timedelta(microseconds=1)
+    data = _CURSOR_FORMAT.pack(version, microseconds, value)
+    return base64.urlsafe_b64encode(data).decode()
 
 
-def unpack_cursor(cursor):
-    """Converts a feed cursor into a timestamp and a cid for a post."""
+def unpack_cursor(cursor: str) -> tuple[datetime, int]:
+    """Converts a feed cursor into a timestamp and an ID for a post."""
+    return _unpack_versioned_cursor(cursor, _CURSOR_VERSION)
+
+
+def create_cursor(timestamp: datetime, post_id: int) -> str:
+    """Converts a timestamp and ID for a post into a feed cursor."""
+    return _create_versioned_cursor(_CURSOR_VERSION, timestamp, post_id)
+
+
+def unpack_rank_cursor(cursor: str) -> tuple[datetime, int]:
+    """Converts a ranked feed cursor into the time the ranking was computed and the
+    rank of a post.
+    """
+    return _unpack_versioned_cursor(cursor, _RANK_CURSOR_VERSION)
+
+
+def create_rank_cursor(computed_at: datetime, rank: int) -> str:
+    """Converts the time a ranking was computed and the rank of a post into a ranked
+    feed cursor.
+    """
+    return _create_versioned_cursor(_RANK_CURSOR_VERSION, computed_at, rank)
+
+
+def unpack_legacy_cursor(cursor: str) -> tuple[datetime, str]:
+    """Converts an old-style feed cursor into a timestamp and a cid for a post."""
     cursor_parts = cursor.split("::")
     if len(cursor_parts) != 2:
         raise ValueError("Malformed cursor")
@@ -263,72 +351,131 @@ def unpack_cursor(cursor):
     return timestamp, cid
 
 
-def create_cursor(timestamp, cid):
-    """Converts a timestamp and cid for a post into a feed cursor."""
-    return f"{int(timestamp * 1000)}::{cid}"
+class FeedProvider(ABC):
+    """A source of posts for one or more feeds. Subclasses say which table the feed's
+    posts live in and how to select them; everything else (cursors, building the
+    response) is shared.
+    """
 
+    # The table the feed's posts are in, which must have id and indexed_at columns
+    model = Post
 
-def get_posts(feed: str, cursor: Optional[str], limit: int) -> dict:
-    """Gets posts for a given feed!"""
-    # Early return if the cursor is just the end of feed indicator
-    if cursor == CURSOR_END_OF_FEED:
-        return {"cursor": CURSOR_END_OF_FEED, "feed": []}
+    # Column that old-style "<timestamp>::<cid>" cursors refer to
+    cid_field = Post.cid
 
-    # Hard-coded exceptions
-    if feed == "signup":
-        return get_posts_signup_feed(cursor, limit)
+    @abstractmethod
+    def select(self, feed: str, limit: int):
+        """Returns a query for the first limit posts in the feed, selecting (id,
+        indexed_at, uri) and ordered by indexed_at and id, newest first. There should be
+        an index that matches this order.
+        """
 
-    # Setup a query that's only for valid accounts
-    # valid_dids = VALID_ACCOUNTS.get_accounts()
-    posts = _select_posts(feed, limit)
+    def get_posts(self, feed: str, cursor: Optional[str], limit: int) -> dict:
+        posts = self.select(feed, limit)
 
-    # If the client specified a cursor, limit the posts to within some time range
-    if cursor:
-        posts = _handle_cursor(cursor, posts)
+        # If the client specified a cursor, limit the posts to within some time range
+        if cursor:
+            posts = _handle_cursor(cursor, posts, self.model, self.cid_field)
 
-    # Create the actual feed to send back to the user!
-    post_uris = _create_feed(posts)
-    cursor = _move_cursor_to_last_post(posts)
+        # Create the actual feed to send back to the user! Plain tuples are much cheaper
+        # than model instances on this, our hottest path
+        post_uris, cursor = _create_feed_and_cursor(_read(posts.tuples()))
 
-    return {"cursor": cursor, "feed": post_uris}
+        return {"cursor": cursor, "feed": post_uris}
 
 
-def get_posts_signup_feed(cursor: Optional[str], limit: int) -> dict:
+class FirehoseFeedProvider(FeedProvider):
+    """Feeds of posts added by the firehose, e.g. the astro feed."""
+
+    def select(self, feed: str, limit: int):
+        return _select_posts(feed, limit)
+
+
+class NoRepliesFeedProvider(FeedProvider):
+    """Versions of firehose feeds without replies (NO_REPLIES_FEEDS), read in order from
+    an index on Post (is_reply, indexed_at, id).
+    """
+
+    def select(self, feed: str, limit: int):
+        return _select_posts(NO_REPLIES_FEEDS[feed], limit, exclude_replies=True)
+
+
+class SignupFeedProvider(FeedProvider):
     """A special-case feed that contains all current signup attempts on the Astronomy
-    feed. Really really annoyingly, it's difficult to just use the same feed methods as
-    it includes multiple different column names & Peewee's OOP approach would make this
-    hellish.
+    feed, for moderators. Outstanding attempts are read in order from an index on
+    BotActions (type, stage, complete, indexed_at, id), so this doesn't get slower as
+    the table grows.
     """
-    # TODO: refactor this into separate methods, or somehow make existing ones more compatible
-    # Initial query
-    posts = (
-        BotActions.select(
-            BotActions.indexed_at, BotActions.latest_uri, BotActions.latest_cid
+
+    model = BotActions
+    cid_field = BotActions.latest_cid
+
+    def select(self, feed: str, limit: int):
+        return (
+            BotActions.select(
+                BotActions.id, BotActions.indexed_at, BotActions.latest_uri
+            )
+            .where(
+                BotActions.type == "signup",
+                BotActions.stage == "get_moderator",
+                BotActions.complete == False,  # noqa: E712
+            )
+            .order_by(BotActions.indexed_at.desc(), BotActions.id.desc())
+            .limit(limit)
         )
-        .where(
-            BotActions.complete == False,  # noqa: E712
-            BotActions.type == "signup",
-            BotActions.stage == "get_moderator",
+
+
+class TopFeedProvider(FeedProvider):
+    """Serves "top of the day" feeds in rank order, straight from the TopPost table
+    that astrofeed_lib.ranking.refresh_top_feeds materializes. Cursors hold the time
+    the ranking was computed and the rank of the last post sent (see
+    create_rank_cursor.) Once the ranking has been recomputed, ranks in old cursors
+    refer to different posts, so paging from them ends the feed rather than repeating
+    or skipping posts.
+    """
+
+    model = TopPost
+
+    def select(self, feed: str, limit: int):
+        return (
+            TopPost.select(TopPost.rank, TopPost.computed_at, TopPost.uri)
+            .where(TopPost.feed == feed)
+            .order_by(TopPost.rank)
+            .limit(limit)
         )
-        .order_by(BotActions.indexed_at.desc())
-        .limit(limit)
-    )
 
-    # Handle cursor
-    if cursor:
-        timestamp, cid = unpack_cursor(cursor)
-        posts = posts.where(
-            ((BotActions.indexed_at == timestamp) & (BotActions.latest_cid < cid))  # type: ignore
-            | (BotActions.indexed_at < timestamp)  # type: ignore
+    def get_posts(self, feed: str, cursor: Optional[str], limit: int) -> dict:
+        posts = self.select(feed, limit)
+        if cursor:
+            computed_at, rank = unpack_rank_cursor(cursor)
+            posts = posts.where(TopPost.computed_at == computed_at, TopPost.rank > rank)
+
+        post_uris, cursor = _create_feed_and_cursor(
+            _read(posts.tuples()), create_rank_cursor
         )
+        return {"cursor": cursor, "feed": post_uris}
+
 
-    # Extract URIs
-    post_uris = [{"post": post.latest_uri} for post in posts]
+# Feeds that aren't served by FirehoseFeedProvider
+FEED_PROVIDERS: dict[str, FeedProvider] = {"signup": SignupFeedProvider()}
+FEED_PROVIDERS.update({top_feed: TopFeedProvider() for top_feed in TOP_FEEDS})
+FEED_PROVIDERS.update({feed: NoRepliesFeedProvider() for feed in NO_REPLIES_FEEDS})
+_FIREHOSE_FEED_PROVIDER = FirehoseFeedProvider()
 
-    # Create cursor for feed
-    last_post = posts[-1] if posts else None
-    cursor = CURSOR_END_OF_FEED
-    if last_post:
-        cursor = create_cursor(last_post.indexed_at.timestamp(), last_post.latest_cid)
 
-    return {"cursor": cursor, "feed": post_uris}
+def get_feed_provider(feed: str) -> FeedProvider:
+    return FEED_PROVIDERS.get(feed, _FIREHOSE_FEED_PROVIDER)
+
+
+def get_posts(feed: str, cursor: Optional[str], limit: int) -> dict:
+    """Gets posts for a given feed!"""
+    # Early return if the cursor is just the end of feed indicator
+    if cursor == CURSOR_END_OF_FEED:
+        return {"cursor": CURSOR_END_OF_FEED, "feed": []}
+
+    return get_feed_provider(feed).get_posts(feed, cursor, limit)
+
+
+def get_posts_signup_feed(cursor: Optional[str], limit: int) -> dict:
+    """Gets posts for the signup feed."""
+    return get_posts("signup", cursor, limit)
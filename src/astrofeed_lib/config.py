@@ -31,6 +31,71 @@ DEBUG_ENABLED = os.getenv("ASTROFEED_DEBUG", "False").lower() in {"true", "1"}
 # ----------------------------------------------
 BLUESKY_DATABASE = os.environ.get("BLUESKY_DATABASE", None)
 
+# Connection pool settings (PostgreSQL & MySQL only). These are read separately by every
+# process that imports this module, so each firehose worker, gunicorn worker and the bot
+# all get their own pool of this size.
+# Maximum number of open connections in this process's pool
+DATABASE_POOL_SIZE = int(os.getenv("ASTROFEED_DATABASE_POOL_SIZE", 10))
+
+# Seconds after which an idle connection is recycled instead of reused. Unset = never.
+_pool_stale_timeout = os.getenv("ASTROFEED_DATABASE_POOL_STALE_TIMEOUT", None)
+if _pool_stale_timeout is not None:
+    _pool_stale_timeout = int(_pool_stale_timeout)
+DATABASE_POOL_STALE_TIMEOUT: int | None = _pool_stale_timeout
+
+# Seconds to wait for a free connection when the pool is exhausted before giving up
+DATABASE_POOL_TIMEOUT = int(os.getenv("ASTROFEED_DATABASE_POOL_TIMEOUT", 5))
+
+# Whether to ping pooled connections before handing them out, so that connections the
+# server has silently dropped are thrown away rather than failing the next query
+DATABASE_POOL_HEALTH_CHECK = os.getenv(
+    "ASTROFEED_DATABASE_POOL_HEALTH_CHECK", "False"
+).lower() in {"true", "1"}
+
+# Optional read replica, in the same format as BLUESKY_DATABASE. If set, the feed server
+# sends read-only queries here instead of to the primary that the firehose writes to.
+BLUESKY_REPLICA_DATABASE = os.environ.get("BLUESKY_REPLICA_DATABASE", None)
+
+# If the replica is more than this many seconds behind the primary, reads go to the
+# primary instead until it catches up
+DATABASE_REPLICA_MAX_LAG = float(os.getenv("ASTROFEED_DATABASE_REPLICA_MAX_LAG", 30))
+
+# How often (in seconds) each process re-checks how far behind the replica is
+DATABASE_REPLICA_CHECK_INTERVAL = 10
+
+# Queries slower than this many seconds are logged along with their SQL
+DATABASE_SLOW_QUERY_THRESHOLD = float(
+    os.getenv("ASTROFEED_DATABASE_SLOW_QUERY_THRESHOLD", 0.5)
+)
+
+
+# ----------------------------------------------
+# ACCOUNT CACHING
+# ----------------------------------------------
+# Cached account lists (e.g. the list of valid accounts) only fetch accounts that have
+# changed since they were last refreshed. Every this many seconds, they reload all
+# accounts anyway, in case a change was missed (e.g. a deleted account.)
+ACCOUNT_FULL_QUERY_INTERVAL = int(
+    os.getenv("ASTROFEED_ACCOUNT_FULL_QUERY_INTERVAL", 60 * 60)
+)
+
+# Changes to accounts made by the bot are pushed to cached account lists straight away
+# (with LISTEN/NOTIFY on PostgreSQL.) On SQLite and MySQL, cached account lists instead
+# poll the account change log this often (in seconds.)
+ACCOUNT_CHANGE_POLL_INTERVAL = float(
+    os.getenv("ASTROFEED_ACCOUNT_CHANGE_POLL_INTERVAL", 5)
+)
+# ----------------------------------------------
+# METRICS
+# ----------------------------------------------
+# Port that the bot and firehose serve Prometheus metrics on. Firehose commit processors
+# use the ports directly after this one, and each server (gunicorn) worker uses the
+# first free port from this one onwards. Unset = metrics aren't served.
+_metrics_port = os.getenv("ASTROFEED_METRICS_PORT", None)
+if _metrics_port is not None:
+    _metrics_port = int(_metrics_port)
+METRICS_PORT: int | None = _metrics_port
+
 
 ################################################
 # FEED SETTINGS
@@ -60,7 +125,9 @@ FEED_URI = "at://did:plc:jcoy7v3a2t4rcfdh6i4kza25/app.bsky.feed.generator/"
 # There are two options here: a feed may either have 'None' (all posts added) OR a dict
 # containing emoji combinations and words. Emoji are accepted anywhere in a post;
 # whereas words have to be exact space-separated matches (e.g. #space won't match
-# #spacecraft, but it would if it was in the emoji section)
+# #spacecraft, but it would if it was in the emoji section). Words are all hashtags,
+# which are taken from a post's tag facets and tags when it has them (see
+# astrofeed_lib.feeds.post_in_feeds.)
 # These feed terms also interact with the database specification. The Post table in the
 # database contains boolean columns feed_all, feed_astro, ... etc for each one of the
 # feeds.
@@ -98,6 +165,15 @@ NON_FIREHOSE_FEEDS = {"signup": {"emoji": [], "words": []}}
 # There are also a number of feeds that ANY account can post to.
 GENERAL_FEEDS = {"questions": {"emoji": [], "words": ["#askanastronomer"]}}
 
+# "Top of the day" feeds, which contain the most liked recent posts from another feed.
+# Keys are the name of the top feed and values are the name of the feed it ranks. They
+# are computed every few minutes by the firehose; see astrofeed_lib.ranking.
+TOP_FEEDS = {f"top-{feed}": feed for feed in (FEED_TERMS | GENERAL_FEEDS)}
+
+# Versions of each feed without replies. Keys are the name of the feed without replies
+# and values are the name of the feed it filters.
+NO_REPLIES_FEEDS = {f"{feed}-noreplies": feed for feed in (FEED_TERMS | GENERAL_FEEDS)}
+
 # Dict containing all feeds *to be published*! key:value pairs of the name as published
 # and internal (short) name. The short name is used throughout databases. The name as
 # published is the URI where the feed is.
@@ -108,7 +184,9 @@ FEED_NAMING_SCHEME_RULEBREAKERS = {
     "all": "astro-all"
 }  # The astrosky feed has an inconsistent name!
 FEED_URIS = {}
-for a_feed in (FEED_TERMS | NON_FIREHOSE_FEEDS | GENERAL_FEEDS).keys():
+for a_feed in (
+    FEED_TERMS | NON_FIREHOSE_FEEDS | GENERAL_FEEDS | TOP_FEEDS | NO_REPLIES_FEEDS
+).keys():
     if a_feed in FEED_NAMING_SCHEME_RULEBREAKERS:
         key = FEED_URI + FEED_NAMING_SCHEME_RULEBREAKERS[a_feed]
     else:
@@ -0,0 +1,189 @@
+"""Precompiled matchers for finding emoji in the text of posts.
+
+The emoji library's replace_emoji walks through text one character at a time in
+Python, which made removing emoji one of the slowest steps in classifying a post.
+Instead, every emoji that the library knows is compiled into regular expressions when
+this module is imported: one that finds characters that could start an emoji, and one
+for each of those characters that matches the rest of the longest emoji starting with
+it. These are structured like a trie, so that the regex engine never has to try
+thousands of alternatives at a character.
+
+remove_emoji gives exactly the same results as emoji.replace_emoji(text, replace=""),
+which is checked by tests/astrofeed_lib/test_emoji_matcher.py. The emoji library treats
+emoji that are joined by zero-width joiners as one sequence even when it doesn't know
+the sequence, and gives up on sequences that it only partly knows, neither of which a
+regex does in the same way. Text that contains the characters that could start such a
+sequence (see _PARTIAL_SEQUENCE_CHARACTERS) is still passed to the emoji library, which
+only happens for a few posts in a hundred.
+"""
+
+import re
+from typing import Iterable, Mapping
+
+import emoji
+
+# Characters that the emoji library removes wherever they are
+_VARIATION_SELECTORS = "\ufe0e\ufe0f"
+_ZWJ = "\u200d"
+
+
+def _build_trie(strings: Iterable[str]) -> dict:
+    """A trie of the strings, as nested dicts keyed by character. The key "" marks the
+    end of a string.
+    """
+    trie: dict = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return trie
+
+
+def _trie_pattern(node: dict) -> str:
+    """A regex matching the longest string in the trie that the text starts with."""
+    leaves, branches = [], []
+    for char, child in node.items():
+        if char == "":
+            continue
+        if list(child) == [""]:
+            leaves.append(re.escape(char))
+            continue
+        branches.append(re.escape(char) + _continuation_pattern(child))
+    if leaves:
+        branches.append(f"[{''.join(leaves)}]")
+    return "|".join(branches)
+
+
+def _continuation_pattern(node: dict) -> str:
+    """A regex matching the rest of the longest string in the trie that continues from
+    node, which may be nothing if node is the end of a string itself.
+    """
+    rest = _trie_pattern({key: value for key, value in node.items() if key})
+    return f"(?:{rest}){'?' if '' in node else ''}"
+
+
+def _character_ranges(characters: Iterable[str], max_gap: int = 16) -> str:
+    """A regex character class matching every character, and a few more between them.
+    Python's regex engine checks classes with characters outside the Basic Multilingual
+    Plane (like most emoji) one range at a time, so fewer, wider ranges are faster.
+    """
+    ranges: list[list[int]] = []
+    for code in sorted(map(ord, characters)):
+        if ranges and code - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return (
+        "["
+        + "".join(
+            re.escape(chr(start)) + (f"-{re.escape(chr(end))}" if end > start else "")
+            for start, end in ranges
+        )
+        + "]"
+    )
+
+
+def _partial_sequence_characters(trie: dict, node: dict | None = None) -> set[str]:
+    """Characters that continue a known emoji into the start of a longer sequence that
+    isn't itself an emoji.
+    """
+    characters = {_ZWJ}
+    for char, child in (node or trie).items():
+        if char == "":
+            continue
+        if "" in child:
+            characters.update(
+                key for key, value in child.items() if key and "" not in value
+            )
+        characters.update(_partial_sequence_characters(trie, child))
+    return characters
+
+
+_EMOJI_TRIE = _build_trie(emoji.EMOJI_DATA)
+
+# Characters that can start an emoji (and some that can't, see _character_ranges), and
+# the rest of the longest emoji starting with each character that can. None means that
+# the character is always an emoji on its own.
+_EMOJI_START = re.compile(_character_ranges([*_EMOJI_TRIE, *_VARIATION_SELECTORS]))
+_EMOJI_CONTINUATIONS: dict[str, re.Pattern | None] = {
+    char: None if list(child) == [""] else re.compile(_continuation_pattern(child))
+    for char, child in _EMOJI_TRIE.items()
+}
+
+_PARTIAL_SEQUENCE_CHARACTERS = re.compile(
+    f"[{''.join(sorted(_partial_sequence_characters(_EMOJI_TRIE)))}]"
+)
+
+
+def remove_emoji(text: str) -> str:
+    """Removes every emoji from text, in the same way as emoji.replace_emoji."""
+    if _PARTIAL_SEQUENCE_CHARACTERS.search(text):
+        return emoji.replace_emoji(text, replace="")
+
+    # Emoji are removed from left to right, and each is the longest that starts there
+    pieces, end = [], 0
+    for candidate in _EMOJI_START.finditer(text):
+        start = candidate.start()
+        char = text[start]
+        if start < end:
+            continue
+        if char in _VARIATION_SELECTORS:
+            emoji_end = start + 1
+        elif char in _EMOJI_CONTINUATIONS:
+            continuation = _EMOJI_CONTINUATIONS[char]
+            if continuation is None:
+                emoji_end = start + 1
+            elif match := continuation.match(text, start + 1):
+                emoji_end = match.end()
+            else:
+                continue
+        else:
+            continue
+        pieces.append(text[end:start])
+        end = emoji_end
+    if not pieces:
+        return text
+    pieces.append(text[end:])
+    return "".join(pieces)
+
+
+class EmojiFinder:
+    def __init__(self, emoji_by_label: Mapping[str, Iterable[str]]):
+        """Finds which of several lists of emoji (e.g. the emoji of each feed) have any
+        emoji in a piece of text, in one scan of the text (see labels_in.) An emoji is
+        found wherever it appears, including inside longer emoji, just like `emoji in
+        text`.
+        """
+        emoji_by_label = {
+            label: set(emojis) for label, emojis in emoji_by_label.items()
+        }
+        all_emoji = set().union(*emoji_by_label.values())
+
+        # Only the longest emoji found at each position is matched, so this is every
+        # label with an emoji that the match starts with
+        self.labels_by_emoji = {
+            match: {
+                label
+                for label, emojis in emoji_by_label.items()
+                if any(match.startswith(emoji) for emoji in emojis)
+            }
+            for match in all_emoji
+        }
+
+        # The match is in a lookahead, so that every position in the text is checked
+        longest_first = sorted(all_emoji, key=len, reverse=True)
+        self.pattern = None
+        if all_emoji:
+            self.pattern = re.compile(
+                f"(?=({'|'.join(re.escape(emoji) for emoji in longest_first)}))"
+            )
+
+    def labels_in(self, text: str) -> set[str]:
+        """Labels of every list of emoji that has an emoji in text."""
+        labels: set[str] = set()
+        if self.pattern is None:
+            return labels
+        for match in self.pattern.finditer(text):
+            labels.update(self.labels_by_emoji[match[1]])
+        return labels
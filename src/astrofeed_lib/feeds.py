@@ -2,8 +2,8 @@
 
 import re
 from typing import Iterable
-import emoji
 from .config import FEED_TERMS, GENERAL_FEEDS
+from .emoji_matcher import EmojiFinder, remove_emoji
 
 
 def remove_links_from_post(post: str) -> str:
@@ -24,7 +24,7 @@ def remove_punctuation_from_post(post: str) -> str:
 
 
 def remove_emoji_from_post(post: str) -> str:
-    return emoji.replace_emoji(post, replace="")
+    return remove_emoji(post)
 
 
 def cleaned_word_list(post: str) -> list:
@@ -41,6 +41,16 @@ def cleaned_word_list(post: str) -> list:
     return [f" {word} " for word in post.split()]
 
 
+def hashtag_word_list(tags: Iterable[str]) -> list:
+    """Generates a list of words from hashtags (with or without the #) in the same
+    format as cleaned_word_list, like ' #astro '. Emoji are removed from them, as they
+    would be from words in the text.
+    """
+    return [
+        f" #{remove_emoji_from_post(tag.removeprefix('#').lower())} " for tag in tags
+    ]
+
+
 FEED_TERMS_WITH_SPACES = dict()
 for feed, terms in (FEED_TERMS | GENERAL_FEEDS).items():
     if terms is not None:
@@ -50,9 +60,41 @@ for feed, terms in (FEED_TERMS | GENERAL_FEEDS).items():
     else:
         FEED_TERMS_WITH_SPACES[feed] = None
 
-
-def label_post(labels, post, words, feed, database_feed_prefix: str = "feed_"):
-    """Labels a post as being in a given feed."""
+# The feeds that each word (with spaces, like ' #astro ') is a term of, to find the
+# feeds with any of their words in a post for every feed at once
+FEED_WORDS: dict[str, set[str]] = dict()
+for feed, terms in FEED_TERMS_WITH_SPACES.items():
+    if terms is not None:
+        for word in terms["words"]:
+            FEED_WORDS.setdefault(word, set()).add(feed)
+
+# Tokenizing a post's text takes most of the time of classifying it. If every feed word
+# is a hashtag, text without a '#' can't match any of them, so it isn't tokenized.
+_FEED_WORDS_ARE_HASHTAGS = all(word.startswith(" #") for word in FEED_WORDS)
+
+# Finds the feeds with any of their emoji in a post, for every feed at once
+FEED_EMOJI = EmojiFinder(
+    {
+        feed: terms["emoji"]
+        for feed, terms in FEED_TERMS_WITH_SPACES.items()
+        if terms is not None
+    }
+)
+
+
+def label_post(
+    labels,
+    post,
+    words,
+    feed,
+    database_feed_prefix: str = "feed_",
+    feeds_with_emoji: set[str] | None = None,
+    feeds_with_words: set[str] | None = None,
+):
+    """Labels a post as being in a given feed. feeds_with_emoji and feeds_with_words
+    are the results of FEED_EMOJI.labels_in(post) and _feeds_with_words(words), if
+    they're already known.
+    """
     terms = FEED_TERMS_WITH_SPACES[feed]
 
     feed_in_db = database_feed_prefix + feed
@@ -65,11 +107,15 @@ def label_post(labels, post, words, feed, database_feed_prefix: str = "feed_"):
 
     # Otherwise, we check against all feeds
     # Firstly, check emoji
-    labels[feed_in_db] = _emoji_in_post(terms, post)
+    if feeds_with_emoji is None:
+        feeds_with_emoji = FEED_EMOJI.labels_in(post)
+    labels[feed_in_db] = feed in feeds_with_emoji
 
     # Then check words if the emoji wasn't already a hit
     if not labels[feed_in_db]:
-        labels[feed_in_db] = _word_in_post(terms, words)
+        if feeds_with_words is None:
+            feeds_with_words = _feeds_with_words(words)
+        labels[feed_in_db] = feed in feeds_with_words
 
     # Special case: add all posts in other feeds to the Astronomy feed
     # Todo: this may want to be coded more neatly, its an absolute mess!!!
@@ -81,19 +127,42 @@ def label_post(labels, post, words, feed, database_feed_prefix: str = "feed_"):
             labels[database_feed_prefix + "research"] = True
 
 
-def _emoji_in_post(terms, post):
-    return any([emoji in post for emoji in terms["emoji"]])
-
-
-def _word_in_post(terms, words):
-    return any([word in terms["words"] for word in words])
+def _feeds_with_words(words: Iterable[str]) -> set[str]:
+    feeds = set()
+    for word in words:
+        feeds.update(FEED_WORDS.get(word, ()))
+    return feeds
 
 
 def post_in_feeds(
-    post: str, feeds: None | Iterable[str] = None, database_feed_prefix: str = "feed_"
+    post: str,
+    feeds: None | Iterable[str] = None,
+    database_feed_prefix: str = "feed_",
+    facet_tags: Iterable[str] = (),
+    record_tags: Iterable[str] = (),
 ) -> dict:
-    """Tests if a given post is in the defined feeds by checking its text; returns none if so."""
-    words = cleaned_word_list(post)
+    """Tests if a given post is in the defined feeds by checking its text; returns none if so.
+
+    facet_tags are the hashtags in the post's app.bsky.richtext.facet#tag facets, and
+    record_tags those in its tags field. Both are matched along with the words in the
+    post's text, so they can only add feeds: facets get hashtags right that the text
+    doesn't (e.g. the tag of '#astro。' is 'astro'), while hashtags without a facet
+    (e.g. from apps that don't add them for every hashtag) are still found in the text.
+    """
+    if "#" in post or not _FEED_WORDS_ARE_HASHTAGS:
+        words = cleaned_word_list(post)
+    else:
+        words = []
+    words += hashtag_word_list(facet_tags)
+    words += hashtag_word_list(record_tags)
+
+    # This is a second scan for emoji after the one that removes them from the words.
+    # Feed emoji count wherever they are in the post, including in links, which are
+    # removed before the words' emoji are, so the two can't share a scan without
+    # changing which posts are in which feeds. It's one regex search for a couple of
+    # emoji, which takes a few percent of the time of cleaned_word_list.
+    feeds_with_emoji = FEED_EMOJI.labels_in(post)
+    feeds_with_words = _feeds_with_words(words)
     labels = {}
 
     if feeds is None:
@@ -106,6 +175,8 @@ def post_in_feeds(
             words,
             feed,
             database_feed_prefix=database_feed_prefix,
+            feeds_with_emoji=feeds_with_emoji,
+            feeds_with_words=feeds_with_words,
         )
 
     return labels
@@ -0,0 +1,344 @@
+"""Lightweight, dependency-free metrics that can be exported in the Prometheus text
+format.
+
+Every process keeps its own registry (METRICS), which it can serve on a port of its own
+with serve_metrics_in_background (or serve_metrics_on_free_port, for processes like
+gunicorn workers that don't have a fixed index to pick a port with.)
+"""
+
+import math
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Iterable
+
+from astrofeed_lib import logger
+
+# Roughly the default Prometheus client buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric(ABC):
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        """Base class for a metric with an optional set of label names. Values for each
+        combination of label values are stored separately.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: tuple, extra: dict | None = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.extend(extra.items())
+        if not pairs:
+            return ""
+        escaped = [f'{name}="{_escape_label_value(value)}"' for name, value in pairs]
+        return "{" + ",".join(escaped) + "}"
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """Returns the lines for the metric's values, without its HELP and TYPE."""
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        """A value that only ever goes up, like a number of queries."""
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        function: Callable[[], float] | None = None,
+    ):
+        """A value that can go up and down, like a number of connections in use. If
+        `function` is given, it's called to get the (unlabelled) value at export time.
+        """
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def clear(self) -> None:
+        """Removes the values for every combination of labels."""
+        with self.lock:
+            self.values.clear()
+
+    def get(self, **labels) -> float:
+        if self.function is not None:
+            return self.function()
+        with self.lock:
+            return self.values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            try:
+                return [f"{self.name} {_format_value(self.function())}"]
+            except Exception as e:
+                logger.warning(f"Unable to evaluate metric {self.name}: {e}")
+                return []
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        """Counts observations (like query durations) into cumulative buckets."""
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.counts:
+                self.counts[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts = self.counts[key]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.sums[key] += value
+
+    def set(self, bucket_counts: list[int], total: float, **labels) -> None:
+        """Replaces the observations with ones counted elsewhere (e.g. by another
+        process), given as the (non-cumulative) count in each bucket and the sum.
+        """
+        if len(bucket_counts) != len(self.buckets) + 1:
+            raise ValueError(
+                f"Expected {len(self.buckets) + 1} bucket counts (including +Inf), "
+                f"got {len(bucket_counts)}"
+            )
+        key = self._key(labels)
+        with self.lock:
+            self.counts[key] = list(bucket_counts)
+            self.sums[key] = total
+
+    def get_count(self, **labels) -> int:
+        with self.lock:
+            return sum(self.counts.get(self._key(labels), []))
+
+    def get_sum(self, **labels) -> float:
+        with self.lock:
+            return self.sums.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            counts = {key: list(value) for key, value in self.counts.items()}
+            sums = dict(self.sums)
+
+        lines = []
+        for key, bucket_counts in counts.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), bucket_counts):
+                cumulative += count
+                labels = self._format_labels(key, {"le": _format_value(upper_bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = self._format_labels(key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(sums[key])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Holds all metrics for this process, so that they can be exported at once."""
+        self.metrics: dict[str, _Metric] = {}
+        self.lock = Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered.")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self, name: str, documentation: str, labelnames=(), function=None
+    ) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+def render_prometheus() -> str:
+    """Returns all metrics in this process in the Prometheus text exposition format."""
+    return METRICS.render()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    render: Callable[[], str] = staticmethod(render_prometheus)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes happen every few seconds - we don't want them in the service logs
+        pass
+
+
+def serve_metrics_in_background(
+    port: int,
+    host: str = "127.0.0.1",
+    render: Callable[[], str] = render_prometheus,
+) -> ThreadingHTTPServer:
+    """Serves this process's metrics at http://host:port/metrics from a daemon thread.
+    The page is made by render, if metrics other than those in METRICS are wanted.
+    """
+    handler = type(
+        "MetricsRequestHandler",
+        (_MetricsRequestHandler,),
+        {"render": staticmethod(render)},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = Thread(target=server.serve_forever, name="Metrics server", daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
+
+
+def serve_metrics_on_free_port(
+    first_port: int,
+    port_count: int,
+    host: str = "127.0.0.1",
+    render: Callable[[], str] = render_prometheus,
+) -> ThreadingHTTPServer | None:
+    """Serves this process's metrics like serve_metrics_in_background, on the first port
+    from first_port to first_port + port_count - 1 that isn't in use. Returns None if
+    they're all in use.
+    """
+    for port in range(first_port, first_port + port_count):
+        try:
+            return serve_metrics_in_background(port, host, render)
+        except OSError:
+            continue
+    logger.warning(
+        f"Unable to serve metrics: ports {first_port} to "
+        f"{first_port + port_count - 1} are all in use."
+    )
+    return None
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
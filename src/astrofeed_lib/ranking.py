@@ -0,0 +1,80 @@
+"""Popularity ranking of posts, used to build the "top of the day" feeds (TOP_FEEDS.)
+
+Post.likes is kept up to date by the firehose. Every few minutes, refresh_top_feeds
+scores recent posts by their likes, decayed by their age, and writes the best posts in
+each feed to the TopPost table, which the feed server reads from directly.
+"""
+
+from datetime import datetime, timedelta
+from typing import Final
+
+import peewee
+
+from astrofeed_lib import logger
+from .config import TOP_FEEDS
+from .database import Account, DBConnection, Post, TopPost, datetime_now_utc_naive
+
+# How far back the top feeds look for posts
+TOP_FEED_WINDOW: Final[timedelta] = timedelta(days=1)
+
+# Number of posts in each top feed
+TOP_FEED_SIZE: Final[int] = 100
+
+# How quickly posts sink as they get older; see score_post
+TOP_FEED_GRAVITY: Final[float] = 1.5
+
+
+def score_post(likes: int, age: timedelta) -> float:
+    """Time-decayed popularity of a post, as used by Hacker News: likes divided by
+    (age in hours + 2) ** TOP_FEED_GRAVITY.
+    """
+    age_hours = max(age.total_seconds(), 0.0) / 3600
+    return likes / (age_hours + 2) ** TOP_FEED_GRAVITY
+
+
+def refresh_top_feeds(now: datetime | None = None) -> dict[str, int]:
+    """Recomputes every top feed, replacing their contents in one transaction. Returns
+    the number of posts in each one.
+    """
+    if now is None:
+        now = datetime_now_utc_naive()
+
+    feed_columns = [getattr(Post, "feed_" + feed) for feed in TOP_FEEDS.values()]
+    query = (
+        Post.select(Post.uri, Post.indexed_at, Post.likes, *feed_columns)
+        .join(Account, on=(Account.did == Post.author))
+        .where(
+            Post.indexed_at > now - TOP_FEED_WINDOW,
+            Post.likes > 0,
+            ~Post.hidden,
+            Account.is_valid,
+            ~Account.is_banned,
+            ~Account.is_muted,
+        )
+        .tuples()
+    )
+
+    rankings: dict[str, list[tuple[float, str]]] = {feed: [] for feed in TOP_FEEDS}
+    with DBConnection():
+        for uri, indexed_at, likes, *in_feeds in query:
+            score = score_post(likes, now - indexed_at)
+            for top_feed, in_feed in zip(TOP_FEEDS, in_feeds):
+                if in_feed:
+                    rankings[top_feed].append((score, uri))
+
+    rows = []
+    for top_feed, posts in rankings.items():
+        posts.sort(reverse=True)
+        del posts[TOP_FEED_SIZE:]
+        rows.extend(
+            dict(feed=top_feed, rank=rank, uri=uri, score=score, computed_at=now)
+            for rank, (score, uri) in enumerate(posts)
+        )
+
+    with DBConnection() as db, db.atomic():
+        TopPost.delete().execute()
+        for batch in peewee.chunked(rows, 500):
+            TopPost.insert_many(batch).execute()
+
+    logger.info(f"Refreshed top feeds with {len(rows)} posts")
+    return {top_feed: len(posts) for top_feed, posts in rankings.items()}
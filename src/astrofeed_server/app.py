@@ -11,7 +11,7 @@ from astrofeed_lib.algorithm import (
     get_feed_logs_by_date,
     get_feed_stats,
 )
-from astrofeed_lib.database import get_database, setup_connection, teardown_connection
+from astrofeed_lib.database import get_database, teardown_connection
 from astrofeed_server.auth import AuthorizationError, validate_auth
 from astrofeed_server.request_log import request_log
 from astrofeed_server.cors import enable_cross_origin_requests
@@ -37,23 +37,10 @@ if not config.ASTROFEED_PRODUCTION:
     enable_cross_origin_requests(app)
 
 
-# -----------------------------------
-# REQUEST HOOKS
-# -----------------------------------
-# This hook ensures that a connection is opened to handle any queries
-# generated by the request.
-@app.before_request
-def _db_connect():
-    if get_database().is_closed():
-        setup_connection(get_database())
-
-
-# This hook ensures that the connection is closed when we've finished
-# processing the request.
-@app.teardown_request
-def _db_close(exc):
-    if not get_database().is_closed():
-        teardown_connection(get_database())
+# N.B.: requests don't open a database connection up front. Code that queries the
+# database does so in a DBConnection scope, so that feed requests only connect to the
+# read replica (if there is one), and requests that don't need the database (like
+# did.json) never connect at all.
 
 
 # -----------------------------------
@@ -162,9 +149,9 @@ def get_feed_skeleton():
     finally:
         pass
 
-    # Add pinned instruction post
+    # Add pinned instruction post, except to ranked feeds, which don't have one
     # See: https://bsky.app/profile/did:plc:jcoy7v3a2t4rcfdh6i4kza25/post/3kc632qlmnm2j
-    if cursor is None:
+    if cursor is None and feed not in config.TOP_FEEDS:
         add_pinned_post_to_feed(body, feed)
 
     return jsonify(body)
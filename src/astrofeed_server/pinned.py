@@ -1,6 +1,6 @@
 import json
 import random
-from astrofeed_lib import DATA_DIRECTORY, logger
+from astrofeed_lib import DATA_DIRECTORY, config, logger
 
 # DIDs
 # emily.space: did:plc:jcoy7v3a2t4rcfdh6i4kza25
@@ -27,6 +27,8 @@ with open(DATA_DIRECTORY / "pinned_posts.json") as handle:
 
 
 def add_pinned_post_to_feed(body, feed):
+    # Feeds without replies share the pinned post of the feed they're made from
+    feed = config.NO_REPLIES_FEEDS.get(feed, feed)
     if feed not in DEFAULT_PINNED_POSTS:
         logger.warning(f"Pinned post for feed {feed} not set.")
         return
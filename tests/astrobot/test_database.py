@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from astrobot.database import get_candidate_stale_bot_actions
+from astrofeed_lib.database import BotActions, DBConnection
+
+
+def test_candidate_stale_bot_actions(sqlite_db_conn):
+    """incomplete actions of the right type should be returned, least recently checked
+    first
+    """
+    now = datetime.now()
+    with DBConnection():
+        for i, (type, complete) in enumerate(
+            [("signup", False), ("signup", True), ("other", False), ("signup", False)]
+        ):
+            BotActions.create(
+                indexed_at=now - timedelta(hours=1),
+                checked_at=now - timedelta(minutes=i),
+                did=f"did:plc:{i}",
+                type=type,
+                stage="get_moderator",
+                complete=complete,
+                latest_uri=f"at://signup/{i}",
+                latest_cid=f"cid{i}",
+            )
+
+    uris, ids = get_candidate_stale_bot_actions(["signup"])
+    assert uris == ["at://signup/3", "at://signup/0"]
+    with DBConnection():
+        assert ids == [BotActions.get(BotActions.latest_uri == uri).id for uri in uris]
@@ -0,0 +1,21 @@
+from astrobot import moderation
+from astrobot.moderation import ban_user, signup_user
+from astrofeed_lib.database import Account, DBConnection
+
+
+def test_failed_account_change_not_reported(sqlite_db_conn, monkeypatch):
+    """signups and bans should still succeed if other processes can't be told about
+    them straight away
+    """
+
+    def fail(did):
+        raise OSError("no notifications today")
+
+    monkeypatch.setattr(moderation, "publish_account_change", fail)
+    signup_user("did:plc:AAAA", "did:plc:MOD", handle="alice")
+    assert ban_user("did:plc:AAAA", "did:plc:MOD", "spam") == (
+        "User banned from feeds successfully."
+    )
+    with DBConnection():
+        account = Account.get(Account.did == "did:plc:AAAA")
+    assert account.is_valid and account.is_banned
@@ -0,0 +1,148 @@
+import pytest
+from atproto import models
+
+from astrofeed_firehose import apply_commit
+from astrofeed_firehose.apply_commit import (
+    _classify_posts,
+    _get_facet_tags,
+    _new_ops,
+    apply_ops,
+)
+from astrofeed_firehose.likes import LikeCounter
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_lib.database import DBConnection, Post, hash_uri
+
+
+class _Accounts:
+    def get_accounts(self):
+        return {"did"}
+
+
+def _created_post(
+    i: int,
+    reply_root: str | None = None,
+    text: str = "Look at this 🔭",
+    cid: str | None = None,
+    facets: list | None = None,
+) -> dict:
+    reply = None
+    if reply_root is not None:
+        root = models.ComAtprotoRepoStrongRef.Main(uri=reply_root, cid="cid")
+        reply = models.AppBskyFeedPost.ReplyRef(root=root, parent=root)
+    record = models.AppBskyFeedPost.Record(
+        text=text, created_at="2025-03-01T00:00:00Z", reply=reply, facets=facets
+    )
+    cid = cid if cid is not None else f"cid{i}"
+    return {"record": record, "uri": f"at://{i}", "cid": cid, "author": "did"}
+
+
+@pytest.fixture(scope="function")
+def apply(sqlite_db_conn, monkeypatch):
+    """applies ops of posts by a signed up account"""
+    monkeypatch.setattr(apply_commit, "VALID_ACCOUNTS", _Accounts())
+    monkeypatch.setattr(apply_commit, "LIKES", LikeCounter())
+    monkeypatch.setattr(apply_commit, "POSTS", PostWriter())
+
+    def apply(created=(), updated=(), deleted=()):
+        ops = _new_ops()
+        ops["posts"]["created"].extend(created)
+        ops["posts"]["updated"].extend(updated)
+        ops["posts"]["deleted"].extend(
+            {"uri": f"at://{i}", "author": "did"} for i in deleted
+        )
+        apply_ops(ops, 1)
+        apply_commit.POSTS.flush()
+
+    with DBConnection():
+        yield apply
+
+
+def test_classify_replies():
+    """replies should be flagged, along with a hash of the root of their thread"""
+    posts, feed_counts = _classify_posts(
+        [_created_post(0), _created_post(1, reply_root="at://0")]
+    )
+    assert posts[0]["is_reply"] is False
+    assert posts[0]["reply_root"] is None
+    assert posts[1]["is_reply"] is True
+    assert posts[1]["reply_root"] == hash_uri("at://0")
+    assert feed_counts["feed_astro"] == 2
+
+
+def test_classify_with_facets():
+    """hashtags should also be taken from tag facets, ignoring other kinds of facet"""
+    facet = models.AppBskyRichtextFacet.Main(
+        index=models.AppBskyRichtextFacet.ByteSlice(byte_start=0, byte_end=6),
+        features=[
+            models.AppBskyRichtextFacet.Tag(tag="astro"),
+            models.AppBskyRichtextFacet.Link(uri="https://example.com"),
+        ],
+    )
+    posts, _ = _classify_posts(
+        [_created_post(0, text="#astro。今夜は晴れ", facets=[facet])]
+    )
+    assert posts[0]["feed_astro"] is True
+
+
+def test_facet_tags_of_unvalidated_records():
+    """records that don't validate (e.g. with a new kind of facet) are DotDicts, but
+    their tag facets should still be found
+    """
+    record = models.get_or_create(
+        {
+            "$type": "app.bsky.feed.post",
+            "text": "#astro",
+            "createdAt": "2025-03-01T00:00:00Z",
+            "facets": [
+                {
+                    "index": {"byteStart": 0, "byteEnd": 6},
+                    "features": [
+                        {"$type": "app.bsky.richtext.facet#tag", "tag": "astro"},
+                        {"$type": "app.bsky.richtext.facet#new"},
+                    ],
+                }
+            ],
+        },
+        strict=False,
+    )
+    assert isinstance(record, models.dot_dict.DotDict)
+    assert _get_facet_tags(record) == ["astro"]
+
+
+def test_edited_posts_reclassified(apply):
+    """edits should update the text and feed labels of posts that have changed"""
+    apply(created=[_created_post(0), _created_post(1)])
+    apply(
+        updated=[
+            _created_post(0, text="Nothing to see here", cid="edited0"),
+            _created_post(1, cid="edited1"),
+            _created_post(2, cid="edited2"),  # Never stored
+        ]
+    )
+
+    edited = Post.get(Post.uri == "at://0")
+    assert edited.text == "Nothing to see here"
+    assert edited.cid == "edited0"
+    assert edited.feed_astro is False
+    assert edited.feed_all is True
+
+    # Edits that don't change anything we store aren't written
+    unchanged = Post.get(Post.uri == "at://1")
+    assert unchanged.cid == "cid1"
+    assert unchanged.feed_astro is True
+    assert Post.select().count() == 2
+
+
+def test_posts_deleted(apply):
+    """creates, deletes and edits should all be applied in one go"""
+    apply(created=[_created_post(0), _created_post(1)])
+    apply(
+        created=[_created_post(2)],
+        updated=[_created_post(1, text="Jupiter 🔭", cid="edited1")],
+        deleted=[0],
+    )
+    assert [post.uri for post in Post.select().order_by(Post.uri)] == [
+        "at://1",
+        "at://2",
+    ]
+    assert Post.get(Post.uri == "at://1").text == "Jupiter 🔭"
@@ -0,0 +1,94 @@
+import libipld
+from atproto import firehose_models
+from faster_fifo import Queue
+
+from astrofeed_firehose.capture import (
+    BackgroundCaptureWriter,
+    CaptureWriter,
+    encode_frame,
+    read_capture,
+)
+from astrofeed_firehose.commit_processor import _process_commit
+from astrofeed_firehose.replay import run_replayer
+
+_CID = libipld.decode_multibase(
+    "bafyreie5737gdxlw5i64vzichcalba3z2v5n6icifvx5xytvske7mr3hpm"
+)[1]
+
+
+def _commit_frame(seq: int) -> firehose_models.MessageFrame:
+    """an (empty) commit frame, as decoded by the firehose client"""
+    body = {
+        "seq": seq,
+        "rebase": False,
+        "tooBig": False,
+        "repo": "did:plc:AAAA",
+        "commit": _CID,
+        "rev": "3l3qo2vutsw2b",
+        "since": None,
+        "blocks": b"",
+        "ops": [],
+        "blobs": [],
+        "time": "2025-03-01T00:00:00.000Z",
+    }
+    raw_frame = libipld.encode_dag_cbor({"op": 1, "t": "#commit"})
+    raw_frame += libipld.encode_dag_cbor(body)
+    return firehose_models.Frame.from_bytes(raw_frame)
+
+
+class _Value:
+    value = 0
+
+
+def test_capture_round_trip(tmp_path):
+    """frames should be read back exactly as they were recorded"""
+    path = str(tmp_path / "capture.bin")
+    frames = [_commit_frame(seq) for seq in range(5)]
+    with CaptureWriter(path) as writer:
+        for frame in frames[:3]:
+            writer.write(frame)
+    # Captures can be appended to
+    with CaptureWriter(path) as writer:
+        for frame in frames[3:]:
+            writer.write(frame)
+
+    raw_frames = [bytes(frame) for frame in read_capture(path)]
+    assert raw_frames == [encode_frame(frame) for frame in frames]
+    assert [firehose_models.Frame.from_bytes(f) for f in raw_frames] == frames
+
+
+def test_background_capture(tmp_path):
+    """frames written from the background thread should all be there after closing"""
+    path = str(tmp_path / "capture.bin")
+    frames = [_commit_frame(seq) for seq in range(100)]
+    with BackgroundCaptureWriter(path) as writer:
+        for frame in frames:
+            writer.write(frame)
+    assert writer.frames_written == 100
+    raw_frames = [bytes(frame) for frame in read_capture(path)]
+    assert raw_frames == [encode_frame(frame) for frame in frames]
+
+
+def test_partial_frame_ignored(tmp_path):
+    """a capture that was cut off mid-frame should still be readable"""
+    path = tmp_path / "capture.bin"
+    with CaptureWriter(str(path)) as writer:
+        writer.write(_commit_frame(1))
+        writer.write(_commit_frame(2))
+    path.write_bytes(path.read_bytes()[:-10])
+    assert len(list(read_capture(str(path)))) == 1
+
+
+def test_replay_to_commit_processor(tmp_path, sqlite_db_conn):
+    """replayed frames should be processed the same as frames from the firehose"""
+    path = str(tmp_path / "capture.bin")
+    with CaptureWriter(path) as writer:
+        for seq in range(250):
+            writer.write(_commit_frame(seq))
+
+    queue = Queue(1024**2)
+    assert run_replayer(queue, path, _Value()) == 250
+    messages = []
+    while len(messages) < 250:
+        messages.extend(queue.get_many(timeout=1.0))
+    assert [_process_commit(message) for message in messages] == list(range(250))
@@ -0,0 +1,101 @@
+import asyncio
+from multiprocessing import Value
+
+import pytest
+from atproto.exceptions import FirehoseError
+from atproto_client.models.common import XrpcError
+from faster_fifo import Queue
+
+from astrofeed_firehose import firehose_client
+from astrofeed_firehose.capture import encode_frame, read_capture
+from astrofeed_firehose.firehose_client import get_reconnect_delay, run_client_async
+from astrofeed_firehose.synthetic import SyntheticFirehose
+
+
+class _StopTest(Exception):
+    pass
+
+
+class _FakeClient:
+    def __init__(self, start_cursor, connections):
+        """Sends the frames of the next connection, then fails like the relay would."""
+        self.start_cursor = start_cursor
+        self.frames, self.error = connections.pop(0)
+
+    def update_params(self, params):
+        pass
+
+    async def start(self, on_message_handler):
+        for frame in self.frames:
+            await on_message_handler(frame)
+        raise self.error
+
+
+def test_reconnect_delay(monkeypatch):
+    monkeypatch.setattr(firehose_client, "RECONNECT_BASE_DELAY", 1.0)
+    monkeypatch.setattr(firehose_client, "RECONNECT_MAX_DELAY", 10.0)
+    delays = [get_reconnect_delay(3) for _ in range(100)]
+    assert all(0 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1  # jittered
+    assert max(get_reconnect_delay(20) for _ in range(100)) <= 10
+
+
+def test_reconnect_resumes_from_last_commit(monkeypatch):
+    """after ConsumerTooSlow, the client should resume from the last commit it received
+    (rather than the saved cursor), skipping any commits that the relay sends again
+    """
+    frames = SyntheticFirehose().commits(8)
+    too_slow = FirehoseError(XrpcError("ConsumerTooSlow", "too slow"))
+    connections = [(frames[:5], too_slow), (frames[3:], _StopTest())]
+    clients = []
+
+    def get_client(start_cursor):
+        clients.append(_FakeClient(start_cursor, connections))
+        return clients[-1]
+
+    monkeypatch.setattr(firehose_client, "_get_client", get_client)
+    monkeypatch.setattr(firehose_client, "RECONNECT_BASE_DELAY", 0.0)
+    replayed_before = firehose_client.FIREHOSE_REPLAYED_COMMITS.get()
+    reconnects_before = firehose_client.FIREHOSE_RECONNECTS.get(error="ConsumerTooSlow")
+
+    queue = Queue(1024 * 1024)
+    cursor, process_time = Value("L", 1234), Value("d", 0.0)
+    received_count = Value("L", 0)
+    with pytest.raises(_StopTest):
+        asyncio.run(
+            run_client_async(queue, cursor, process_time, received_count=received_count)
+        )
+
+    # The first connection starts from the workers' cursor, the second from the
+    # last commit received
+    assert [client.start_cursor for client in clients] == [1234, 5]
+    seqs = []
+    while len(seqs) < 8:
+        seqs.extend(frame.body["seq"] for frame in queue.get_many(timeout=5))
+    assert seqs == list(range(1, 9))
+    assert received_count.value == 8
+    assert firehose_client.FIREHOSE_REPLAYED_COMMITS.get() - replayed_before == 2
+    assert (
+        firehose_client.FIREHOSE_RECONNECTS.get(error="ConsumerTooSlow")
+        - reconnects_before
+        == 1
+    )
+
+
+def test_capture_closed_when_client_stops(monkeypatch, tmp_path):
+    """every frame received should be in the capture file once the client stops"""
+    frames = SyntheticFirehose().commits(20)
+    connections = [(frames, _StopTest())]
+    path = str(tmp_path / "capture.bin")
+    monkeypatch.setattr(
+        firehose_client, "_get_client", lambda cursor: _FakeClient(cursor, connections)
+    )
+    monkeypatch.setattr(firehose_client, "CAPTURE_PATH", path)
+
+    queue = Queue(1024 * 1024)
+    cursor, process_time = Value("L", 1), Value("d", 0.0)
+    with pytest.raises(_StopTest):
+        asyncio.run(run_client_async(queue, cursor, process_time))
+
+    captured = [bytes(frame) for frame in read_capture(path)]
+    assert captured == [encode_frame(frame) for frame in frames]
@@ -0,0 +1,244 @@
+import asyncio
+import json
+from multiprocessing import Value
+
+from atproto import parse_subscribe_repos_message
+from faster_fifo import Queue
+
+from astrofeed_firehose import (
+    apply_commit,
+    commit_processor,
+    firehose_client,
+    jetstream,
+)
+from astrofeed_firehose.apply_commit import (
+    _get_ops_by_type,
+    _get_ops_from_jetstream_event,
+)
+from astrofeed_firehose.commit_processor import _process_commit, _update_cursor
+from astrofeed_firehose.jetstream import (
+    JETSTREAM_CURSOR_SERVICE,
+    run_jetstream_client_async,
+)
+from astrofeed_firehose.likes import LikeCounter
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_firehose.synthetic import LocalJetstream, SyntheticFirehose
+from astrofeed_lib.database import DBConnection, Post, SubscriptionState
+
+
+class _Accounts:
+    def __init__(self, accounts):
+        self.accounts = set(accounts)
+        self.version = 1
+
+    def get_accounts(self):
+        return self.accounts
+
+
+def _summarize(ops: dict) -> dict:
+    return {
+        "created": [
+            (post["uri"], post["cid"], post["author"], post["record"].text)
+            for post in ops["posts"]["created"]
+        ],
+        "deleted": ops["posts"]["deleted"],
+        "likes": [like["uri"] for like in ops["likes"]["created"]],
+    }
+
+
+def test_jetstream_ops_match_relay_ops():
+    """Jetstream events should be sorted the same as the same commits from the relay"""
+    frames = SyntheticFirehose(seed=1, delete_ratio=0.2).commits(200)
+    events = SyntheticFirehose(seed=1, delete_ratio=0.2).jetstream_events(200)
+    for frame, event in zip(frames, events):
+        relay_ops = _get_ops_by_type(parse_subscribe_repos_message(frame))
+        jetstream_ops = _get_ops_from_jetstream_event(json.loads(json.dumps(event)))
+        assert _summarize(jetstream_ops) == _summarize(relay_ops)
+
+
+def test_jetstream_events_processed(sqlite_db_conn, monkeypatch):
+    """workers should add posts from Jetstream events, returning their time as the
+    cursor
+    """
+    firehose = SyntheticFirehose(
+        signed_up_accounts=1, signed_up_ratio=1, post_ratio=1, like_ratio=0
+    )
+    monkeypatch.setattr(
+        apply_commit, "VALID_ACCOUNTS", _Accounts([firehose.signed_up_did(0)])
+    )
+    monkeypatch.setattr(apply_commit, "LIKES", LikeCounter())
+    monkeypatch.setattr(apply_commit, "POSTS", PostWriter())
+    events = firehose.jetstream_events(10)
+    with DBConnection():
+        cursors = [_process_commit(json.dumps(event)) for event in events]
+        apply_commit.POSTS.flush()
+        assert Post.select().count() == sum(
+            event["commit"]["operation"] == "create"
+            and event["commit"]["collection"] == "app.bsky.feed.post"
+            for event in events
+        )
+    assert cursors == [event["time_us"] for event in events]
+
+
+def test_jetstream_cursor_saved(sqlite_db_conn, monkeypatch):
+    """Jetstream cursors (which are times, so rarely round numbers) should be kept up to
+    date for the client after every event, and saved to the database every
+    JETSTREAM_CURSOR_SAVE_INTERVAL seconds
+    """
+    monkeypatch.setattr(commit_processor, "SOURCE", "jetstream")
+    monkeypatch.setattr(commit_processor, "CURSOR_SERVICE", JETSTREAM_CURSOR_SERVICE)
+    monkeypatch.setattr(commit_processor, "POSTS", PostWriter())
+    monkeypatch.setattr(commit_processor, "_next_jetstream_cursor_save", 0.0)
+    with DBConnection():
+        SubscriptionState.create(service=JETSTREAM_CURSOR_SERVICE, cursor=0)
+
+    def saved_cursor():
+        with DBConnection():
+            state = SubscriptionState.get(
+                SubscriptionState.service == JETSTREAM_CURSOR_SERVICE
+            )
+        return state.cursor
+
+    cursor = Value("L", 0)
+    times_us = [1_740_787_200_123_457 + 7919 * i for i in range(5)]
+    for time_us in times_us:
+        _update_cursor(cursor, time_us)
+        assert cursor.value == time_us
+    # Saved on the first event, and then not again until the interval has passed
+    assert saved_cursor() == times_us[0]
+
+    monkeypatch.setattr(commit_processor, "_next_jetstream_cursor_save", 0.0)
+    _update_cursor(cursor, times_us[-1] + 1)
+    assert saved_cursor() == times_us[-1] + 1
+
+
+def test_jetstream_client(monkeypatch):
+    """the client should only be sent posts by signed up accounts, and resume from the
+    latest event it received when the server disconnects it
+    """
+    monkeypatch.setattr(firehose_client, "RECONNECT_BASE_DELAY", 0.0)
+    firehose = SyntheticFirehose(signed_up_accounts=5, signed_up_ratio=0.5, seed=2)
+    events = firehose.jetstream_events(300)
+    signed_up = {firehose.signed_up_did(i) for i in range(5)}
+    wanted = [
+        event
+        for event in events
+        if event["did"] in signed_up
+        and event["commit"]["collection"] == "app.bsky.feed.post"
+    ]
+    server = LocalJetstream(events, disconnect_after=len(wanted) // 2)
+    queue = Queue(1024 * 1024)
+
+    async def run():
+        await server.serve()
+        client = asyncio.create_task(
+            run_jetstream_client_async(
+                queue,
+                Value("L", 1),
+                Value("d", 0.0),
+                uri=server.uri,
+                accounts=_Accounts(signed_up),
+            )
+        )
+        received = []
+        while len(received) < len(wanted):
+            await asyncio.sleep(0.05)
+            received.extend(queue.get_many_nowait() if not queue.empty() else [])
+        client.cancel()
+        server.server.close()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert [json.loads(event) for event in received] == wanted
+    assert server.connections[0]["cursor"] == "1"
+    assert server.connections[1]["cursor"] == str(
+        wanted[len(wanted) // 2 - 1]["time_us"]
+    )
+    assert set(server.connections[0]["options"]["wantedDids"]) == signed_up
+
+
+class _FailingAccounts(_Accounts):
+    def __init__(self, accounts, failures):
+        """Accounts that can't be fetched the first few times, like when the database
+        is down.
+        """
+        super().__init__(accounts)
+        self.failures = failures
+
+    def get_accounts(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("database is down")
+        return self.accounts
+
+
+def test_jetstream_client_retries_options(monkeypatch):
+    """the client should keep trying to send the accounts it wants posts from, rather
+    than waiting forever for events that the server won't send without them
+    """
+    monkeypatch.setattr(jetstream, "JETSTREAM_OPTIONS_INTERVAL", 0.05)
+    firehose = SyntheticFirehose(signed_up_accounts=1, signed_up_ratio=1, seed=3)
+    events = [
+        event
+        for event in firehose.jetstream_events(20)
+        if event["commit"]["collection"] == "app.bsky.feed.post"
+    ]
+    server = LocalJetstream(events)
+    queue = Queue(1024 * 1024)
+
+    async def run():
+        await server.serve()
+        client = asyncio.create_task(
+            run_jetstream_client_async(
+                queue,
+                Value("L", 1),
+                Value("d", 0.0),
+                uri=server.uri,
+                accounts=_FailingAccounts({firehose.signed_up_did(0)}, failures=2),
+            )
+        )
+        received = []
+        while len(received) < len(events):
+            await asyncio.sleep(0.05)
+            received.extend(queue.get_many_nowait() if not queue.empty() else [])
+        client.cancel()
+        server.server.close()
+        return received
+
+    received = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert [json.loads(event) for event in received] == events
+    assert len(server.connections) == 1
+
+
+def test_jetstream_client_idle(monkeypatch):
+    """the client should keep telling the watchdog that it's running while connected,
+    even when the server has no events to send it
+    """
+    monkeypatch.setattr(jetstream, "WATCHDOG_UPDATE_INTERVAL", 0.05)
+    server = LocalJetstream([])
+    firehose_time = Value("d", 0.0)
+
+    async def run():
+        await server.serve()
+        client = asyncio.create_task(
+            run_jetstream_client_async(
+                Queue(1024 * 1024),
+                Value("L", 1),
+                firehose_time,
+                uri=server.uri,
+                accounts=_Accounts({"did:plc:AAAA"}),
+            )
+        )
+        while not server.connections:
+            await asyncio.sleep(0.05)
+        times = []
+        for _ in range(4):
+            await asyncio.sleep(0.2)
+            times.append(firehose_time.value)
+        client.cancel()
+        server.server.close()
+        return times
+
+    times = asyncio.run(asyncio.wait_for(run(), timeout=10))
+    assert times == sorted(set(times))  # updated between every check
+    assert len(server.connections) == 1
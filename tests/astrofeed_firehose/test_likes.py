@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+from astrofeed_firehose.likes import LIKE_TRACKING_WINDOW, LikeCounter, RecentUriSet
+from astrofeed_lib.database import DBConnection, Post, PostLike, datetime_now_utc_naive
+
+
+def _ops(created=(), deleted=()):
+    """a _get_ops_by_type dict with the given likes, as (like uri, post uri) pairs"""
+    return {
+        "likes": {
+            "created": [
+                {
+                    "uri": uri,
+                    "record": SimpleNamespace(subject=SimpleNamespace(uri=post)),
+                }
+                for uri, post in created
+            ],
+            "deleted": [{"uri": uri} for uri in deleted],
+        }
+    }
+
+
+def _likes() -> dict[str, int]:
+    with DBConnection():
+        return dict(Post.select(Post.uri, Post.likes).tuples())
+
+
+def test_like_counter(sqlite_db_conn):
+    with DBConnection():
+        for uri in ("at://ours/1", "at://ours/2"):
+            Post.create(uri=uri, cid="cid", author="did:plc:AAAA", text="")
+
+    counter = LikeCounter()
+    counter.add_ops(
+        _ops(
+            created=[
+                ("at://like/1", "at://ours/1"),
+                ("at://like/2", "at://ours/1"),
+                ("at://like/3", "at://ours/2"),
+                ("at://like/4", "at://not-ours"),
+                ("at://like/5", "at://ours/2"),
+            ],
+            deleted=["at://like/5"],  # Created and deleted before a flush
+        )
+    )
+    counter.flush()
+    assert _likes() == {"at://ours/1": 2, "at://ours/2": 1}
+
+    # Deleting a like only takes effect if we counted it
+    counter.add_ops(_ops(deleted=["at://like/1", "at://like/4", "at://like/6"]))
+    # Replayed likes (e.g. after a restart) shouldn't be counted twice
+    counter.add_ops(_ops(created=[("at://like/3", "at://ours/2")]))
+    counter.flush()
+    assert _likes() == {"at://ours/1": 1, "at://ours/2": 1}
+    with DBConnection():
+        assert PostLike.select().count() == 2
+
+
+def test_recent_uri_set(sqlite_db_conn):
+    """posts added by other processes should be picked up by refreshes, and old posts
+    dropped by reloads
+    """
+    with DBConnection():
+        Post.create(uri="at://new", cid="cid", author="did:plc:AAAA", text="")
+        Post.create(
+            uri="at://old",
+            cid="cid",
+            author="did:plc:AAAA",
+            text="",
+            indexed_at=datetime_now_utc_naive() - LIKE_TRACKING_WINDOW * 2,
+        )
+
+    recent_posts = RecentUriSet(Post)
+    recent_posts.refresh_if_due()
+    assert "at://new" in recent_posts
+    assert "at://old" not in recent_posts
+
+    with DBConnection():
+        Post.create(uri="at://newer", cid="cid", author="did:plc:AAAA", text="")
+    recent_posts.refresh()
+    assert "at://newer" in recent_posts
+    assert len(recent_posts) == 2
+
+
+def test_likes_of_posts_from_other_processes(sqlite_db_conn):
+    """likes of posts written by other commit processors should be counted straight
+    away, but not likes of posts older than the tracking window
+    """
+    counter = LikeCounter()
+    counter.add_ops(_ops(created=[("at://like/1", "at://not-ours")]))
+    counter.flush()
+
+    with DBConnection():
+        Post.create(uri="at://theirs", cid="cid", author="did:plc:AAAA", text="")
+        Post.create(
+            uri="at://old",
+            cid="cid",
+            author="did:plc:AAAA",
+            text="",
+            indexed_at=datetime_now_utc_naive() - LIKE_TRACKING_WINDOW * 2,
+        )
+    counter.add_ops(
+        _ops(created=[("at://like/2", "at://theirs"), ("at://like/3", "at://old")])
+    )
+    counter.flush()
+    assert _likes() == {"at://theirs": 1, "at://old": 0}
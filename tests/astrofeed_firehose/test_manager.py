@@ -0,0 +1,97 @@
+import time
+
+import pytest
+
+from astrofeed_firehose import manager
+from astrofeed_firehose.manager import (
+    FirehoseProcessingManager,
+    ManagedProcess,
+    get_target_worker_count,
+)
+
+
+def _exit_immediately(last_active):
+    pass
+
+
+def _work_until_stopped(queue, cursor, last_active, should_stop=None, **kwargs):
+    while not should_stop.is_set():
+        last_active.value = time.time()
+        time.sleep(0.01)
+
+
+@pytest.fixture(scope="function")
+def idle_manager(monkeypatch):
+    """a manager with no processes of its own, to add test processes to"""
+    monkeypatch.setattr(manager, "_run_commit_processor", _work_until_stopped)
+    firehose_manager = FirehoseProcessingManager()
+    firehose_manager.workers, firehose_manager.services = [], []
+    firehose_manager.client = ManagedProcess("Client", _exit_immediately)
+    yield firehose_manager
+    firehose_manager.stop_processes()
+
+
+@pytest.mark.parametrize(
+    "queue_size, lag, utilization, expected",
+    [
+        (5000, 0, 0.5, 4),  # Commits are backing up
+        (0, 10000, 0.5, 4),  # We're falling behind the firehose
+        (0, 0, 0.95, 4),  # Workers are almost always busy
+        (0, 0, 0.1, 2),  # Workers are mostly idle
+        (500, 1000, 0.6, 3),  # Somewhere in between
+    ],
+)
+def test_target_worker_count(monkeypatch, queue_size, lag, utilization, expected):
+    monkeypatch.setattr(manager, "MIN_WORKER_COUNT", 1)
+    monkeypatch.setattr(manager, "MAX_WORKER_COUNT", 8)
+    assert get_target_worker_count(3, queue_size, lag, utilization) == expected
+
+
+def test_target_worker_count_bounds(monkeypatch):
+    monkeypatch.setattr(manager, "MIN_WORKER_COUNT", 2)
+    monkeypatch.setattr(manager, "MAX_WORKER_COUNT", 4)
+    assert get_target_worker_count(4, 5000, 0, 0.0) == 4
+    assert get_target_worker_count(2, 0, 0, 0.0) == 2
+
+
+def test_dead_processes_restarted(idle_manager, monkeypatch):
+    """dead processes should be restarted on their own, until they fail too often"""
+    monkeypatch.setattr(manager, "MANAGER_MAX_RESTARTS", 3)
+    for _ in range(3):
+        idle_manager._restart_failed_processes()
+        idle_manager.client.process.join()
+    assert idle_manager.client.restarts_in_last(60) == 3
+
+    with pytest.raises(RuntimeError, match="Client died"):
+        idle_manager._restart_failed_processes()
+
+
+def test_hung_processes_restarted(idle_manager):
+    idle_manager.workers.append(idle_manager._create_worker(1))
+    idle_manager.workers[0].start()
+    time.sleep(0.1)
+    first_process = idle_manager.workers[0].process
+
+    idle_manager.workers[0].kwargs["should_stop"].set()  # Stops updating last_active
+    idle_manager.workers[0].last_active.value = 0
+    idle_manager.client.start()
+    idle_manager._restart_failed_processes()
+    assert idle_manager.workers[0].process is not first_process
+    assert not first_process.is_alive()
+
+
+def test_add_and_remove_workers(idle_manager):
+    """workers should be added and removed without affecting the others"""
+    idle_manager.add_worker()
+    idle_manager.add_worker()
+    assert [worker.name for worker in idle_manager.workers] == [
+        "Commit processor 1",
+        "Commit processor 2",
+    ]
+    assert all(worker.is_alive() for worker in idle_manager.workers)
+
+    removed_worker = idle_manager.workers[-1]
+    idle_manager.remove_worker()
+    assert len(idle_manager.workers) == 1
+    assert removed_worker.process.exitcode == 0  # i.e. it stopped by itself
+    assert idle_manager.workers[0].is_alive()
@@ -0,0 +1,175 @@
+import time
+import urllib.request
+
+import pytest
+
+from astrofeed_firehose import apply_commit, commit_processor, post_writer
+from astrofeed_firehose.commit_processor import _process_commit
+from astrofeed_firehose.likes import LikeCounter
+from astrofeed_firehose.manager import FirehoseProcessingManager
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_firehose.synthetic import SyntheticFirehose
+from astrofeed_firehose.worker_stats import (
+    SharedWorkerStats,
+    WorkerStats,
+    combine_snapshots,
+)
+from astrofeed_lib.database import Account, DBConnection
+
+
+class _Accounts:
+    def __init__(self, accounts):
+        self.accounts = set(accounts)
+
+    def get_accounts(self):
+        return self.accounts
+
+
+@pytest.fixture(scope="function")
+def idle_manager():
+    """a manager with no processes, but one worker's worth of stats"""
+    firehose_manager = FirehoseProcessingManager()
+    firehose_manager.workers = firehose_manager.workers[:1]
+    yield firehose_manager
+    firehose_manager.stop_processes()
+
+
+def test_worker_stats_flush():
+    """totals should be added up across flushes, while latest values keep the highest"""
+    stats, shared = WorkerStats(), SharedWorkerStats()
+    stats.add("commits", 10)
+    stats.set_latest("saved_cursor", 2000)
+    stats.count_posts("inserted", [{"feed_astro": True, "feed_all": True}])
+    stats.flush(shared)
+    stats.add("commits", 5)
+    stats.set_latest("saved_cursor", 1000)
+    stats.flush(shared)
+
+    assert shared.get("commits") == 15
+    assert shared.get("saved_cursor") == 2000
+    assert shared.get("inserted_astro") == shared.get("inserted_all") == 1
+    assert shared.get("inserted_solar") == 0
+    assert stats.values[0] == 0
+
+    combined = combine_snapshots([shared.snapshot(), shared.snapshot()])
+    assert combined["commits"] == 30
+    assert combined["saved_cursor"] == 2000
+
+
+def test_stage_timers_exclusive():
+    """time spent in a stage inside another stage should only count towards the inner
+    one
+    """
+    stats, shared = WorkerStats(), SharedWorkerStats()
+    with stats.timer("parse"):
+        time.sleep(0.01)
+        with stats.timer("car"):
+            time.sleep(0.05)
+    stats.flush(shared)
+    assert 0.01 <= shared.get("parse_time") < 0.05
+    assert shared.get("car_time") >= 0.05
+
+
+def test_commits_traced():
+    """one in every trace_interval commits should have its stages timed"""
+    stats, shared = WorkerStats(trace_interval=2), SharedWorkerStats()
+    for cursor in range(5):
+        trace = stats.start_trace()
+        with stats.timer("parse"):
+            time.sleep(0.003)
+        if trace is not None:
+            stats.finish_trace(trace, cursor)
+    stats.flush(shared)
+
+    assert shared.get("traced_commits") == 2
+    # Every traced commit took 2.5-5 ms in total, almost all of which was parsing
+    for stage in ("parse", "total"):
+        assert shared.get(f"trace_{stage}_5") == 2
+        assert 0.006 <= shared.get(f"trace_{stage}_sum") < 0.01
+    assert shared.get("trace_database_0") == 2
+
+
+def test_processed_commits_counted(sqlite_db_conn, monkeypatch):
+    """processing commits should time each stage and count posts by feed"""
+    firehose = SyntheticFirehose(
+        signed_up_accounts=1,
+        signed_up_ratio=1,
+        post_ratio=1,
+        like_ratio=0,
+        follow_ratio=0,
+        delete_ratio=0,
+        feed_emoji_ratio=1,
+    )
+    stats = WorkerStats()
+    monkeypatch.setattr(apply_commit, "STATS", stats)
+    monkeypatch.setattr(commit_processor, "STATS", stats)
+    monkeypatch.setattr(post_writer, "STATS", stats)
+    monkeypatch.setattr(
+        apply_commit, "VALID_ACCOUNTS", _Accounts([firehose.signed_up_did(0)])
+    )
+    monkeypatch.setattr(apply_commit, "LIKES", LikeCounter())
+    monkeypatch.setattr(apply_commit, "POSTS", PostWriter())
+    with DBConnection():
+        Account.create(handle="a", did=firehose.signed_up_did(0), is_valid=True)
+        for raw_commit in firehose.raw_commits(20):
+            _process_commit(raw_commit)
+        apply_commit.POSTS.flush()
+
+    shared = SharedWorkerStats()
+    stats.flush(shared)
+    assert shared.get("inserted_all") == 20
+    assert shared.get("inserted_astro") > 0
+    assert all(
+        shared.get(f"{stage}_time") > 0
+        for stage in ("parse", "car", "records", "classify", "database")
+    )
+    # Commit times are from the synthetic firehose, which starts in March 2025
+    assert 1740787200 < shared.get("latest_commit_time") < 1740787201
+
+
+def test_manager_metrics(idle_manager):
+    """the manager should report the totals of every worker, including removed ones"""
+    worker_stats = idle_manager.workers[0].kwargs["stats"]
+    stats = WorkerStats(trace_interval=1)
+    stats.add("commits", 100)
+    stats.add("parse_time", 0.5)
+    stats.count_posts("deleted", [{"feed_astro": True}])
+    stats.finish_trace(stats.start_trace())
+    stats.flush(worker_stats)
+    idle_manager.retired_stats = worker_stats.snapshot()
+    idle_manager.received_count.value = 250
+    idle_manager.received_seq.value = 1000
+    idle_manager.processed_seq.value = 900
+
+    idle_manager.metrics.update_rates()
+    lines = idle_manager.metrics.render().splitlines()
+    assert 'firehose_commits_total{stage="received"} 250' in lines
+    assert 'firehose_commits_total{stage="processed"} 200' in lines
+    assert 'firehose_stage_seconds_total{stage="parse"} 1' in lines
+    assert 'firehose_posts_total{feed="astro",action="deleted"} 2' in lines
+    assert 'firehose_seq{position="processed"} 900' in lines
+    assert "firehose_lag_commits 100" in lines
+    assert "firehose_queue_commits 0" in lines
+    assert "firehose_workers 1" in lines
+    assert 'firehose_traced_commit_seconds_bucket{stage="total",le="0.0001"} 2' in lines
+    assert 'firehose_traced_commit_seconds_count{stage="parse"} 2' in lines
+    assert any(
+        line.startswith('firehose_worker_busy_fraction{worker="Commit processor 1"}')
+        for line in lines
+    )
+
+    # Totals shouldn't be counted twice
+    assert 'firehose_commits_total{stage="received"} 250' in (
+        idle_manager.metrics.render().splitlines()
+    )
+
+
+def test_manager_metrics_served(idle_manager):
+    server = idle_manager.metrics.serve(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert "# TYPE firehose_commits_total counter" in body
@@ -0,0 +1,150 @@
+import time
+from multiprocessing import Value
+
+import peewee
+from faster_fifo import Queue
+
+from astrofeed_firehose import apply_commit, commit_processor, post_writer
+from astrofeed_firehose.commit_processor import (
+    _get_messages_from_queue,
+    _update_cursor,
+)
+from astrofeed_firehose.config import DATABASE_CURSOR_UPDATE
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_lib.config import SERVICE_DID
+from astrofeed_lib.database import DBConnection, Post, SubscriptionState
+from astrofeed_lib.feeds import post_in_feeds
+
+
+def _post(i: int, text: str = "Look at this 🔭") -> dict:
+    return {
+        "uri": f"at://{i}",
+        "cid": f"cid{i}",
+        "author": "did",
+        "text": text,
+        "is_reply": False,
+        "reply_root": None,
+        **post_in_feeds(text),
+    }
+
+
+def test_posts_written_in_batches(sqlite_db_conn):
+    """posts should only be written once there are enough of them, or once the oldest
+    has waited long enough
+    """
+    writer = PostWriter(batch_size=3, latency_target=0.05)
+    with DBConnection():
+        writer.add(1, created=[_post(0), _post(1)])
+        writer.flush_if_due()
+        assert Post.select().count() == 0
+
+        writer.add(2, deleted=["at://5"])
+        writer.flush_if_due()
+        assert Post.select().count() == 2
+        assert writer.time_until_due() is None
+
+        writer.add(3, created=[_post(2)])
+        writer.flush_if_due()
+        assert Post.select().count() == 2
+        time.sleep(0.05)
+        assert writer.time_until_due() == 0.0
+        writer.flush_if_due()
+        assert Post.select().count() == 3
+
+
+def test_operations_applied_in_order(sqlite_db_conn):
+    """posts edited or deleted before they're written should end up as if every
+    operation had been written straight away
+    """
+    writer = PostWriter(batch_size=100)
+    with DBConnection():
+        writer.add(1, created=[_post(0), _post(1)])
+        writer.flush()
+
+        writer.add(2, created=[_post(2), _post(3)])
+        writer.add(3, updated=[_post(2, text="Edited")], deleted=["at://3"])
+        writer.add(4, deleted=["at://0"], created=[_post(4)])
+        writer.add(5, updated=[_post(1, text="Also edited")])
+        assert len(writer) == 5
+        writer.flush()
+
+        posts = {post.uri: post.text for post in Post.select()}
+    assert posts == {
+        "at://1": "Also edited",
+        "at://2": "Edited",
+        "at://4": "Look at this 🔭",
+    }
+
+
+def test_worker_stops_waiting_when_posts_due(monkeypatch):
+    """workers shouldn't wait for commits for longer than their posts can wait"""
+    writer = PostWriter(latency_target=0.1)
+    monkeypatch.setattr(commit_processor, "POSTS", writer)
+    monkeypatch.setattr(apply_commit, "POSTS", writer)
+    writer.add(1, deleted=["at://0"])
+
+    start = time.time()
+    assert _get_messages_from_queue(Queue(1024)) == []
+    assert time.time() - start < 5
+
+
+def test_failed_batch_retried_once(sqlite_db_conn, monkeypatch):
+    """a batch that can't be written should be tried once more, and then dropped"""
+    writer = PostWriter(batch_size=1)
+
+    def fail(cursor, posts):
+        raise peewee.OperationalError("database is locked")
+
+    with DBConnection():
+        monkeypatch.setattr(post_writer, "_create_posts", fail)
+        writer.add(1, created=[_post(0)])
+        writer.flush_if_due()
+        assert len(writer) == 1
+
+        writer.flush_if_due()
+        assert len(writer) == 0
+
+        monkeypatch.undo()
+        writer.add(2, created=[_post(1)])
+        writer.flush_if_due()
+        writer.add(3, created=[_post(2)])
+        monkeypatch.setattr(post_writer, "_create_posts", fail)
+        writer.flush_if_due()
+        monkeypatch.undo()
+        writer.flush_if_due()
+        assert [post.uri for post in Post.select()] == ["at://1", "at://2"]
+
+
+def test_failed_batch_before_cursor(sqlite_db_conn, monkeypatch):
+    """posts that can't be written before saving the cursor shouldn't stop the worker,
+    and the cursor shouldn't be saved past them
+    """
+    writer = PostWriter()
+    monkeypatch.setattr(commit_processor, "POSTS", writer)
+    monkeypatch.setattr(commit_processor, "SOURCE", "relay")
+    monkeypatch.setattr(commit_processor, "CURSOR_SERVICE", SERVICE_DID)
+    with DBConnection():
+        SubscriptionState.create(service=SERVICE_DID, cursor=0)
+
+    def fail(cursor, posts):
+        raise peewee.OperationalError("database is locked")
+
+    create_posts = post_writer._create_posts
+    monkeypatch.setattr(post_writer, "_create_posts", fail)
+    writer.add(1, created=[_post(0)])
+    cursor = Value("L", 0)
+    _update_cursor(cursor, DATABASE_CURSOR_UPDATE)
+    assert cursor.value == DATABASE_CURSOR_UPDATE
+    with DBConnection():
+        assert (
+            SubscriptionState.get(SubscriptionState.service == SERVICE_DID).cursor == 0
+        )
+
+    # The posts are tried again before the next cursor is saved
+    monkeypatch.setattr(post_writer, "_create_posts", create_posts)
+    _update_cursor(cursor, 2 * DATABASE_CURSOR_UPDATE)
+    with DBConnection():
+        assert [post.uri for post in Post.select()] == ["at://0"]
+        assert SubscriptionState.get(
+            SubscriptionState.service == SERVICE_DID
+        ).cursor == (2 * DATABASE_CURSOR_UPDATE)
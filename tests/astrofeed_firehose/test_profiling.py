@@ -0,0 +1,45 @@
+import os
+import pstats
+import signal
+import time
+
+from astrofeed_firehose.profiling import (
+    PROFILE_SIGNAL,
+    combine_profiles,
+    request_snapshots,
+    start_profiling,
+)
+
+
+def _busy_work():
+    return sum(i * i for i in range(10000))
+
+
+def test_profile_snapshots_combined(tmp_path):
+    """workers should write their profile on a signal, which can then be combined"""
+    previous_handler = signal.getsignal(PROFILE_SIGNAL)
+    profiler = start_profiling("Commit processor 1", str(tmp_path))
+    try:
+        _busy_work()
+        start = time.time()
+        request_snapshots([os.getpid()])
+        _busy_work()
+        request_snapshots([os.getpid()])
+    finally:
+        profiler.disable()
+        signal.signal(PROFILE_SIGNAL, previous_handler)
+
+    snapshots = sorted(os.listdir(tmp_path))
+    assert len(snapshots) == 2
+    assert all(
+        name.startswith(f"astrofeed-firehose-profile-commit-processor-1-{os.getpid()}-")
+        for name in snapshots
+    )
+
+    path = combine_profiles(str(tmp_path), since=start - 1)
+    assert path is not None
+    functions = {function for _, _, function in pstats.Stats(path).stats}
+    assert "_busy_work" in functions
+
+    # Combined profiles aren't combined again, and nor are older snapshots
+    assert combine_profiles(str(tmp_path), since=time.time() + 60) is None
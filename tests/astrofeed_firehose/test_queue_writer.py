@@ -0,0 +1,56 @@
+import threading
+import time
+
+from atproto import firehose_models
+from faster_fifo import Queue
+
+from astrofeed_firehose.queue_writer import QueueWriter
+from astrofeed_firehose.synthetic import SyntheticFirehose
+
+
+def _get_seqs(queue: Queue, count: int) -> list[int]:
+    seqs = []
+    while len(seqs) < count:
+        for message in queue.get_many(timeout=5):
+            if isinstance(message, bytes):
+                message = firehose_models.Frame.from_bytes(message)
+            seqs.append(message.body["seq"])
+    return seqs
+
+
+def test_overflow_to_disk(tmp_path):
+    """commits should go to disk instead of blocking when the buffer is full, and then
+    be sent on in order
+    """
+    queue = Queue(1024 * 64)
+    writer = QueueWriter(queue, buffer_size=10, overflow_directory=str(tmp_path))
+    writer.start()
+
+    # Nothing reads from the queue yet, so it fills up
+    for frame in SyntheticFirehose().commits(500):
+        writer.put(frame)
+    assert writer.commits_on_disk > 0
+    assert list(tmp_path.iterdir())
+
+    assert _get_seqs(queue, 500) == list(range(1, 501))
+    time.sleep(0.1)
+    assert writer.commits_on_disk == 0
+    assert not list(tmp_path.iterdir())
+
+
+def test_waits_without_overflow():
+    """without an overflow directory, put should wait for space in the buffer"""
+    queue = Queue(1024 * 64)
+    writer = QueueWriter(queue, buffer_size=10, overflow_directory=None)
+    writer.start()
+    frames = SyntheticFirehose().commits(500)
+
+    thread = threading.Thread(target=lambda: [writer.put(frame) for frame in frames])
+    thread.start()
+    time.sleep(0.5)
+    assert thread.is_alive()
+    assert len(writer.buffer) == 10
+
+    assert _get_seqs(queue, 500) == list(range(1, 501))
+    thread.join(timeout=5)
+    assert not thread.is_alive()
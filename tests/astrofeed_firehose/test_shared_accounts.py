@@ -0,0 +1,48 @@
+from multiprocessing import Value
+
+from astrofeed_firehose.shared_accounts import SharedAccountSet, write_account_hashes
+
+DIDS = {f"did:plc:{i:024d}" for i in range(1000)}
+
+
+def test_membership(tmp_path):
+    """the shared set should contain exactly the DIDs that were published"""
+    path = str(tmp_path / "accounts")
+    version = Value("L", 0)
+    assert write_account_hashes(path, DIDS) == len(DIDS)
+    version.value += 1
+
+    accounts = SharedAccountSet(path, version).get_accounts()
+    assert len(accounts) == len(DIDS)
+    assert all(did in accounts for did in DIDS)
+    assert "did:plc:notsignedup" not in accounts
+
+
+def test_reload_swaps_set(tmp_path):
+    """publishing a new set should be picked up on the next get_accounts call"""
+    path = str(tmp_path / "accounts")
+    version = Value("L", 0)
+    write_account_hashes(path, ["did:plc:AAAA"])
+    version.value += 1
+    accounts = SharedAccountSet(path, version)
+    assert "did:plc:AAAA" in accounts.get_accounts()
+
+    # Until the version changes, the old (still mapped) set is used
+    write_account_hashes(path, ["did:plc:BBBB"])
+    assert "did:plc:AAAA" in accounts.get_accounts()
+
+    version.value += 1
+    assert "did:plc:AAAA" not in accounts.get_accounts()
+    assert "did:plc:BBBB" in accounts.get_accounts()
+
+
+def test_empty_set(tmp_path):
+    """an empty set can't be memory-mapped, but should still work"""
+    path = str(tmp_path / "accounts")
+    version = Value("L", 0)
+    write_account_hashes(path, [])
+    version.value += 1
+
+    accounts = SharedAccountSet(path, version).get_accounts()
+    assert len(accounts) == 0
+    assert "did:plc:AAAA" not in accounts
@@ -0,0 +1,62 @@
+import pytest
+from atproto import parse_subscribe_repos_message
+
+from astrofeed_firehose import apply_commit
+from astrofeed_firehose.apply_commit import _get_ops_by_type
+from astrofeed_firehose.benchmark import measure_import_time, run_benchmarks
+from astrofeed_firehose.likes import LikeCounter
+from astrofeed_firehose.post_writer import PostWriter
+from astrofeed_firehose.synthetic import SyntheticFirehose
+from astrofeed_lib.accounts import CachedAccountQuery
+
+
+def test_synthetic_commits():
+    """synthetic commits should decode like real ones, with the requested mix of ops"""
+    firehose = SyntheticFirehose(
+        post_ratio=1, like_ratio=1, follow_ratio=0, delete_ratio=0, seed=1
+    )
+    counts = {"posts": 0, "likes": 0, "follows": 0}
+    for frame in firehose.commits(200):
+        ops = _get_ops_by_type(parse_subscribe_repos_message(frame))
+        for op_type in counts:
+            counts[op_type] += len(ops[op_type]["created"])
+
+    assert counts["posts"] + counts["likes"] == 200
+    assert 50 < counts["posts"] < 150
+    # Likes are of earlier posts
+    like = ops["likes"]["created"] or ops["posts"]["created"]
+    assert like[0]["uri"].startswith("at://did:plc:")
+
+    # The same seed should give the same commits
+    assert SyntheticFirehose(seed=2).raw_commits(5) == SyntheticFirehose(
+        seed=2
+    ).raw_commits(5)
+
+
+def test_benchmark_runs(tmp_path, monkeypatch):
+    """a small run of the benchmarks, so that they don't silently break"""
+    # Don't reuse accounts cached by other tests
+    monkeypatch.setattr(apply_commit, "VALID_ACCOUNTS", CachedAccountQuery())
+    monkeypatch.setattr(apply_commit, "LIKES", LikeCounter())
+    monkeypatch.setattr(apply_commit, "POSTS", PostWriter())
+    results = run_benchmarks(
+        200,
+        directory=str(tmp_path),
+        include_manager=False,
+        include_imports=False,
+        signed_up_ratio=0.5,
+    )
+    assert set(results["stages"]) == {
+        "post_in_feeds",
+        "get_ops_by_type",
+        "process_commit",
+    }
+    assert all(stage["ops"] == 200 for stage in results["stages"].values())
+    assert results["posts_added"] > 0
+
+
+def test_import_time_measured():
+    """import times should be broken down by top-level package"""
+    result = measure_import_time("astrofeed_firehose.synthetic")
+    assert result["packages_ms"]["astrofeed_firehose"] > 0
+    assert result["total_ms"] == pytest.approx(sum(result["packages_ms"].values()))
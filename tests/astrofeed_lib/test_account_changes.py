@@ -0,0 +1,52 @@
+from astrofeed_lib.account_changes import (
+    get_account_change_listener,
+    publish_account_change,
+)
+from astrofeed_lib.accounts import CachedAccountQuery, CachedBannedList
+from astrofeed_lib.database import Account, AccountChange, DBConnection
+
+
+def _create_account(did: str, is_valid: bool):
+    with DBConnection():
+        Account.create(handle=did, did=did, is_valid=is_valid)
+
+
+def test_published_changes_apply_before_next_refresh(sqlite_db_conn):
+    """a published change should be picked up without waiting for query_interval"""
+    _create_account("did:plc:AAAA", False)
+    valid_accounts = CachedAccountQuery(flags=[Account.is_valid], query_interval=3600)
+    banned_accounts = CachedBannedList(query_interval=3600)
+    assert valid_accounts.get_accounts() == set()
+    assert banned_accounts.get_accounts() == set()
+
+    with DBConnection():
+        account = Account.get(Account.did == "did:plc:AAAA")
+        account.is_valid = account.is_banned = True
+        account.save()
+    publish_account_change("did:plc:AAAA")
+    get_account_change_listener().last_poll_time = 0  # Don't wait for the next poll
+
+    # Every subscriber in the process should see the change
+    assert valid_accounts.get_accounts() == {"did:plc:AAAA"}
+    assert banned_accounts.get_accounts() == {"did:plc:AAAA"}
+
+
+def test_old_changes_are_not_replayed(sqlite_db_conn):
+    """changes logged before a subscriber loaded its accounts are already included"""
+    publish_account_change("did:plc:AAAA")
+    subscription = get_account_change_listener().subscribe()
+    assert subscription.get_changes() == set()
+
+    publish_account_change("did:plc:BBBB")
+    get_account_change_listener().last_poll_time = 0
+    assert subscription.get_changes() == {"did:plc:BBBB"}
+    assert subscription.get_changes() == set()
+
+
+def test_polling_is_rate_limited(sqlite_db_conn):
+    """between polls, subscribers shouldn't query the change log at all"""
+    subscription = get_account_change_listener().subscribe()
+    publish_account_change("did:plc:AAAA")
+    assert subscription.get_changes() == set()
+    with DBConnection():
+        assert AccountChange.select().count() == 1
@@ -0,0 +1,86 @@
+from astrofeed_lib.accounts import CachedAccountQuery, CachedModeratorList
+from astrofeed_lib.database import Account, DBConnection
+
+
+class _SpyingAccountQuery(CachedAccountQuery):
+    """remembers which DIDs each account query was limited to"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queried_dids = []
+
+    def account_query(self, dids=None):
+        self.queried_dids.append(dids)
+        return super().account_query(dids)
+
+
+def _create_accounts(*accounts):
+    with DBConnection():
+        for did, is_valid in accounts:
+            Account.create(handle=did, did=did, is_valid=is_valid)
+
+
+def _set_valid(did: str, is_valid: bool):
+    with DBConnection():
+        account = Account.get(Account.did == did)
+        account.is_valid = is_valid
+        account.save()
+
+
+def test_changes_are_applied_without_full_reload(sqlite_db_conn):
+    """after the first load, only changed accounts should be fetched"""
+    _create_accounts(("did:plc:AAAA", True), ("did:plc:BBBB", False))
+    accounts = _SpyingAccountQuery(
+        flags=[Account.is_valid], query_interval=-1, full_query_interval=3600
+    )
+    assert accounts.get_accounts() == {"did:plc:AAAA"}
+    assert accounts.queried_dids == [None]
+
+    _set_valid("did:plc:AAAA", False)
+    _set_valid("did:plc:BBBB", True)
+    _create_accounts(("did:plc:CCCC", True))
+    assert accounts.get_accounts() == {"did:plc:BBBB", "did:plc:CCCC"}
+    assert accounts.queried_dids[-1] == {"did:plc:AAAA", "did:plc:BBBB", "did:plc:CCCC"}
+
+
+def test_old_changes_are_not_fetched_again(sqlite_db_conn):
+    """accounts that changed long before the last refresh shouldn't be re-fetched"""
+    _create_accounts(("did:plc:AAAA", True))
+    with DBConnection():
+        Account.update(updated_at="2025-01-01 00:00:00").execute()
+
+    accounts = _SpyingAccountQuery(
+        flags=[Account.is_valid], query_interval=-1, full_query_interval=3600
+    )
+    accounts.get_accounts()
+    accounts.get_accounts()
+    assert accounts.queried_dids == [None]
+
+
+def test_full_reload_still_happens(sqlite_db_conn):
+    """changes missed by the delta refresh are picked up by the full reload"""
+    _create_accounts(("did:plc:AAAA", True))
+    accounts = _SpyingAccountQuery(
+        flags=[Account.is_valid], query_interval=-1, full_query_interval=-1
+    )
+    assert accounts.get_accounts() == {"did:plc:AAAA"}
+
+    # Deleting an account doesn't leave anything behind for a delta refresh to find
+    with DBConnection():
+        Account.delete().execute()
+    assert accounts.get_accounts() == set()
+    assert accounts.queried_dids == [None, None]
+
+
+def test_moderator_changes(sqlite_db_conn):
+    """delta refreshes also work for the moderator dict"""
+    _create_accounts(("did:plc:AAAA", True), ("did:plc:BBBB", True))
+    moderators = CachedModeratorList(query_interval=-1, full_query_interval=3600)
+    assert moderators.get_accounts() == {}
+
+    with DBConnection():
+        account = Account.get(Account.did == "did:plc:AAAA")
+        account.mod_level = 3
+        account.save()
+    assert moderators.get_accounts() == {"did:plc:AAAA": 3}
+    assert moderators.get_accounts_above_level(4) == set()
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+import pytest
+
+from astrofeed_lib.algorithm import (
+    CURSOR_END_OF_FEED,
+    create_cursor,
+    create_rank_cursor,
+    get_posts,
+    unpack_cursor,
+    unpack_rank_cursor,
+)
+from astrofeed_lib.database import Account, DBConnection, Post
+
+NOW = datetime(2025, 3, 1, 12, 0, 0, 123456)
+
+
+@pytest.fixture(scope="function")
+def posts_with_ties(sqlite_db_conn):
+    """ten posts in the astro feed, in groups that share the exact same indexed_at"""
+    with DBConnection():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        for i in range(10):
+            Post.create(
+                uri=f"at://{i}",
+                cid=f"cid{9 - i}",  # cid order shouldn't matter
+                author="did:plc:AAAA",
+                text="🔭",
+                indexed_at=NOW.replace(second=i // 3),
+                feed_all=True,
+                feed_astro=True,
+            )
+    return [f"at://{i}" for i in reversed(range(10))]
+
+
+def test_cursor_round_trip():
+    """cursors should keep the full microsecond timestamp and post ID"""
+    cursor = create_cursor(NOW, 123456789)
+    assert "::" not in cursor
+    assert unpack_cursor(cursor) == (NOW, 123456789)
+
+
+@pytest.mark.parametrize("cursor", ["nonsense!", "AAAA", create_cursor(NOW, 1)[:-4]])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        unpack_cursor(cursor)
+
+
+def test_rank_cursors_are_distinct():
+    """cursors for ranked feeds shouldn't be accepted by time-ordered feeds, or the
+    other way around
+    """
+    rank_cursor = create_rank_cursor(NOW, 5)
+    assert unpack_rank_cursor(rank_cursor) == (NOW, 5)
+    assert rank_cursor != create_cursor(NOW, 5)
+    with pytest.raises(ValueError):
+        unpack_cursor(rank_cursor)
+    with pytest.raises(ValueError):
+        unpack_rank_cursor(create_cursor(NOW, 5))
+
+
+def test_paging_with_ties(posts_with_ties):
+    """paging through a feed should return every post exactly once, in order"""
+    seen, cursor = [], None
+    while cursor != CURSOR_END_OF_FEED:
+        response = get_posts("astro", cursor, 2)
+        seen.extend(post["post"] for post in response["feed"])
+        cursor = response["cursor"]
+    assert seen == posts_with_ties
+
+
+def test_legacy_cursor_still_accepted(posts_with_ties):
+    """old '<milliseconds>::<cid>' cursors should still work, and return a new cursor"""
+    legacy_cursor = f"{int(NOW.replace(second=3).timestamp() * 1000)}::cid0"
+    response = get_posts("astro", legacy_cursor, 100)
+    assert [post["post"] for post in response["feed"]] == posts_with_ties[1:]
+    assert "::" not in response["cursor"]
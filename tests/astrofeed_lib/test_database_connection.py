@@ -0,0 +1,74 @@
+import peewee
+
+from astrofeed_lib import database
+from astrofeed_lib.database import (
+    DBConnection,
+    Account,
+    DATABASE_CONNECTS,
+    DATABASE_CONNECTION_REUSES,
+)
+
+
+def test_nested_connections_reuse_outer_connection(sqlite_db_conn):
+    """inner DBConnection blocks should reuse the open connection and leave it open"""
+    connects_before = DATABASE_CONNECTS.get()
+    reuses_before = DATABASE_CONNECTION_REUSES.get()
+
+    with DBConnection() as outer:
+        connection = outer.connection()
+        with DBConnection() as inner:
+            assert inner.connection() is connection
+            Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        assert not sqlite_db_conn.is_closed()
+
+        # If the inner block had closed the connection, this would fail
+        assert Account.select().count() == 1
+
+    assert sqlite_db_conn.is_closed()
+    assert DATABASE_CONNECTS.get() == connects_before + 1
+    assert DATABASE_CONNECTION_REUSES.get() == reuses_before + 1
+
+
+def test_nested_connection_survives_exception(sqlite_db_conn):
+    """an exception inside an inner block should not close the outer block's connection"""
+    with DBConnection():
+        try:
+            with DBConnection():
+                raise RuntimeError("oh no")
+        except RuntimeError:
+            pass
+        assert not sqlite_db_conn.is_closed()
+    assert sqlite_db_conn.is_closed()
+
+
+def test_explicit_database(tmp_path):
+    """DBConnection can also manage a database other than the main one"""
+    database = peewee.SqliteDatabase(tmp_path / "other.db", autoconnect=False)
+    with DBConnection(database) as db:
+        assert db is database
+        assert not database.is_closed()
+    assert database.is_closed()
+
+
+class _BrokenConnection:
+    closed = 0
+
+    def get_transaction_status(self):
+        return 0  # Idle
+
+    def cursor(self):
+        raise peewee.OperationalError("server closed the connection unexpectedly")
+
+    def close(self):
+        self.closed = 1
+
+
+def test_failed_health_check_closes_connection(monkeypatch):
+    """pooled connections that fail their health check should be closed, not just
+    dropped from the pool
+    """
+    monkeypatch.setattr(database, "DATABASE_POOL_HEALTH_CHECK", True)
+    db = database._HealthCheckedPooledPostgresqlDatabase("test", autoconnect=False)
+    connection = _BrokenConnection()
+    assert db._is_closed(connection)
+    assert connection.closed
@@ -0,0 +1,170 @@
+"""Checks that the precompiled emoji matchers give identical results to the emoji
+library and to substring tests, which is how posts were classified before.
+"""
+
+import json
+import os
+import random
+
+import emoji
+import pytest
+from atproto import firehose_models, models, parse_subscribe_repos_message
+from atproto.exceptions import ModelError
+
+from astrofeed_firehose.apply_commit import (
+    _get_ops_by_type,
+    _get_ops_from_jetstream_event,
+)
+from astrofeed_firehose.capture import read_capture
+from astrofeed_lib import feeds
+from astrofeed_lib.emoji_matcher import EmojiFinder, remove_emoji
+
+# A capture of the relay's firehose or of Jetstream, recorded with
+# FIREHOSE_CAPTURE_PATH (see astrofeed_firehose.capture), to check the matchers against
+# the text of real posts. Captures are full of other people's posts, so none is kept in
+# the repo, and the tests that use one are skipped unless this is set.
+TEST_CAPTURE_PATH = os.getenv("ASTROFEED_TEST_CAPTURE")
+
+# Posts like those on the feeds, with the kinds of emoji that people use
+POSTS = [
+    "Clear skies tonight! 🔭✨ Finally got Saturn through the new scope 🪐 #astrophotography",
+    "New paper on the arXiv today ☄️ we find that short-period comets are... #astrosci",
+    "☄ Comet C/2023 A3 from my backyard, 30x20s subs, no flats 😅",
+    "Our team 👩🏽‍🔬👨🏻‍💻🧑‍🚀 is hiring a postdoc! Apply by 1️⃣5️⃣ March 🇬🇧🇺🇸🇩🇪",
+    "Happy #PrideMonth from the observatory 🏳️‍🌈🏳️‍⚧️ 🌌",
+    "Rate my setup 1-10 👇 https://example.com/🔭/gallery?img=2 #astro",
+    "Eclipse glasses on!! 🌑🌒🌓🌔🌕 © NASA/JPL-Caltech ®",
+    "#️⃣ hashtags are hard *️⃣ 0⃣ #1 ranked galaxy photo",
+    "ok 👍🏿👍🏻👍 ❤️‍🔥 ❤ ♥️ ☺︎ ☺️",
+    "Scotland 🏴󠁧󠁢󠁳󠁣󠁴󠁿 and England 🏴󠁧󠁢󠁥󠁮󠁧󠁿 had the aurora 🏴 last night",
+    "The Moon 🌝 and Jupiter ♃ are close tonight, look ⬆️ to the SE ↘",
+    "👨‍👩‍👧‍👦 family stargazing trip 🚐💨 to the dark sky park 🌲🌲",
+    "Strange sequences: 🧑‍🔭‍ 👩‍ ‍🔭 🔭‍🔭 🫱🏻‍🫲🏿 🫱🏻‍ 🏻 🏻‍🦰",
+    "Japanese: 天体観測🔭 楽しい！ Arabic: علم الفلك ☄️ Emoji in text:🔭🔭🔭",
+    "No emoji at all, just #astronomy and #cosmology and numbers 2024 #3",
+    "",
+]
+
+
+def _random_texts(count: int, seed: int = 0) -> list[str]:
+    """Random mixes of emoji, parts of emoji, and characters that appear in them."""
+    rng = random.Random(seed)
+    known = list(emoji.EMOJI_DATA)
+    characters = list("ab #*019©®\n\u200d\ufe0e\ufe0f\u20e3\U000e0067\U000e007f🏻🇺")
+    texts = []
+    for _ in range(count):
+        pieces = []
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.5:
+                pieces.append(rng.choice(characters))
+            else:
+                # Whole emoji, and only the start of one
+                pieces.append(rng.choice(known)[: rng.randint(1, 5)])
+        texts.append("".join(pieces))
+    return texts
+
+
+def _post_texts_from_capture(path: str) -> list[str]:
+    """The text of every post created in a capture file."""
+    texts = []
+    for raw_frame in read_capture(path):
+        if raw_frame[:1] == b"{":
+            ops = _get_ops_from_jetstream_event(json.loads(bytes(raw_frame)))
+        else:
+            frame = firehose_models.Frame.from_bytes(bytes(raw_frame))
+            if not isinstance(frame, firehose_models.MessageFrame):
+                continue
+            try:
+                commit = parse_subscribe_repos_message(frame)
+            except ModelError:
+                continue
+            if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+                continue
+            ops = _get_ops_by_type(commit)
+        texts.extend(post["record"].text for post in ops["posts"]["created"])
+    return texts
+
+
+@pytest.fixture(scope="module")
+def captured_posts() -> list[str]:
+    if TEST_CAPTURE_PATH is None:
+        pytest.skip("ASTROFEED_TEST_CAPTURE isn't set to a capture file.")
+    texts = _post_texts_from_capture(TEST_CAPTURE_PATH)
+    if not texts:
+        pytest.skip(f"{TEST_CAPTURE_PATH} has no posts.")
+    return texts
+
+
+@pytest.mark.parametrize("text", POSTS)
+def test_emoji_removed_like_emoji_library(text):
+    assert remove_emoji(text) == emoji.replace_emoji(text, replace="")
+
+
+def test_every_emoji_removed_like_emoji_library():
+    """every emoji that the library knows, on its own and between text"""
+    for known in emoji.EMOJI_DATA:
+        for text in (known, f"a{known}b", f"{known}{known}", f"#{known}1"):
+            assert remove_emoji(text) == emoji.replace_emoji(text, replace=""), text
+
+
+def test_random_text_removed_like_emoji_library():
+    for text in _random_texts(20000):
+        assert remove_emoji(text) == emoji.replace_emoji(text, replace=""), text
+
+
+def test_captured_posts_removed_like_emoji_library(captured_posts):
+    for text in captured_posts:
+        assert remove_emoji(text) == emoji.replace_emoji(text, replace=""), text
+
+
+def test_emoji_found_like_substrings():
+    """emoji should be found wherever they are in the text, even inside other emoji"""
+    emoji_by_label = {
+        "telescope": ["🔭"],
+        "comet": ["☄️", "☄"],
+        "people": ["🧑", "🧑‍🚀"],
+        "flag": ["🏴"],
+        "none": [],
+    }
+    finder = EmojiFinder(emoji_by_label)
+    for text in POSTS + _random_texts(2000, seed=1):
+        expected = {
+            label
+            for label, emojis in emoji_by_label.items()
+            if any(emoji in text for emoji in emojis)
+        }
+        assert finder.labels_in(text) == expected, text
+
+
+def _post_in_feeds_with_emoji_library(post: str) -> dict:
+    """How posts were classified before the emoji matchers"""
+    post_without_links = feeds.remove_links_from_post(post)
+    words = [
+        f" {word} "
+        for word in emoji.replace_emoji(
+            feeds.remove_punctuation_from_post(post_without_links), replace=""
+        ).split()
+    ]
+    labels = {}
+    for feed, terms in feeds.FEED_TERMS_WITH_SPACES.items():
+        in_feed = terms is None or (
+            any(emoji in post for emoji in terms["emoji"])
+            or any(word in terms["words"] for word in words)
+        )
+        labels[f"feed_{feed}"] = in_feed
+        if in_feed and feed not in ("astro", "questions", "all"):
+            labels["feed_astro"] = True
+            if feed not in ("research", "astrophotos"):
+                labels["feed_research"] = True
+    return labels
+
+
+def test_posts_classified_like_emoji_library():
+    for text in POSTS + _random_texts(2000, seed=2):
+        assert feeds.post_in_feeds(text) == _post_in_feeds_with_emoji_library(text)
+
+
+def test_captured_posts_classified_like_emoji_library(captured_posts):
+    for text in captured_posts:
+        expected = _post_in_feeds_with_emoji_library(text)
+        assert feeds.post_in_feeds(text) == expected, text
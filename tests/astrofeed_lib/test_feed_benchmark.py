@@ -0,0 +1,90 @@
+"""Micro-benchmark of the feed query path, comparing model hydration (how get_posts
+used to build feeds) with the plain tuples it uses now. Run with `pytest -s` to see the
+numbers.
+"""
+
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytest
+
+from astrofeed_lib.algorithm import (
+    _create_feed_and_cursor,
+    _handle_cursor,
+    _select_posts,
+    create_cursor,
+)
+from astrofeed_lib.database import Account, DBConnection, Post
+
+POSTS_IN_DATABASE = 2000
+LIMIT = 100
+REPEATS = 50
+
+
+@pytest.fixture(scope="function")
+def feed_db(sqlite_db_conn):
+    start = datetime(2025, 3, 1)
+    with DBConnection(), sqlite_db_conn.atomic():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        Post.insert_many(
+            [
+                dict(
+                    uri=f"at://did:plc:AAAA/app.bsky.feed.post/{i}",
+                    cid=f"cid{i}",
+                    author="did:plc:AAAA",
+                    text="🔭",
+                    indexed_at=start + timedelta(seconds=i),
+                    feed_all=True,
+                    feed_astro=True,
+                )
+                for i in range(POSTS_IN_DATABASE)
+            ]
+        ).execute()
+    return sqlite_db_conn
+
+
+def _feed_with_models(query):
+    posts = list(query)
+    feed = [{"post": post.uri} for post in posts]
+    last_post = posts[-1]
+    return feed, create_cursor(last_post.indexed_at, last_post.id)
+
+
+def _feed_with_tuples(query):
+    return _create_feed_and_cursor(list(query.tuples()))
+
+
+def _measure(build_feed, query) -> tuple[float, int, tuple]:
+    """Returns the mean time per request, the memory blocks allocated per request and
+    the result of one request.
+    """
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        build_feed(query.clone())
+    elapsed = (time.perf_counter() - start) / REPEATS
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = build_feed(query.clone())
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return elapsed, blocks, result
+
+
+def test_feed_query_benchmark(feed_db):
+    cursor = create_cursor(datetime(2025, 3, 1) + timedelta(seconds=1500), 1500)
+    query = _handle_cursor(cursor, _select_posts("astro", LIMIT))
+
+    with DBConnection():
+        model_time, model_blocks, model_result = _measure(_feed_with_models, query)
+        tuple_time, tuple_blocks, tuple_result = _measure(_feed_with_tuples, query)
+
+    print(
+        f"\nFeed query, {LIMIT} posts per request:"
+        f"\n  models: {model_time * 1e3:.3f} ms/request, {model_blocks} objects/request"
+        f"\n  tuples: {tuple_time * 1e3:.3f} ms/request, {tuple_blocks} objects/request"
+    )
+    assert tuple_result == model_result
+    assert tuple_blocks < model_blocks
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from astrofeed_lib import algorithm
+from astrofeed_lib.algorithm import (
+    CURSOR_END_OF_FEED,
+    FeedProvider,
+    NoRepliesFeedProvider,
+    SignupFeedProvider,
+    get_posts,
+)
+from astrofeed_lib.database import Account, BotActions, DBConnection, Post, hash_uri
+
+START = datetime(2025, 3, 1)
+
+
+def _create_bot_action(i: int, stage="get_moderator", complete=False, type="signup"):
+    BotActions.create(
+        indexed_at=START + timedelta(minutes=i),
+        did=f"did:plc:{i}",
+        type=type,
+        stage=stage,
+        complete=complete,
+        latest_uri=f"at://signup/{i}",
+        latest_cid=f"cid{i}",
+    )
+
+
+def test_signup_feed(sqlite_db_conn):
+    """only outstanding signups waiting for a moderator should be in the feed"""
+    with DBConnection():
+        for i in range(5):
+            _create_bot_action(i)
+        _create_bot_action(5, complete=True)
+        _create_bot_action(6, stage="initial")
+        _create_bot_action(7, type="hide")
+
+    first_page = get_posts("signup", None, 3)
+    assert first_page["feed"] == [{"post": f"at://signup/{i}"} for i in (4, 3, 2)]
+    second_page = get_posts("signup", first_page["cursor"], 3)
+    assert second_page["feed"] == [{"post": f"at://signup/{i}"} for i in (1, 0)]
+    assert get_posts("signup", second_page["cursor"], 3)["feed"] == []
+
+
+def test_signup_feed_uses_index(sqlite_db_conn):
+    """the signup feed shouldn't need to scan or sort BotActions"""
+    query = SignupFeedProvider().select("signup", 10)
+    with DBConnection() as db:
+        sql, params = query.sql()
+        plan = " ".join(
+            str(row) for row in db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+        )
+    assert "botactions_type_stage_complete_indexed_at_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+class _EveryPostProvider(FeedProvider):
+    def select(self, feed, limit):
+        return (
+            Post.select(Post.id, Post.indexed_at, Post.uri)
+            .order_by(Post.indexed_at.desc(), Post.id.desc())
+            .limit(limit)
+        )
+
+
+def test_custom_provider(sqlite_db_conn, monkeypatch):
+    """new kinds of feed only need to say how to select their posts"""
+    monkeypatch.setitem(algorithm.FEED_PROVIDERS, "everything", _EveryPostProvider())
+    with DBConnection():
+        for i in range(3):
+            Post.create(
+                uri=f"at://{i}",
+                cid=f"cid{i}",
+                author="did:plc:AAAA",
+                text="",
+                indexed_at=START + timedelta(minutes=i),
+            )
+
+    response = get_posts("everything", None, 3)
+    assert response["feed"] == [{"post": f"at://{i}"} for i in (2, 1, 0)]
+    assert get_posts("everything", response["cursor"], 3)["cursor"] == (
+        CURSOR_END_OF_FEED
+    )
+
+
+def test_no_replies_feed(sqlite_db_conn):
+    """no-replies feeds should only contain posts that start a thread"""
+    with DBConnection():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        for i in range(6):
+            Post.create(
+                uri=f"at://{i}",
+                cid=f"cid{i}",
+                author="did:plc:AAAA",
+                text="🔭",
+                indexed_at=START + timedelta(minutes=i),
+                feed_astro=True,
+                is_reply=i % 2 == 1,
+                reply_root=hash_uri("at://0") if i % 2 == 1 else None,
+            )
+
+    assert len(get_posts("astro", None, 10)["feed"]) == 6
+    first_page = get_posts("astro-noreplies", None, 2)
+    assert first_page["feed"] == [{"post": "at://4"}, {"post": "at://2"}]
+    second_page = get_posts("astro-noreplies", first_page["cursor"], 2)
+    assert second_page["feed"] == [{"post": "at://0"}]
+
+
+def test_no_replies_feed_uses_index(sqlite_db_conn):
+    """the no-replies feeds shouldn't need to sort posts"""
+    query = NoRepliesFeedProvider().select("astro-noreplies", 10)
+    with DBConnection() as db:
+        sql, params = query.sql()
+        plan = " ".join(
+            str(row) for row in db.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+        )
+    assert "post_is_reply_indexed_at_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_provider_must_select():
+    """a provider that doesn't say how to select its posts can't be created"""
+
+    class _NoSelectProvider(FeedProvider):
+        pass
+
+    with pytest.raises(TypeError):
+        _NoSelectProvider()
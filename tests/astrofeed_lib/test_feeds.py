@@ -0,0 +1,63 @@
+from astrofeed_lib import feeds
+from astrofeed_lib.feeds import post_in_feeds
+
+
+def test_hashtags_from_facets():
+    """hashtags should also come from tag facets, which gets hashtags followed by
+    punctuation or other scripts right
+    """
+    assert post_in_feeds("Jupiter tonight #astro—", facet_tags=["astro"])["feed_astro"]
+    assert post_in_feeds("木星 ＃astronomy", facet_tags=["Astronomy"])["feed_astro"]
+    assert not post_in_feeds("Jupiter tonight #astro—")["feed_astro"]
+
+    # Facets only add feeds to those from the text
+    assert post_in_feeds(
+        "My #astro-photography setup", facet_tags=["astro-photography"]
+    )["feed_astro"]
+    assert post_in_feeds("My #astro-photography setup")["feed_astro"]
+
+
+def test_hashtags_without_facets_from_text():
+    """hashtags that don't have a facet should still be found in the text when others
+    do
+    """
+    labels = post_in_feeds("Tonight! #astro #cosmology", facet_tags=["astro"])
+    assert labels["feed_astro"] and labels["feed_cosmology"]
+
+
+def test_hashtags_from_text_without_facets():
+    """posts without tag facets should still have the hashtags in their text matched"""
+    labels = post_in_feeds("New paper! #AstroSci #cosmology")
+    assert labels["feed_research"] and labels["feed_cosmology"]
+    assert not labels["feed_exoplanets"]
+
+
+def test_record_tags_included():
+    """tags in a post's tags field should be matched alongside its text or facets"""
+    assert post_in_feeds("Look up", record_tags=["exoplanets"])["feed_exoplanets"]
+    labels = post_in_feeds(
+        "#cosmology", facet_tags=["cosmology"], record_tags=["#Exoplanet"]
+    )
+    assert labels["feed_cosmology"] and labels["feed_exoplanets"]
+
+
+def test_emoji_still_found_with_facets():
+    """feed emoji are found in the text even when hashtags come from facets"""
+    assert post_in_feeds("🔭 #caturday", facet_tags=["caturday"])["feed_astro"]
+    assert post_in_feeds("#astronomy🔭", facet_tags=["astronomy🔭"])["feed_astro"]
+
+
+def test_text_without_hashtags_not_tokenized(monkeypatch):
+    """the text of posts without a '#' can't match any feed words (which are all
+    hashtags), so it shouldn't be tokenized, while tags and emoji still count
+    """
+
+    def cleaned_word_list(post):
+        raise AssertionError(f"Tokenized {post!r}")
+
+    monkeypatch.setattr(feeds, "cleaned_word_list", cleaned_word_list)
+    labels = post_in_feeds(
+        "Saturn 🔭", facet_tags=["cosmology"], record_tags=["exoplanets"]
+    )
+    assert labels["feed_astro"] and labels["feed_cosmology"]
+    assert labels["feed_exoplanets"] and not labels["feed_astrophotos"]
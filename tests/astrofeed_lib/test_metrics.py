@@ -0,0 +1,136 @@
+import socket
+import urllib.request
+
+import pytest
+
+from astrofeed_lib.database import (
+    DBConnection,
+    Account,
+    DATABASE_QUERY_SECONDS,
+    DATABASE_SLOW_QUERIES,
+)
+from astrofeed_lib import database
+from astrofeed_lib.metrics import (
+    _Metric,
+    MetricsRegistry,
+    render_prometheus,
+    serve_metrics_on_free_port,
+)
+
+
+def test_prometheus_text_format():
+    """metrics should render in the Prometheus text exposition format"""
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "A counter.", labelnames=("feed",))
+    gauge = registry.gauge("test_gauge", "A gauge.", function=lambda: 3)
+    histogram = registry.histogram("test_seconds", "A histogram.", buckets=(0.1, 1.0))
+
+    counter.inc(feed="astro")
+    counter.inc(2, feed='"quoted"')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+
+    assert gauge.get() == 3
+    assert registry.render().splitlines() == [
+        "# HELP test_total A counter.",
+        "# TYPE test_total counter",
+        'test_total{feed="astro"} 1',
+        'test_total{feed="\\"quoted\\""} 2',
+        "# HELP test_gauge A gauge.",
+        "# TYPE test_gauge gauge",
+        "test_gauge 3",
+        "# HELP test_seconds A histogram.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]
+
+
+def test_labels_must_match():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "A counter.", labelnames=("feed",))
+    with pytest.raises(ValueError):
+        counter.inc(model="Post")
+    with pytest.raises(ValueError):
+        registry.counter("test_total", "Registered twice.")
+
+
+def test_metrics_must_have_samples():
+    """metric types have to say how their values are rendered"""
+
+    class Untyped(_Metric):
+        pass
+
+    with pytest.raises(TypeError):
+        Untyped("test_untyped", "No samples.")
+
+
+def test_metrics_served_on_first_free_port():
+    """processes without a fixed port (like gunicorn workers) should take the first
+    free one"""
+    taken = socket.socket()
+    taken.bind(("127.0.0.1", 0))
+    taken.listen()
+    first_port = taken.getsockname()[1]
+
+    servers = []
+    try:
+        server = serve_metrics_on_free_port(first_port, 100, render=lambda: "test 1\n")
+        assert server is not None
+        servers.append(server)
+        port = server.server_address[1]
+        assert first_port < port < first_port + 100
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.read() == b"test 1\n"
+
+        # Every port in the range is in use
+        assert serve_metrics_on_free_port(first_port, port - first_port + 1) is None
+    finally:
+        taken.close()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+def test_queries_are_timed_by_model_and_operation(sqlite_db_conn):
+    selects_before = DATABASE_QUERY_SECONDS.get_count(
+        model="Account", operation="select"
+    )
+    inserts_before = DATABASE_QUERY_SECONDS.get_count(
+        model="Account", operation="insert"
+    )
+
+    with DBConnection():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        list(Account.select().where(Account.is_valid))
+
+    assert (
+        DATABASE_QUERY_SECONDS.get_count(model="Account", operation="insert")
+        == inserts_before + 1
+    )
+    assert (
+        DATABASE_QUERY_SECONDS.get_count(model="Account", operation="select")
+        == selects_before + 1
+    )
+    assert (
+        'astrofeed_database_query_seconds_count{model="Account",operation="select"}'
+        in render_prometheus()
+    )
+
+
+def test_slow_queries_are_logged(sqlite_db_conn, monkeypatch, caplog):
+    monkeypatch.setattr(database, "DATABASE_SLOW_QUERY_THRESHOLD", 0.0)
+    slow_before = DATABASE_SLOW_QUERIES.get(model="Account", operation="select")
+
+    with DBConnection():
+        list(Account.select().where(Account.handle == "Bob"))
+
+    assert (
+        DATABASE_SLOW_QUERIES.get(model="Account", operation="select")
+        == slow_before + 1
+    )
+    assert any('FROM "account"' in record.getMessage() for record in caplog.records)
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from astrofeed_lib.algorithm import (
+    CURSOR_END_OF_FEED,
+    create_cursor,
+    get_posts,
+    unpack_rank_cursor,
+)
+from astrofeed_lib.database import Account, DBConnection, Post, TopPost
+from astrofeed_lib.ranking import TOP_FEED_WINDOW, refresh_top_feeds, score_post
+
+NOW = datetime(2025, 3, 1, 12)
+
+
+def _create_post(i: int, likes: int, age: timedelta, author="did:plc:AAAA", **feeds):
+    Post.create(
+        uri=f"at://{i}",
+        cid=f"cid{i}",
+        author=author,
+        text="🔭",
+        indexed_at=NOW - age,
+        likes=likes,
+        feed_all=True,
+        **feeds,
+    )
+
+
+def test_score_decays_with_age():
+    """newer posts should need fewer likes to rank as highly as older ones"""
+    assert score_post(10, timedelta(hours=1)) > score_post(10, timedelta(hours=5))
+    assert score_post(5, timedelta(0)) > score_post(10, timedelta(hours=6))
+    assert score_post(0, timedelta(0)) == 0
+
+
+def test_top_feeds(sqlite_db_conn):
+    with DBConnection():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        Account.create(handle="Bob", did="did:plc:BBBB", is_valid=True, is_banned=True)
+        _create_post(0, 5, timedelta(hours=1), feed_astro=True)
+        _create_post(1, 50, timedelta(hours=20), feed_astro=True)
+        _create_post(2, 20, timedelta(hours=2), feed_astro=True)
+        _create_post(3, 0, timedelta(hours=1), feed_astro=True)  # No likes
+        _create_post(4, 100, TOP_FEED_WINDOW + timedelta(hours=1), feed_astro=True)
+        _create_post(5, 100, timedelta(hours=1), author="did:plc:BBBB", feed_astro=True)
+        _create_post(6, 10, timedelta(hours=1))  # Not an astro post
+
+    counts = refresh_top_feeds(NOW)
+    assert counts["top-astro"] == 3
+    assert counts["top-all"] == 4
+
+    first_page = get_posts("top-astro", None, 2)
+    assert first_page["feed"] == [{"post": "at://2"}, {"post": "at://0"}]
+    assert unpack_rank_cursor(first_page["cursor"]) == (NOW, 1)
+    second_page = get_posts("top-astro", first_page["cursor"], 2)
+    assert second_page["feed"] == [{"post": "at://1"}]
+    assert get_posts("top-astro", second_page["cursor"], 2)["cursor"] == (
+        CURSOR_END_OF_FEED
+    )
+
+    # Cursors from time-ordered feeds aren't ranks
+    with pytest.raises(ValueError):
+        get_posts("top-astro", create_cursor(NOW, 1), 2)
+
+    # Refreshing again should replace the feeds, not add to them
+    refresh_top_feeds(NOW + TOP_FEED_WINDOW)
+    with DBConnection():
+        assert TopPost.select().count() == 0
+
+
+def test_top_feed_refreshed_between_pages(sqlite_db_conn):
+    """paging from a cursor for an old ranking should end the feed, rather than
+    continuing by rank in a new ranking that may repeat or skip posts
+    """
+    with DBConnection():
+        Account.create(handle="Alice", did="did:plc:AAAA", is_valid=True)
+        for i in range(4):
+            _create_post(i, 10 * (i + 1), timedelta(hours=1), feed_astro=True)
+
+    refresh_top_feeds(NOW)
+    first_page = get_posts("top-astro", None, 2)
+    assert first_page["feed"] == [{"post": "at://3"}, {"post": "at://2"}]
+
+    refresh_top_feeds(NOW + timedelta(minutes=5))
+    second_page = get_posts("top-astro", first_page["cursor"], 2)
+    assert second_page == {"cursor": CURSOR_END_OF_FEED, "feed": []}
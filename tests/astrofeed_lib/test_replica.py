@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+
+import peewee
+import pytest
+from peewee import DatabaseProxy
+
+from astrofeed_lib import database
+from astrofeed_lib.algorithm import get_posts
+from astrofeed_lib.database import (
+    Account,
+    ActivityLog,
+    BotActions,
+    ModActions,
+    NormalizedFeedStats,
+    Post,
+    ReplicaRouter,
+    SubscriptionState,
+    get_read_database,
+)
+
+NOW = datetime(2025, 3, 1, 12, 0, 0)
+
+
+@pytest.fixture(scope="function")
+def replica_router(sqlite_db_conn, tmp_path, monkeypatch):
+    """sets up a second SQLite file as a read replica of the test database, and routes
+    read-only queries through it
+    """
+    replica_db = peewee.SqliteDatabase(tmp_path / "replica.db", autoconnect=False)
+    models = [
+        Post,
+        SubscriptionState,
+        Account,
+        BotActions,
+        ModActions,
+        ActivityLog,
+        NormalizedFeedStats,
+    ]
+    with replica_db.connection_context(), replica_db.bind_ctx(models):
+        replica_db.create_tables(models)
+    replica = DatabaseProxy()
+    replica.initialize(replica_db)
+
+    router = ReplicaRouter(sqlite_db_conn, replica, max_lag=60, check_interval=0)
+    monkeypatch.setattr(database, "replica_router", router)
+    return router
+
+
+def _add_post(db, uri: str, indexed_at: datetime):
+    """adds a valid author and a post in the astro feed to one of the databases"""
+    with database.DBConnection(db) as conn:
+        if Account.select().where(Account.did == "did:plc:AAAA").count(conn) == 0:
+            Account.insert(handle="Alice", did="did:plc:AAAA", is_valid=True).execute(
+                conn
+            )
+        Post.insert(
+            uri=uri,
+            cid=uri,
+            author="did:plc:AAAA",
+            text="🔭",
+            indexed_at=indexed_at,
+            feed_all=True,
+            feed_astro=True,
+        ).execute(conn)
+
+
+def test_reads_go_to_up_to_date_replica(replica_router):
+    """when the replica has caught up, posts are read from it"""
+    _add_post(replica_router.primary, "at://primary", NOW)
+    _add_post(replica_router.replica, "at://replica", NOW)
+
+    assert get_read_database() is replica_router.replica
+    assert get_posts("astro", None, 10)["feed"] == [{"post": "at://replica"}]
+    assert replica_router.lag == 0
+
+
+def test_lagging_replica_falls_back_to_primary(replica_router):
+    """when the replica is too far behind, posts are read from the primary"""
+    _add_post(replica_router.primary, "at://primary", NOW)
+    _add_post(replica_router.replica, "at://replica", NOW - timedelta(minutes=5))
+
+    assert get_read_database() is replica_router.primary
+    assert get_posts("astro", None, 10)["feed"] == [{"post": "at://primary"}]
+    assert replica_router.lag == 300
+
+
+def test_empty_replica_falls_back_to_primary(replica_router):
+    """a replica that has nothing yet is treated as infinitely far behind"""
+    _add_post(replica_router.primary, "at://primary", NOW)
+    assert get_read_database() is replica_router.primary
+
+
+def test_unreachable_replica_falls_back_to_primary(replica_router):
+    """if the replica can't be checked, reads go to the primary"""
+    _add_post(replica_router.primary, "at://primary", NOW)
+    replica_router.replica.initialize(
+        peewee.SqliteDatabase("/nonexistent/replica.db", autoconnect=False)
+    )
+    assert get_read_database() is replica_router.primary
+    assert replica_router.lag is None
+
+
+def test_no_replica_uses_primary(sqlite_db_conn):
+    """without BLUESKY_REPLICA_DATABASE, everything is read from the primary"""
+    assert database.replica_router is None
+    assert get_read_database() is sqlite_db_conn
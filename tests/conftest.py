@@ -1,8 +1,22 @@
+import peewee
 import pytest
 from datetime import datetime
 from atproto import Client
 
-from astrofeed_lib.database import proxy
+from astrofeed_lib.database import (
+    proxy,
+    Post,
+    SubscriptionState,
+    Account,
+    BotActions,
+    ModActions,
+    ActivityLog,
+    NormalizedFeedStats,
+    AccountChange,
+    PostLike,
+    TopPost,
+)
+from astrofeed_lib import account_changes
 from astrofeed_lib.config import ASTROFEED_PRODUCTION
 from astrobot.generate_notification import construct_strong_ref_main
 from tests.test_lib.test_database import build_test_db, populate_test_db, delete_test_db
@@ -86,3 +100,38 @@ def test_db_conn(test_db_conn_session):
 
     # send session connection to the requesting test
     return test_db_conn_session
+
+
+@pytest.fixture(scope="function")
+def sqlite_db_conn(tmp_path, monkeypatch):
+    """points the database proxy at a fresh, empty SQLite database for one test
+
+    Unlike test_db_conn, this does not need a running PostgreSQL server, so it's useful
+    for testing connection handling and query logic that isn't database-specific.
+    """
+    db_conn = peewee.SqliteDatabase(tmp_path / "test.db", autoconnect=False)
+    database_prev = proxy.obj
+    proxy.initialize(db_conn)
+    with db_conn.connection_context():
+        db_conn.create_tables(
+            [
+                Post,
+                SubscriptionState,
+                Account,
+                BotActions,
+                ModActions,
+                ActivityLog,
+                NormalizedFeedStats,
+                AccountChange,
+                PostLike,
+                TopPost,
+            ]
+        )
+
+    # The account change listener remembers where it got to in the change log
+    monkeypatch.setattr(account_changes, "listener", None)
+
+    yield proxy
+    if not proxy.is_closed():
+        proxy.close()
+    proxy.initialize(database_prev)